@@ -0,0 +1,2601 @@
+"""ai-hearthstone 性能基准测试
+
+不需要启动游戏：所有基准都基于合成的 Power.log (格式与炉石客户端输出一致)。
+
+用法:
+    python benchmark.py            # 运行全部基准
+    python benchmark.py parse      # 只运行指定基准
+    python benchmark.py --list     # 列出可用基准
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from io import StringIO
+
+
+# ---------------------------------------------------------------------------
+# 合成 Power.log
+# ---------------------------------------------------------------------------
+
+# (card_id, 费用, 攻击, 生命, 关键字)
+SYNTHETIC_MINIONS = [
+    ("CS2_168", 1, 2, 1, ""),        # 鱼人袭击者
+    ("CS2_172", 2, 3, 2, ""),        # 血沼迅猛龙
+    ("CS2_120", 2, 2, 3, ""),        # 淡水鳄
+    ("CS2_121", 2, 2, 2, "TAUNT"),   # 霜狼步兵
+    ("CS2_124", 3, 3, 1, "CHARGE"),  # 狼骑兵
+    ("CS2_125", 3, 3, 3, "TAUNT"),   # 铁鬃灰熊
+    ("CS2_182", 4, 4, 5, ""),        # 冰风雪人
+    ("CS2_119", 4, 2, 7, ""),        # 绿洲钳嘴龟
+    ("CS2_179", 4, 3, 5, "TAUNT"),   # 森金持盾卫士
+    ("CS2_200", 6, 6, 7, ""),        # 石拳食人魔
+    ("CS2_186", 7, 7, 7, ""),        # 作战傀儡
+    ("EX1_008", 1, 1, 1, "DIVINE_SHIELD"),  # 银色侍从
+]
+SYNTHETIC_ENCHANTMENTS = ["EX1_019e", "CS2_122e"]
+SYNTHETIC_SPELLS = [
+    ("CS2_029", 4, 6),  # 火球术
+    ("CS2_024", 2, 3),  # 寒冰箭
+]
+SYNTHETIC_HEROES = ["HERO_08", "HERO_01"]
+SYNTHETIC_PLAYERS = ["Friendly#1001", "Opponent#2002"]
+
+
+class _SyntheticGame:
+    """生成一局完整对局的日志行 (GameState + PowerTaskList 两份)"""
+
+    def __init__(self, rng, clock, max_turns, discover_every, hero_health=30):
+        self.rng = rng
+        self.clock = clock
+        self.max_turns = max_turns
+        self.discover_every = discover_every
+        self.max_health = hero_health
+        self.lines = []
+        self._pending_ptl = []
+        self.next_id = 4
+        self.choice_id = 1
+        self.entities = {}
+        self.hero_health = {1: hero_health, 2: hero_health}
+
+    # -- 行输出 --
+
+    def _ts(self):
+        self.clock[0] += timedelta(milliseconds=self.rng.randint(1, 40))
+        return self.clock[0].strftime("%H:%M:%S.%f") + "0"
+
+    def power(self, text, indent=0):
+        body = " " * (4 * indent) + text
+        self.lines.append(f"D {self._ts()} GameState.DebugPrintPower() - {body}\n")
+        self._pending_ptl.append(body)
+
+    def raw(self, method, text):
+        self.lines.append(f"D {self._ts()} {method}() - {text}\n")
+
+    def flush_task_list(self):
+        """PowerTaskList 在 GameState 之后成批输出同样的内容 (hslog 会忽略它)"""
+        for body in self._pending_ptl:
+            self.lines.append(f"D {self._ts()} PowerTaskList.DebugPrintPower() - {body}\n")
+        self._pending_ptl = []
+
+    # -- 实体 --
+
+    def ref(self, eid):
+        e = self.entities[eid]
+        card_id = e["card_id"] if e["revealed"] else ""
+        name = card_id or "UNKNOWN ENTITY [cardType=INVALID]"
+        return f"[entityName={name} id={eid} zone={e['zone']} zonePos={e['pos']} cardId={card_id} player={e['player']}]"
+
+    def tag(self, entity, tag, value):
+        if isinstance(entity, int):
+            entity = self.ref(entity)
+        self.power(f"TAG_CHANGE Entity={entity} tag={tag} value={value} ")
+
+    def stat_tags(self, eid, indent):
+        e = self.entities[eid]
+        self.power(f"tag=CONTROLLER value={e['player']}", indent)
+        self.power(f"tag=CARDTYPE value={e['type']}", indent)
+        self.power(f"tag=COST value={e['cost']}", indent)
+        if e["type"] == "MINION":
+            self.power(f"tag=ATK value={e['atk']}", indent)
+            self.power(f"tag=HEALTH value={e['health']}", indent)
+            if e["keyword"]:
+                self.power(f"tag={e['keyword']} value=1", indent)
+        self.power(f"tag=ZONE value={e['zone']}", indent)
+        self.power(f"tag=ZONE_POSITION value={e['pos']}", indent)
+        self.power(f"tag=ENTITY_ID value={eid}", indent)
+
+    def new_card(self, player, zone, revealed):
+        if self.rng.random() < 0.2:
+            card_id, cost, dmg = self.rng.choice(SYNTHETIC_SPELLS)
+            card = dict(type="SPELL", cost=cost, atk=0, health=0, keyword="", dmg=dmg)
+        else:
+            card_id, cost, atk, health, keyword = self.rng.choice(SYNTHETIC_MINIONS)
+            card = dict(type="MINION", cost=cost, atk=atk, health=health, keyword=keyword)
+        eid = self.next_id
+        self.next_id += 1
+        card.update(card_id=card_id, player=player, zone=zone, pos=0, revealed=revealed, damage=0)
+        self.entities[eid] = card
+        return eid
+
+    def zone_of(self, player, zone):
+        ids = [i for i, e in self.entities.items()
+               if e["player"] == player and e["zone"] == zone and e["type"] in ("MINION", "SPELL")]
+        return sorted(ids, key=lambda i: self.entities[i]["pos"])
+
+    def move(self, eid, zone):
+        e = self.entities[eid]
+        old_zone = e["zone"]
+        e["zone"] = zone
+        if zone in ("HAND", "PLAY"):
+            e["pos"] = len(self.zone_of(e["player"], zone))
+        else:
+            e["pos"] = 0
+        for i, other in enumerate(self.zone_of(e["player"], old_zone), 1):
+            if old_zone in ("HAND", "PLAY") and self.entities[other]["pos"] != i:
+                self.entities[other]["pos"] = i
+                self.tag(other, "ZONE_POSITION", i)
+
+    # -- 对局流程 --
+
+    def create_game(self):
+        self.power("CREATE_GAME")
+        self.power("GameEntity EntityID=1", 1)
+        for tag, value in [("CARDTYPE", "GAME"), ("ZONE", "PLAY"), ("ENTITY_ID", 1)]:
+            self.power(f"tag={tag} value={value}", 2)
+        for pid in (1, 2):
+            self.power(f"Player EntityID={pid + 1} PlayerID={pid} GameAccountId=[hi=144115193835963207 lo={30722000 + pid}]", 1)
+            for tag, value in [("PLAYER_ID", pid), ("HERO_ENTITY", 1 + pid * 2), ("MAXHANDSIZE", 10),
+                               ("MAXRESOURCES", 10), ("CONTROLLER", pid), ("CARDTYPE", "PLAYER"),
+                               ("ENTITY_ID", pid + 1), ("ZONE", "PLAY")]:
+                self.power(f"tag={tag} value={value}", 2)
+        for pid in (1, 2):
+            hero_id = 1 + pid * 2
+            self.entities[hero_id] = dict(card_id=SYNTHETIC_HEROES[pid - 1], player=pid, zone="PLAY",
+                                          pos=0, revealed=True, type="HERO")
+            self.power(f"FULL_ENTITY - Creating ID={hero_id} CardID={SYNTHETIC_HEROES[pid - 1]}")
+            for tag, value in [("HEALTH", self.max_health), ("ZONE", "PLAY"), ("CONTROLLER", pid),
+                               ("ENTITY_ID", hero_id), ("CARDTYPE", "HERO")]:
+                self.power(f"tag={tag} value={value}", 1)
+        self.next_id = 6
+        for pid in (1, 2):
+            for _ in range(30):
+                eid = self.new_card(pid, "DECK", revealed=False)
+                self.power(f"FULL_ENTITY - Creating ID={eid} CardID=")
+                for tag, value in [("ZONE", "DECK"), ("CONTROLLER", pid), ("ENTITY_ID", eid)]:
+                    self.power(f"tag={tag} value={value}", 1)
+        for pid, name in enumerate(SYNTHETIC_PLAYERS, 1):
+            self.raw("GameState.DebugPrintGame", f"PlayerID={pid}, PlayerName={name}")
+        self.flush_task_list()
+
+    def draw(self, player):
+        deck = [i for i in self.zone_of(player, "DECK")]
+        if not deck or len(self.zone_of(player, "HAND")) >= 10:
+            return None
+        eid = self.rng.choice(deck)
+        self.move(eid, "HAND")
+        e = self.entities[eid]
+        if player == 1:
+            # 友方抽牌会揭示卡牌
+            unknown = f"[entityName=UNKNOWN ENTITY [cardType=INVALID] id={eid} zone=DECK zonePos=0 cardId= player=1]"
+            self.tag(unknown, "ZONE", "HAND")
+            e["revealed"] = True
+            self.power(f"SHOW_ENTITY - Updating Entity={unknown} CardID={e['card_id']}")
+            self.stat_tags(eid, 1)
+        else:
+            self.tag(eid, "ZONE", "HAND")
+            self.tag(eid, "ZONE_POSITION", e["pos"])
+        return eid
+
+    def mulligan(self):
+        self.tag("GameEntity", "STEP", "BEGIN_MULLIGAN")
+        for player, count in ((1, 3), (2, 4)):
+            for _ in range(count):
+                self.draw(player)
+        self.flush_task_list()
+        self.tag(SYNTHETIC_PLAYERS[0], "MULLIGAN_STATE", "INPUT")
+        hand = self.zone_of(1, "HAND")
+        self.raw("GameState.DebugPrintEntityChoices",
+                 f"id={self.choice_id} Player={SYNTHETIC_PLAYERS[0]} TaskList= ChoiceType=MULLIGAN CountMin=0 CountMax={len(hand)}")
+        self.raw("GameState.DebugPrintEntityChoices", "Source=GameEntity")
+        for i, eid in enumerate(hand):
+            self.raw("GameState.DebugPrintEntityChoices", f"Entities[{i}]={self.ref(eid)}")
+        self.raw("GameState.SendChoices", f"id={self.choice_id} ChoiceType=MULLIGAN")
+        for i, eid in enumerate(hand):
+            self.raw("GameState.SendChoices", f"m_chosenEntities[{i}]={self.ref(eid)}")
+        self.choice_id += 1
+        self.tag(SYNTHETIC_PLAYERS[0], "MULLIGAN_STATE", "DEALING")
+        self.tag(SYNTHETIC_PLAYERS[0], "MULLIGAN_STATE", "WAITING")
+        self.tag(SYNTHETIC_PLAYERS[0], "MULLIGAN_STATE", "DONE")
+        self.tag(SYNTHETIC_PLAYERS[1], "MULLIGAN_STATE", "DONE")
+        self.tag("GameEntity", "STEP", "MAIN_READY")
+        self.flush_task_list()
+
+    def discover(self, player):
+        """发现：创建 3 张 SETASIDE 卡牌，发送 Choices，选中其中一张"""
+        options = []
+        self.power(f"BLOCK_START BlockType=POWER Entity={self.ref(1 + player * 2)} EffectCardId= EffectIndex=0 Target=0 SubOption=-1 ")
+        for _ in range(3):
+            eid = self.new_card(player, "SETASIDE", revealed=True)
+            options.append(eid)
+            self.power(f"FULL_ENTITY - Creating ID={eid} CardID={self.entities[eid]['card_id']}", 1)
+            self.stat_tags(eid, 2)
+        self.power("BLOCK_END")
+        self.raw("GameState.DebugPrintEntityChoices",
+                 f"id={self.choice_id} Player={SYNTHETIC_PLAYERS[player - 1]} TaskList=1 ChoiceType=GENERAL CountMin=1 CountMax=1")
+        self.raw("GameState.DebugPrintEntityChoices", f"Source={self.ref(1 + player * 2)}")
+        for i, eid in enumerate(options):
+            self.raw("GameState.DebugPrintEntityChoices", f"Entities[{i}]={self.ref(eid)}")
+        picked = self.rng.choice(options)
+        self.raw("GameState.SendChoices", f"id={self.choice_id} ChoiceType=GENERAL")
+        self.raw("GameState.SendChoices", f"m_chosenEntities[0]={self.ref(picked)}")
+        self.choice_id += 1
+        if len(self.zone_of(player, "HAND")) < 10:
+            self.move(picked, "HAND")
+            self.tag(picked, "ZONE", "HAND")
+            self.tag(picked, "ZONE_POSITION", self.entities[picked]["pos"])
+        self.flush_task_list()
+
+    def enchant(self, target, player):
+        """附魔实体：真实对局后期实体树中大部分是这类实体"""
+        eid = self.next_id
+        self.next_id += 1
+        card_id = self.rng.choice(SYNTHETIC_ENCHANTMENTS)
+        self.entities[eid] = dict(card_id=card_id, player=player, zone="PLAY", pos=0,
+                                  revealed=True, type="ENCHANTMENT")
+        self.power(f"FULL_ENTITY - Creating ID={eid} CardID={card_id}", 1)
+        for tag, value in [("CONTROLLER", player), ("CARDTYPE", "ENCHANTMENT"), ("ATTACHED", target),
+                           ("ZONE", "PLAY"), ("ENTITY_ID", eid)]:
+            self.power(f"tag={tag} value={value}", 2)
+
+    def deaths(self):
+        dead = [i for i, e in self.entities.items()
+                if e["zone"] == "PLAY" and e["type"] == "MINION" and e["damage"] >= e["health"]]
+        if not dead:
+            return
+        self.power("BLOCK_START BlockType=DEATHS Entity=GameEntity EffectCardId= EffectIndex=0 Target=0 SubOption=-1 ")
+        for eid in dead:
+            self.tag(eid, "ZONE", "GRAVEYARD")
+            self.move(eid, "GRAVEYARD")
+        self.power("BLOCK_END")
+
+    def damage(self, target, amount):
+        e = self.entities[target]
+        if e["type"] == "HERO":
+            self.hero_health[e["player"]] -= amount
+            self.tag(target, "DAMAGE", self.max_health - self.hero_health[e["player"]])
+        else:
+            e["damage"] += amount
+            self.tag(target, "DAMAGE", e["damage"])
+
+    def attack(self, eid, target):
+        """随从攻击随从或英雄 (死亡由 deaths 结算)"""
+        self.power(f"BLOCK_START BlockType=ATTACK Entity={self.ref(eid)} EffectCardId= EffectIndex=-1 Target={self.ref(target)} SubOption=-1 ")
+        self.tag("GameEntity", "PROPOSED_ATTACKER", eid)
+        self.tag("GameEntity", "PROPOSED_DEFENDER", target)
+        self.damage(target, self.entities[eid]["atk"])
+        if self.entities[target]["type"] == "MINION":
+            self.damage(eid, self.entities[target]["atk"])
+        self.tag(eid, "EXHAUSTED", 1)
+        self.tag(eid, "NUM_ATTACKS_THIS_TURN", 1)
+        self.power("BLOCK_END")
+
+    def play_turn(self, turn):
+        player = 1 if turn % 2 else 2
+        enemy = 3 - player
+        name = SYNTHETIC_PLAYERS[player - 1]
+        mana = min((turn + 1) // 2, 10)
+
+        self.tag("GameEntity", "TURN", turn)
+        self.tag(name, "CURRENT_PLAYER", 1)
+        self.tag(SYNTHETIC_PLAYERS[enemy - 1], "CURRENT_PLAYER", 0)
+        self.tag(name, "RESOURCES", mana)
+        self.tag(name, "RESOURCES_USED", 0)
+        self.tag("GameEntity", "STEP", "MAIN_START")
+        self.power(f"BLOCK_START BlockType=TRIGGER Entity={name} EffectCardId= EffectIndex=-1 Target=0 SubOption=-1 ")
+        for eid in self.zone_of(player, "PLAY"):
+            self.tag(eid, "EXHAUSTED", 0)
+        self.draw(player)
+        self.power("BLOCK_END")
+        self.tag("GameEntity", "STEP", "MAIN_ACTION")
+        self.flush_task_list()
+
+        if player == 1 and self.discover_every and (turn - 1) % self.discover_every == 0:
+            self.discover(player)
+
+        used = 0
+        for eid in list(self.zone_of(player, "HAND")):
+            e = self.entities[eid]
+            if e["cost"] > mana - used:
+                continue
+            if e["type"] == "MINION" and len(self.zone_of(player, "PLAY")) >= 7:
+                continue
+            used += e["cost"]
+            self.power(f"BLOCK_START BlockType=PLAY Entity={self.ref(eid)} EffectCardId= EffectIndex=0 Target=0 SubOption=-1 ")
+            self.tag(name, "RESOURCES_USED", used)
+            if not e["revealed"]:
+                e["revealed"] = True
+                self.power(f"SHOW_ENTITY - Updating Entity={self.ref(eid)} CardID={e['card_id']}", 1)
+                self.stat_tags(eid, 2)
+            if e["type"] == "MINION":
+                self.move(eid, "PLAY")
+                self.tag(eid, "ZONE", "PLAY")
+                self.tag(eid, "ZONE_POSITION", e["pos"])
+                if e["keyword"] != "CHARGE":
+                    self.tag(eid, "EXHAUSTED", 1)
+                if self.rng.random() < 0.5:
+                    self.enchant(eid, player)
+            else:
+                self.move(eid, "PLAY")
+                self.tag(eid, "ZONE", "PLAY")
+                targets = self.zone_of(enemy, "PLAY") + [1 + enemy * 2]
+                self.damage(self.rng.choice(targets), e["dmg"])
+                self.tag(eid, "ZONE", "GRAVEYARD")
+                self.move(eid, "GRAVEYARD")
+            self.power("BLOCK_END")
+            self.deaths()
+            self.flush_task_list()
+            if self.hero_health[enemy] <= 0:
+                return True
+
+        for eid in list(self.zone_of(player, "PLAY")):
+            e = self.entities[eid]
+            if e["zone"] != "PLAY" or e["atk"] <= 0:
+                continue
+            enemy_board = self.zone_of(enemy, "PLAY")
+            taunts = [i for i in enemy_board if self.entities[i]["keyword"] == "TAUNT"]
+            if taunts:
+                target = self.rng.choice(taunts)
+            elif enemy_board and self.rng.random() < 0.5:
+                target = self.rng.choice(enemy_board)
+            else:
+                target = 1 + enemy * 2
+            self.attack(eid, target)
+            self.deaths()
+            self.flush_task_list()
+            if self.hero_health[enemy] <= 0:
+                return True
+
+        self.tag("GameEntity", "STEP", "MAIN_END")
+        self.flush_task_list()
+        return False
+
+    def play(self):
+        self.create_game()
+        self.mulligan()
+        winner = None
+        for turn in range(1, self.max_turns + 1):
+            if self.play_turn(turn):
+                winner = 1 if turn % 2 else 2
+                break
+        if winner is None:
+            winner = 1 if self.hero_health[1] >= self.hero_health[2] else 2
+        self.tag(SYNTHETIC_PLAYERS[winner - 1], "PLAYSTATE", "WON")
+        self.tag(SYNTHETIC_PLAYERS[2 - winner], "PLAYSTATE", "LOST")
+        self.tag("GameEntity", "STEP", "FINAL_GAMEOVER")
+        self.tag("GameEntity", "STATE", "COMPLETE")
+        self.flush_task_list()
+        return self.lines
+
+
+def iter_synthetic_games(num_games=1, max_turns=30, seed=0, discover_every=5, hero_health=30):
+    """逐局生成 Power.log 文本，避免一次性在内存中拼出超大日志"""
+    rng = random.Random(seed)
+    clock = [datetime(2026, 1, 31, 0, 43, 47)]
+    for _ in range(num_games):
+        yield "".join(_SyntheticGame(rng, clock, max_turns, discover_every, hero_health).play())
+        # 对局之间的空闲时间
+        clock[0] += timedelta(seconds=rng.randint(10, 60))
+
+
+def generate_power_log(num_games=1, max_turns=30, seed=0, discover_every=5, hero_health=30):
+    """生成包含 num_games 局对局的 Power.log 文本"""
+    return "".join(iter_synthetic_games(num_games, max_turns, seed, discover_every, hero_health))
+
+
+def split_chunks(text, lines_per_chunk):
+    """按行数切分日志，模拟每次轮询读到的新增内容"""
+    lines = text.splitlines(keepends=True)
+    return ["".join(lines[i:i + lines_per_chunk]) for i in range(0, len(lines), lines_per_chunk)]
+
+
+# ---------------------------------------------------------------------------
+# 工具函数
+# ---------------------------------------------------------------------------
+
+_TRACKER = None
+
+
+def get_tracker():
+    """卡牌数据库加载较慢，所有基准共用一个 GameStateTracker"""
+    global _TRACKER
+    if _TRACKER is None:
+        from hearthstone_copilot import GameStateTracker
+        _TRACKER = GameStateTracker()
+    _TRACKER.reset()
+    return _TRACKER
+
+
+def rss_mb():
+    """当前进程常驻内存 (MB)，不支持的平台返回 None"""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / 1e6
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / 1e6
+    except ImportError:
+        return None
+
+
+def summarize(label, samples):
+    samples_ms = sorted(s * 1000 for s in samples)
+    p95 = samples_ms[min(len(samples_ms) - 1, int(len(samples_ms) * 0.95))]
+    print(f"    {label:<28} 总计 {sum(samples_ms):9.1f} ms | 平均 {statistics.mean(samples_ms):7.3f} ms"
+          f" | p95 {p95:7.3f} ms | 最大 {samples_ms[-1]:7.3f} ms")
+
+
+# ---------------------------------------------------------------------------
+# 基准
+# ---------------------------------------------------------------------------
+
+def legacy_process_log_chunk(tracker, buffer):
+    """旧实现：每次轮询都用新的 LogParser 重新解析整个累积缓冲区"""
+    from hslog import LogParser
+    from hslog.export import FriendlyPlayerExporter
+    parser = LogParser()
+    parser.read(StringIO(buffer))
+    if parser.games:
+        packet_tree = parser.games[-1]
+        tracker.game = packet_tree.export().game
+        result = FriendlyPlayerExporter(packet_tree).export()
+        if result:
+            tracker.friendly_player_id = result
+        legacy_extract_choices(tracker, packet_tree)
+        legacy_update_revealed_cache(tracker, packet_tree)
+
+
+def legacy_extract_choices(tracker, packet_tree):
+    """旧实现：每次轮询都从根递归遍历整棵 PacketTree 寻找最后一个 Choices"""
+    from hearthstone.enums import GameTag
+    tracker.current_choices = []
+    last_choice_packet = None
+    has_response = False
+    current_turn = 0
+    choice_turn = -1
+
+    def find_last_choice(packets, depth=0):
+        nonlocal last_choice_packet, has_response, current_turn, choice_turn
+        if depth > 50:
+            return
+        for packet in packets:
+            pkt_type = type(packet).__name__
+            if pkt_type == 'TagChange':
+                if packet.tag == GameTag.TURN and packet.entity == 1:
+                    current_turn = packet.value
+            if pkt_type == 'Choices':
+                last_choice_packet = packet
+                choice_turn = current_turn
+                has_response = False
+            elif pkt_type == 'SendChoices':
+                has_response = True
+            if hasattr(packet, 'packets'):
+                find_last_choice(packet.packets, depth + 1)
+
+    find_last_choice(packet_tree.packets)
+    if last_choice_packet and not has_response and choice_turn == current_turn:
+        for choice_id in getattr(last_choice_packet, 'choices', []):
+            entity = tracker._get_entity_by_id(choice_id)
+            if entity:
+                card_id = tracker._get_entity_name(entity)
+                card_name = "Unknown"
+                if card_id:
+                    card_name = tracker.get_card_data(card_id).get("name", card_id)
+                tracker.current_choices.append({"id": choice_id, "card_id": card_id, "name": card_name})
+
+
+def legacy_update_revealed_cache(tracker, packet_tree):
+    """旧实现：每次轮询都从根递归遍历整棵 PacketTree 记录 CardID"""
+    def visit_packets(packets, depth=0):
+        if depth > 50:
+            return
+        for packet in packets:
+            pkt_type = type(packet).__name__
+            if pkt_type in ['FullEntity', 'ShowEntity']:
+                if hasattr(packet, 'card_id') and packet.card_id:
+                    tracker._revealed_cards[packet.entity] = packet.card_id
+            if hasattr(packet, 'packets'):
+                visit_packets(packet.packets, depth + 1)
+
+    visit_packets(packet_tree.packets)
+
+
+def legacy_update_from_parser(tracker):
+    """旧的解析后阶段：增量导出之后再做两次整树遍历"""
+    from hearthstone_copilot import IncrementalEntityTreeExporter
+    if tracker.parser.games:
+        packet_tree = tracker.parser.games[-1]
+        if tracker._exporter is None or tracker._exporter.packet_tree is not packet_tree:
+            tracker._exporter = IncrementalEntityTreeExporter(packet_tree)
+        tracker._exporter.advance()
+        tracker.game = tracker._exporter.game
+        if tracker._exporter.friendly_player:
+            tracker.friendly_player_id = tracker._exporter.friendly_player
+        legacy_extract_choices(tracker, packet_tree)
+        legacy_update_revealed_cache(tracker, packet_tree)
+        if not tracker.initial_deck:
+            current_deck = tracker.get_my_deck(include_details=True)
+            if len(current_deck) > 20:
+                tracker.initial_deck = current_deck
+
+
+def bench_parse(args):
+    """增量解析 vs 每次全量重解析"""
+    log = generate_power_log(num_games=args.games, seed=args.seed)
+    chunks = split_chunks(log, args.chunk_lines)
+    print(f"[*] 合成日志: {args.games} 局, {log.count(chr(10))} 行, {len(log) / 1e6:.1f} MB, {len(chunks)} 个块")
+
+    tracker = get_tracker()
+    incremental = []
+    for chunk in chunks:
+        t0 = time.perf_counter()
+        tracker.process_log_chunk(chunk)
+        incremental.append(time.perf_counter() - t0)
+    final_entities = {e.id: dict(e.tags) for e in tracker.game.entities}
+
+    tracker = get_tracker()
+    legacy = []
+    buffer = ""
+    for chunk in chunks:
+        buffer += chunk
+        t0 = time.perf_counter()
+        legacy_process_log_chunk(tracker, buffer)
+        legacy.append(time.perf_counter() - t0)
+    assert {e.id: dict(e.tags) for e in tracker.game.entities} == final_entities, "增量解析结果与全量解析不一致"
+
+    summarize("增量解析 (每块)", incremental)
+    summarize("全量重解析 (每块)", legacy)
+    tail = max(1, len(chunks) // 10)
+    print(f"    最后 10% 的块平均: 增量 {statistics.mean(incremental[-tail:]) * 1000:.3f} ms"
+          f" vs 全量 {statistics.mean(legacy[-tail:]) * 1000:.3f} ms")
+    print(f"    总加速比: {sum(legacy) / sum(incremental):.1f}x")
+
+
+def bench_memory(args):
+    """长时间会话 (50 局) 的内存与轮询延迟是否保持平稳"""
+    import gc
+    num_games = max(args.games, 50)
+    tracker = get_tracker()
+    per_game = []
+    print(f"    {'对局':>4} {'RSS(MB)':>9} {'平均轮询(ms)':>13} {'实体数':>6} {'解析器对局数':>12}")
+    for i, game_log in enumerate(iter_synthetic_games(num_games, seed=args.seed), 1):
+        samples = []
+        for chunk in split_chunks(game_log, args.chunk_lines):
+            t0 = time.perf_counter()
+            tracker.process_log_chunk(chunk)
+            samples.append(time.perf_counter() - t0)
+        gc.collect()
+        rss = rss_mb()
+        entities = len(list(tracker.game.entities)) if tracker.game else 0
+        per_game.append((rss, statistics.mean(samples) * 1000))
+        if i == 1 or i % 5 == 0:
+            rss_text = f"{rss:9.1f}" if rss is not None else f"{'n/a':>9}"
+            print(f"    {i:>4} {rss_text} {per_game[-1][1]:13.3f} {entities:>6} {len(tracker.parser.games):>12}")
+
+    head, tail = per_game[1:6], per_game[-5:]
+    print(f"    已丢弃对局: {tracker.games_finished}")
+    print(f"    平均轮询: 前 5 局 {statistics.mean(p for _, p in head):.3f} ms"
+          f" -> 后 5 局 {statistics.mean(p for _, p in tail):.3f} ms")
+    if head[0][0] is not None:
+        growth = statistics.mean(r for r, _ in tail) - statistics.mean(r for r, _ in head)
+        print(f"    RSS 增长: {growth:+.1f} MB (前 5 局 -> 后 5 局)")
+
+
+def write_log_file(path, size_mb, seed=0):
+    """写出约 size_mb 大小的多局 Power.log (重复若干基础对局，最后追加一局不同的对局)"""
+    base = generate_power_log(num_games=5, seed=seed)
+    last = generate_power_log(num_games=1, seed=seed + 1)
+    target = int(size_mb * 1e6) - len(last)
+    written = 0
+    with open(path, "w", encoding="utf-8") as f:
+        while written < target:
+            f.write(base)
+            written += len(base)
+        f.write(last)
+
+
+def bench_startup(args):
+    """启动到首个可用状态的延迟：快速定位最后一局 vs 从头重放"""
+    import tempfile
+    from hearthstone_copilot import find_last_game_offset
+
+    def first_state(path, offset):
+        tracker = get_tracker()
+        t0 = time.perf_counter()
+        with open(path, "r", encoding="utf-8", errors="ignore") as f:
+            f.seek(offset)
+            # 与 get_game_state 相同：按块读取直到文件末尾
+            while True:
+                chunk = f.read(1 << 20)
+                if not chunk:
+                    break
+                tracker.process_log_chunk(chunk)
+        tracker.get_my_hand()
+        return time.perf_counter() - t0, tracker
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for size_mb in args.log_sizes:
+            path = os.path.join(tmp, f"Power_{size_mb}MB.log")
+            write_log_file(path, size_mb, seed=args.seed)
+            t0 = time.perf_counter()
+            offset = find_last_game_offset(path)
+            seek_time = time.perf_counter() - t0
+            fast_time, fast = first_state(path, offset)
+            print(f"    {size_mb:>4} MB 日志: 定位最后一局 {seek_time * 1000:7.2f} ms"
+                  f" + 解析 {fast_time * 1000:8.1f} ms (起始偏移 {offset})")
+            if not args.skip_full_replay:
+                full_time, full = first_state(path, 0)
+                assert full.get_my_hand() == fast.get_my_hand(), "快速启动结果与完整重放不一致"
+                print(f"    {'':>4}    从头重放     {full_time * 1000:8.1f} ms"
+                      f" ({full_time / (seek_time + fast_time):.0f}x 慢)")
+
+
+def bench_tail(args):
+    """日志写入到决策循环被唤醒的延迟 (inotify / 自适应轮询 / 旧的 1 秒轮询)，以及截断/轮换处理"""
+    import tempfile
+    import threading
+    from hearthstone_copilot import LogTailer
+
+    line = "D 00:00:00.0000000 PowerTaskList.DebugPrintPower() - TAG_CHANGE Entity=GameEntity tag=STEP value=MAIN_END \n"
+    events = 20
+
+    def writer(path, stamps):
+        rng = random.Random(args.seed)
+        for _ in range(events):
+            time.sleep(rng.uniform(0.05, 0.3))
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(line)
+                f.flush()
+                stamps.append(time.perf_counter())
+
+    def legacy_loop(path, deadline, seen):
+        # 旧实现：每秒重新打开文件 readlines()
+        last_tell = 0
+        while time.perf_counter() < deadline:
+            with open(path, "r", encoding="utf-8") as f:
+                f.seek(last_tell)
+                new_lines = f.readlines()
+                last_tell = f.tell()
+            seen.extend([time.perf_counter()] * len(new_lines))
+            time.sleep(1)
+
+    def tailer_loop(tailer, deadline, seen):
+        while time.perf_counter() < deadline:
+            text = tailer.read()
+            if text:
+                seen.extend([time.perf_counter()] * text.count("\n"))
+            else:
+                tailer.wait(1.0)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode in ("inotify", "poll", "legacy"):
+            path = os.path.join(tmp, f"Power_{mode}.log")
+            open(path, "w").close()
+            stamps, seen = [], []
+            t = threading.Thread(target=writer, args=(path, stamps))
+            deadline = time.perf_counter() + events * 0.3 + 2.5
+            t.start()
+            if mode == "legacy":
+                legacy_loop(path, deadline, seen)
+            else:
+                tailer = LogTailer(path, use_inotify=(mode == "inotify"))
+                label = tailer.backend
+                tailer_loop(tailer, deadline, seen)
+                tailer.close()
+            t.join()
+            latencies = [b - a for a, b in zip(stamps, seen)]
+            summarize(f"唤醒延迟 ({label if mode != 'legacy' else '旧 1 秒轮询'})", latencies)
+
+        # 截断 / 轮换
+        path = os.path.join(tmp, "Power.log")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(line * 10)
+        resets = []
+        tailer = LogTailer(path, on_reset=lambda: resets.append(True))
+        assert tailer.read().count("\n") == 10
+        with open(path, "w", encoding="utf-8") as f:  # 客户端重启：原地截断
+            f.write(line * 2)
+        assert tailer.read().count("\n") == 2 and len(resets) == 1, "截断未被检测到"
+        with open(path, "a", encoding="utf-8") as f:  # 旧文件在被替换前又写入了几行
+            f.write(line * 4)
+        with open(path + ".new", "w", encoding="utf-8") as f:
+            f.write(line * 3)
+        os.replace(path + ".new", path)  # 文件被替换 (轮换)
+        assert tailer.read().count("\n") == 4 and len(resets) == 1, "轮换前旧文件末尾的内容丢失"
+        assert tailer.read().count("\n") == 3 and len(resets) == 2, "轮换未被检测到"
+        tailer.close()
+        print("    截断 / 轮换检测: OK")
+
+
+def load_late_game(args, max_turns=60):
+    """解析一局很长的对局 (英雄血量调高)，返回停在最后一回合的 tracker"""
+    log = generate_power_log(num_games=1, max_turns=max_turns, seed=args.seed,
+                             discover_every=1, hero_health=1000)
+    # 去掉结算行，保持对局进行中
+    log = log[:log.rindex("tag=PLAYSTATE")]
+    log = log[:log.rindex("\n") + 1]
+    tracker = get_tracker()
+    for chunk in split_chunks(log, 500):
+        tracker.process_log_chunk(chunk)
+    return tracker
+
+
+def legacy_snapshot(tracker):
+    """旧实现的取数方式：每个访问器都遍历 player.entities"""
+    from hearthstone.enums import GameTag, Zone, CardType
+    game = tracker.game
+    pid = tracker.friendly_player_id
+    result = {}
+    for key, player_id, zone, cardtype in (("hand", pid, Zone.HAND, None),
+                                           ("my_board", pid, Zone.PLAY, CardType.MINION),
+                                           ("opp_board", 3 - pid, Zone.PLAY, CardType.MINION),
+                                           ("my_hero", pid, Zone.PLAY, CardType.HERO),
+                                           ("enemy_hero", 3 - pid, Zone.PLAY, CardType.HERO)):
+        player = game.players[player_id - 1]
+        found = [e for e in player.entities if e.tags.get(GameTag.ZONE) == zone
+                 and (cardtype is None or e.tags.get(GameTag.CARDTYPE) == cardtype)]
+        found.sort(key=lambda x: x.tags.get(GameTag.ZONE_POSITION, 0))
+        result[key] = [(e.card_id, e.tags.get(GameTag.ATK, 0), e.tags.get(GameTag.HEALTH, 0)) for e in found]
+    player = game.players[pid - 1]
+    result["deck"] = len([e for e in player.entities if e.tags.get(GameTag.ZONE) == Zone.DECK])
+    return result
+
+
+def indexed_snapshot(tracker):
+    from hearthstone.enums import GameTag, Zone, CardType
+    pid = tracker.friendly_player_id
+    result = {}
+    for key, player_id, zone, cardtype in (("hand", pid, Zone.HAND, None),
+                                           ("my_board", pid, Zone.PLAY, CardType.MINION),
+                                           ("opp_board", 3 - pid, Zone.PLAY, CardType.MINION),
+                                           ("my_hero", pid, Zone.PLAY, CardType.HERO),
+                                           ("enemy_hero", 3 - pid, Zone.PLAY, CardType.HERO)):
+        found = tracker._zone_entities(player_id, zone, cardtype)
+        result[key] = [(e.card_id, e.tags.get(GameTag.ATK, 0), e.tags.get(GameTag.HEALTH, 0)) for e in found]
+    result["deck"] = len(tracker._exporter.entities_in(pid, Zone.DECK))
+    return result
+
+
+def time_per_call(func, repeat):
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - t0) / repeat
+
+
+def bench_snapshot(args):
+    """后期实体树上构建状态快照：区域索引 vs 全量扫描"""
+    tracker = load_late_game(args)
+    entities = len(list(tracker.game.entities))
+    assert indexed_snapshot(tracker) == legacy_snapshot(tracker), "区域索引结果与全量扫描不一致"
+    print(f"[*] 后期对局: 回合 {tracker.get_turn()}, 实体 {entities} 个")
+
+    repeat = 200
+    scan = time_per_call(lambda: legacy_snapshot(tracker), repeat)
+    indexed = time_per_call(lambda: indexed_snapshot(tracker), repeat)
+    print(f"    实体查询 (全量扫描)           {scan * 1e6:9.1f} us/次")
+    print(f"    实体查询 (区域索引)           {indexed * 1e6:9.1f} us/次  ({scan / indexed:.0f}x)")
+
+    def full_snapshot():
+        pid = tracker.friendly_player_id
+        tracker.get_my_hand()
+        tracker.get_my_board()
+        tracker.get_opp_board()
+        tracker.get_hero_state(pid)
+        tracker.get_hero_state(3 - pid)
+        tracker.get_my_deck()
+    print(f"    完整快照 (get_my_hand ... get_my_deck) {time_per_call(full_snapshot, repeat) * 1e6:9.1f} us/次")
+
+
+def legacy_get_card_data(tracker, card_id, spell_damage=0):
+    """旧实现：每次调用都重新链式 replace 描述文本并构造新字典"""
+    if not card_id:
+        return {"name": "Unknown", "text": ""}
+    card = tracker.card_db.get(card_id)
+    if card:
+        description = card.description or ""
+        description = description.replace("<b>", "").replace("</b>", "")
+        description = description.replace("<i>", "").replace("</i>", "")
+        description = description.replace("$", "")
+        description = description.replace("[x]", "")
+        description = description.replace("\\n", "")
+        return {"name": card.name, "text": description, "cost": card.cost, "type": card.type}
+    return {"name": card_id, "text": ""}
+
+
+def bench_cardtext(args):
+    """卡牌文本缓存：快照中的 get_card_data 调用 (预编译正则 + 记忆化 vs 链式 replace)"""
+    tracker = load_late_game(args)
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.json"), encoding="utf-8") as f:
+        deck_code = json.load(f).get("DECK_CODE")
+    if deck_code:
+        tracker.apply_deck_code(deck_code)
+
+    def snapshot():
+        tracker.get_my_hand()
+        tracker.get_my_deck()
+
+    repeat = 200
+    cached_get = tracker.get_card_data
+    tracker._card_data_cache.clear()
+    cold = time_per_call(snapshot, 1)
+    cached = time_per_call(snapshot, repeat)
+    tracker.get_card_data = lambda card_id, spell_damage=0: legacy_get_card_data(tracker, card_id, spell_damage)
+    try:
+        legacy = time_per_call(snapshot, repeat)
+    finally:
+        del tracker.get_card_data
+    assert tracker.get_card_data == cached_get
+
+    print(f"[*] 手牌 {len(tracker.get_my_hand())} 张, 套牌 {len(tracker.deck_code_list)} 张, 缓存 {len(tracker._card_data_cache)} 项")
+    print(f"    快照 (链式 replace)           {legacy * 1e6:9.1f} us/次")
+    print(f"    快照 (缓存, 首次)             {cold * 1e6:9.1f} us/次")
+    print(f"    快照 (缓存)                   {cached * 1e6:9.1f} us/次  ({legacy / cached:.1f}x)")
+
+    ids = [cid for cid, card in tracker.card_db.items() if card.description][:5000]
+    legacy_all = time_per_call(lambda: [legacy_get_card_data(tracker, cid) for cid in ids], 3)
+    tracker._card_data_cache.clear()
+    cold_all = time_per_call(lambda: [tracker.get_card_data(cid) for cid in ids], 1)
+    warm_all = time_per_call(lambda: [tracker.get_card_data(cid) for cid in ids], 3)
+    per = 1e6 / len(ids)
+    print(f"    单卡 (链式 replace)           {legacy_all * per:9.2f} us/次")
+    print(f"    单卡 (正则, 未命中缓存)       {cold_all * per:9.2f} us/次")
+    print(f"    单卡 (命中缓存)               {warm_all * per:9.2f} us/次")
+
+
+STARTUP_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+from hearthstone_copilot import GameStateTracker
+imported = time.perf_counter()
+GameStateTracker(card_cache_dir=sys.argv[1])
+done = time.perf_counter()
+print(f"RESULT {imported - start} {done - imported}")
+"""
+
+
+def measure_tracker_startup(cache_dir):
+    """在新进程中构造 GameStateTracker，返回 (导入耗时, 构造耗时, 进程总耗时)"""
+    start = time.perf_counter()
+    out = subprocess.run(
+        [sys.executable, "-c", STARTUP_SCRIPT, cache_dir],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True, text=True, check=True,
+    ).stdout
+    wall = time.perf_counter() - start
+    line = next(l for l in out.splitlines() if l.startswith("RESULT"))
+    imported, built = map(float, line.split()[1:])
+    return imported, built, wall
+
+
+def bench_cardcache(args):
+    """卡牌数据库磁盘缓存：冷启动 (解析 CardDefs.xml) vs 热启动 (读取缓存)"""
+    import tempfile
+    from hearthstone_copilot import CARD_CACHE_HEADER, load_card_db
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "cards_zhCN.bin")
+        print(f"    {'':<28}{'导入':>10}{'构造 tracker':>14}{'进程总计':>12}")
+
+        def report(label, result):
+            imported, built, wall = result
+            print(f"    {label:<28}{imported:9.2f}s{built:13.2f}s{wall:11.2f}s")
+
+        report("冷启动 (无缓存)", measure_tracker_startup(tmp))
+        print(f"[*] 缓存文件 {os.path.getsize(path) / 1e6:.1f} MB")
+        for i in range(3):
+            report(f"热启动 #{i + 1}", measure_tracker_startup(tmp))
+
+        # 缓存键不匹配 (模拟 hearthstone 升级) 时应自动重建
+        with open(path, "r+b") as f:
+            f.seek(CARD_CACHE_HEADER.size)
+            f.write(b"0")
+        report("缓存过期 (自动重建)", measure_tracker_startup(tmp))
+        report("重建后热启动", measure_tracker_startup(tmp))
+
+        # 损坏的缓存不能导致崩溃
+        with open(path, "r+b") as f:
+            f.truncate(os.path.getsize(path) // 2)
+        report("缓存损坏 (自动重建)", measure_tracker_startup(tmp))
+
+        cached = load_card_db(cache_dir=tmp)
+        fresh = load_card_db(cache_dir=None)
+        assert cached.keys() == fresh.keys(), "缓存的卡牌集合与 CardDefs.xml 不一致"
+        assert all(cached[k].to_row() == fresh[k].to_row() for k in fresh), "缓存的卡牌字段与 CardDefs.xml 不一致"
+        print(f"[*] 缓存内容与 CardDefs.xml 一致: {len(fresh)} 张卡牌")
+
+
+def timed_post_parse(tracker, chunks, update):
+    """逐块喂日志，只对解析后阶段 (导出 + 派生状态) 计时；每块之后记录选择项/已揭示卡牌"""
+    samples, states = [], []
+    original = tracker._update_from_parser
+
+    def timed():
+        start = time.perf_counter()
+        update()
+        samples.append(time.perf_counter() - start)
+
+    tracker._update_from_parser = timed
+    try:
+        for chunk in chunks:
+            tracker.process_log_chunk(chunk)
+            states.append((tracker.current_choices, dict(tracker._revealed_cards)))
+    finally:
+        del tracker._update_from_parser
+    assert tracker._update_from_parser == original
+    return samples, states
+
+
+def bench_postparse(args):
+    """解析后阶段：单次增量访问新 packet vs 两次整树遍历 (后期对局)"""
+    log = generate_power_log(num_games=1, max_turns=60, seed=args.seed, discover_every=1, hero_health=1000)
+    log = log[:log.rindex("tag=PLAYSTATE")]
+    log = log[:log.rindex("\n") + 1]
+    # 小块轮询：经常停在 Choices 之后 (等待玩家选择的时刻)
+    chunks = split_chunks(log, 7)
+
+    tracker = get_tracker()
+    new_samples, new_states = timed_post_parse(tracker, chunks, tracker._update_from_parser)
+    tracker.reset()
+    legacy_samples, legacy_states = timed_post_parse(tracker, chunks, lambda: legacy_update_from_parser(tracker))
+
+    assert new_states == legacy_states, "单次访问的结果与整树遍历不一致"
+    pending = sum(1 for choices, _ in new_states if choices)
+    print(f"[*] {len(chunks)} 次轮询 (每次 7 行)，其中 {pending} 次存在未处理的 Choices，结果逐次一致")
+
+    tail = len(chunks) // 10  # 最后 10% 的轮询：实体树/packet 树最大
+    summarize("整树遍历 (全部)", legacy_samples)
+    summarize("单次访问 (全部)", new_samples)
+    summarize("整树遍历 (最后 10%)", legacy_samples[-tail:])
+    summarize("单次访问 (最后 10%)", new_samples[-tail:])
+
+
+def legacy_get_my_deck(tracker, include_details=False):
+    """旧实现 (有套牌代码时)：按显示名称匹配，deepcopy + list.remove"""
+    from copy import deepcopy
+    from hearthstone.enums import GameTag, Zone
+    full_list_names = [item.split(":")[0] if ":" in item else item for item in tracker.deck_code_list]
+    drawn_cards = []
+    for e in tracker._exporter.controlled_by(tracker.friendly_player_id):
+        if e.tags.get(GameTag.ZONE) != Zone.DECK:
+            card_id = e.card_id or tracker._revealed_cards.get(e.id)
+            if card_id:
+                drawn_cards.append(tracker.get_card_data(card_id)["name"])
+    remaining_names = deepcopy(full_list_names)
+    for card in drawn_cards:
+        if card in remaining_names:
+            remaining_names.remove(card)
+    if include_details:
+        final_deck = []
+        temp_remaining = deepcopy(remaining_names)
+        for item in tracker.deck_code_list:
+            name = item.split(":")[0] if ":" in item else item
+            if name in temp_remaining:
+                final_deck.append(item)
+                temp_remaining.remove(name)
+        return final_deck
+    counts = Counter(remaining_names)
+    return [f"{name} x{count}" for name, count in sorted(counts.items())]
+
+
+def bench_deck(args):
+    """牌库推理：按 card_id 增量计数 vs 按名称 deepcopy + list.remove"""
+    from hearthstone.deckstrings import write_deckstring
+    from hearthstone.enums import FormatType
+
+    rng = random.Random(args.seed)
+    game = _SyntheticGame(rng, [datetime(2026, 1, 31, 0, 43, 47)], 24, 1, 1000)
+    log = "".join(game.play())
+    log = log[:log.rindex("tag=PLAYSTATE")]
+    log = log[:log.rindex("\n") + 1]
+    # 友方套牌: 开局时 player 1 的 30 张牌库实体 (ID 6..35)
+    deck_ids = range(6, 36)
+    deck = Counter(game.entities[i]["card_id"] for i in deck_ids)
+    truth = Counter(game.entities[i]["card_id"] for i in deck_ids if game.entities[i]["zone"] == "DECK")
+
+    tracker = get_tracker()
+    db = tracker.card_db
+    deck_code = write_deckstring([(db[cid].dbf_id, n) for cid, n in deck.items()],
+                                 [db[SYNTHETIC_HEROES[0]].dbf_id], FormatType.FT_WILD)
+    tracker.apply_deck_code(deck_code)
+    polls = split_chunks(log, args.chunk_lines)
+    for chunk in polls:
+        tracker.process_log_chunk(chunk)
+
+    def deck_names(cards):
+        names = Counter()
+        for cid, n in cards.items():
+            names[tracker.get_card_data(cid)["name"]] += n
+        return [f"{name} x{n}" for name, n in sorted(names.items())]
+
+    expected = deck_names(truth)
+    assert tracker.get_my_deck() == expected, "牌库推理与实际剩余牌库不一致"
+    assert len(tracker.get_my_deck(include_details=True)) == sum(truth.values())
+
+    # 对局中洗入一张仍在牌库中的卡的复制，再抽到这张复制：原卡的剩余张数不变
+    source = next(i for i in deck_ids if game.entities[i]["zone"] == "DECK")
+    written = len(game.lines)
+    copy = game.new_card(1, "DECK", revealed=True)
+    game.entities[copy].update({key: game.entities[source][key]
+                                for key in ("card_id", "type", "cost", "atk", "health", "keyword", "dmg")
+                                if key in game.entities[source]})
+    game.power(f"BLOCK_START BlockType=POWER Entity={game.ref(3)} EffectCardId= EffectIndex=0 Target=0 SubOption=-1 ")
+    game.power(f"FULL_ENTITY - Creating ID={copy} CardID={game.entities[copy]['card_id']}", 1)
+    game.stat_tags(copy, 2)
+    game.power("BLOCK_END")
+    game.flush_task_list()
+    tracker.process_log_chunk("".join(game.lines[written:]))
+    shuffled = truth + Counter([game.entities[copy]["card_id"]])
+    assert tracker.get_my_deck() == deck_names(shuffled), "洗入的复制没有计入剩余牌库"
+    assert len(tracker.get_my_deck(include_details=True)) == sum(shuffled.values())
+    written = len(game.lines)
+    game.move(copy, "HAND")
+    game.tag(copy, "ZONE", "HAND")
+    game.tag(copy, "ZONE_POSITION", game.entities[copy]["pos"])
+    game.flush_task_list()
+    tracker.process_log_chunk("".join(game.lines[written:]))
+    assert tracker.get_my_deck() == expected, "抽到洗入的复制后，原卡的剩余张数被错误扣减"
+    assert len(tracker.get_my_deck(include_details=True)) == sum(truth.values())
+    legacy = legacy_get_my_deck(tracker)
+    generated = sum(1 for e in game.entities.values() if e["player"] == 1 and e["zone"] != "DECK") \
+        - sum(1 for i in deck_ids if game.entities[i]["zone"] != "DECK")
+    print(f"[*] 回合 {tracker.get_turn()}: 剩余牌库 {sum(truth.values())} 张，与生成器一致"
+          "  (洗入一张复制再抽到后仍一致)")
+    print(f"    旧实现按名称匹配: {'一致' if legacy == expected else '不一致'}"
+          f" (对局中另外生成了 {generated} 张同名卡牌/附魔)")
+
+    repeat = 500
+    for label, details in (("名称列表", False), ("带描述", True)):
+        old = time_per_call(lambda: legacy_get_my_deck(tracker, details), repeat)
+        new = time_per_call(lambda: tracker.get_my_deck(details), repeat)
+        print(f"    get_my_deck ({label}) 旧 {old * 1e6:8.1f} us  新 {new * 1e6:8.1f} us  ({old / new:.0f}x)")
+
+
+class StubLLMServer:
+    """本地 OpenAI 兼容桩服务器：统计 TCP 连接数，并模拟握手延迟和模型生成时间
+
+    请求带 "stream": true 时按 SSE 输出 (每 chunk_delay 秒输出 chunk_chars 个字符)；
+    否则等待同样的生成时间后一次性返回。prefill_per_token > 0 时按输入消息的估算 token 数额外等待 (模拟预填充)。
+    status != 200 时返回错误；slow_every > 0 时每 slow_every 个请求额外等待 slow_delay 秒 (模拟长尾延迟)。
+    """
+
+    def __init__(self, handshake_delay=0.05, think_delay=0.02, reply=None, chunk_chars=4, chunk_delay=0.0,
+                 prefill_per_token=0.0, status=200, slow_every=0, slow_delay=0.0):
+        import http.server
+        import threading
+        from hearthstone_copilot import estimate_tokens
+        stub = self
+        self.connections = 0
+        self.requests = 0
+        self.prompt_tokens = 0  # 最近一次请求的输入 token 数 (估算)
+        self.reply = reply or {"thought": "stub", "actions": [{"type": "END_TURN", "desc": "End Turn"}]}
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # 支持 keep-alive
+            disable_nagle_algorithm = True  # 响应头和响应体分两次写出，避免 Nagle + 延迟 ACK 的 40 ms 停顿
+
+            def setup(self):
+                # 每个 Handler 实例对应一条 TCP 连接；在这里模拟 TCP/TLS 握手耗时
+                super().setup()
+                stub.connections += 1
+                time.sleep(handshake_delay)
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                stub.requests += 1
+                stub.prompt_tokens = sum(estimate_tokens(m.get("content", "")) for m in request.get("messages", []))
+                time.sleep(think_delay + prefill_per_token * stub.prompt_tokens)
+                if slow_every and stub.requests % slow_every == 0:
+                    time.sleep(slow_delay)
+                if status != 200:
+                    body = b'{"error": "stub failure"}'
+                    self.send_response(status)
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                    return
+                content = stub.reply if isinstance(stub.reply, str) else json.dumps(stub.reply, ensure_ascii=False)
+                pieces = [content[i:i + chunk_chars] for i in range(0, len(content), chunk_chars)]
+                if request.get("stream"):
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/event-stream")
+                    self.send_header("Transfer-Encoding", "chunked")
+                    self.end_headers()
+                    try:
+                        for piece in pieces:
+                            self.write_event(json.dumps({"choices": [{"delta": {"content": piece}}]}))
+                            time.sleep(chunk_delay)
+                        self.write_event("[DONE]")
+                        self.wfile.write(b"0\r\n\r\n")
+                    except (BrokenPipeError, ConnectionResetError):
+                        self.close_connection = True  # 客户端取消了流 (竞速落败)
+                    return
+                time.sleep(chunk_delay * len(pieces))
+                body = json.dumps({"choices": [{"message": {"content": content}}]}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def write_event(self, data):
+                event = f"data: {data}\n\n".encode()
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(event), event))
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/v1"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def bench_llm(args):
+    """模型请求：复用 Session (keep-alive) vs 每次 requests.post 新建连接 (本地桩服务器)"""
+    import contextlib
+    import io
+    import requests
+    from hearthstone_copilot import LLMClient
+
+    calls = 20
+    handshake = 0.05
+    messages = [{"role": "user", "content": "state"}]
+
+    stub = StubLLMServer(handshake_delay=handshake)
+    try:
+        start = time.perf_counter()
+        for _ in range(calls):
+            response = requests.post(f"{stub.url}/chat/completions", json={"model": "m", "messages": messages},
+                                     headers={"Authorization": "Bearer x"}, timeout=30)
+            json.loads(response.json()["choices"][0]["message"]["content"])
+        legacy = time.perf_counter() - start
+        legacy_connections = stub.connections
+    finally:
+        stub.close()
+
+    stub = StubLLMServer(handshake_delay=handshake)
+    client = LLMClient(stub.url, "x")
+    timings = []
+    try:
+        start = time.perf_counter()
+        for _ in range(calls):
+            timing = {}
+            with contextlib.redirect_stdout(io.StringIO()):
+                content = client.chat("m", messages, timing=timing)
+            json.loads(content)
+            timings.append(timing)
+        pooled = time.perf_counter() - start
+    finally:
+        client.close()
+        stub.close()
+
+    assert stub.connections == 1 and client.connections == 1, f"Session 应只建立 1 条连接，实际 {stub.connections}"
+    assert stub.requests == calls
+    print(f"[*] {calls} 次请求，模拟握手 {handshake * 1000:.0f} ms (在服务端 accept 之后等待，因此计入首字节而不是连接阶段)")
+    print(f"    requests.post (旧)   连接 {legacy_connections:3d} 条 | 平均 {legacy / calls * 1000:6.1f} ms/次")
+    print(f"    LLMClient (Session)  连接 {stub.connections:3d} 条 | 平均 {pooled / calls * 1000:6.1f} ms/次")
+    first, rest = timings[0], timings[1:]
+    print(f"    首次请求: 连接 {first['connect'] * 1000:5.1f} ms | 首字节 {first['ttfb'] * 1000:5.1f} ms"
+          f" | 总计 {first['total'] * 1000:5.1f} ms")
+    print(f"    后续请求: 连接 {statistics.mean(t['connect'] for t in rest) * 1000:5.1f} ms"
+          f" | 首字节 {statistics.mean(t['ttfb'] for t in rest) * 1000:5.1f} ms"
+          f" | 总计 {statistics.mean(t['total'] for t in rest) * 1000:5.1f} ms (平均)")
+
+
+STREAM_PLAN = {
+    "thought": "对手场面较弱，先用低费随从铺场，再用法术解掉嘲讽，最后随从打脸。",
+    "actions": [
+        {"type": "PLAY_MINION", "hand_index": 0, "desc": "打出 {鱼人袭击者}"},
+        {"type": "PLAY_TARGET", "hand_index": 1, "target_type": "minion", "target_index": 0,
+         "desc": "寒冰箭 -> 敌方 \"嘲讽\" 随从 [0]"},
+        {"type": "ATTACK", "attacker_index": 0, "target_type": "enemy_hero", "desc": "随从 0 打脸"},
+        {"type": "ATTACK", "attacker_index": 1, "target_type": "enemy_hero", "desc": "随从 1 打脸"},
+        {"type": "HERO_POWER", "desc": "使用英雄技能"},
+        {"type": "END_TURN", "desc": "结束回合"},
+    ],
+}
+
+
+def bench_stream(args):
+    """流式决策：收到第一个完整操作即执行 vs 等待完整 JSON (本地 SSE 桩服务器)"""
+    import contextlib
+    import io
+    from hearthstone_copilot import ActionStreamParser, LLMClient
+
+    # 解析器正确性：逐字符喂入，包含 Markdown 代码块、字符串中的括号/引号
+    content = "```json\n" + json.dumps(STREAM_PLAN, ensure_ascii=False, indent=2) + "\n```"
+    parser = ActionStreamParser()
+    parsed = [action for ch in content for action in parser.feed(ch)]
+    assert parsed == STREAM_PLAN["actions"], "流式解析的操作与完整 JSON 不一致"
+    assert parser.thought == STREAM_PLAN["thought"] and parser.result() == STREAM_PLAN
+
+    execute_time = 0.1  # 模拟每个鼠标操作的耗时
+    messages = [{"role": "user", "content": "state"}]
+    stub = StubLLMServer(handshake_delay=0, think_delay=0.3, reply=content, chunk_chars=4, chunk_delay=0.005)
+    client = LLMClient(stub.url, "x")
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            client.chat("m", messages)  # 预热连接，两种方式都复用同一条连接
+
+            # 旧流程：等待完整输出 -> json.loads -> 依次执行
+            start = time.perf_counter()
+            text = client.chat("m", messages)
+            plan = json.loads(text.replace("```json", "").replace("```", "").strip())
+            old_first = time.perf_counter() - start
+            for _ in plan["actions"]:
+                time.sleep(execute_time)
+            old_total = time.perf_counter() - start
+
+            # 流式：每解析出一个完整操作立即执行
+            start = time.perf_counter()
+            parser = ActionStreamParser()
+            new_first = None
+            executed = []
+            timing = {}
+            for delta in client.chat_stream("m", messages, timing=timing):
+                for action in parser.feed(delta):
+                    if new_first is None:
+                        new_first = time.perf_counter() - start
+                    time.sleep(execute_time)
+                    executed.append(action)
+            new_total = time.perf_counter() - start
+            first_token = timing["first_token"]
+    finally:
+        client.close()
+        stub.close()
+
+    assert executed == STREAM_PLAN["actions"]
+    print(f"[*] 计划 {len(content)} 字符，{len(executed)} 个操作；模拟首个 token 300 ms、每个操作执行 {execute_time * 1000:.0f} ms")
+    print(f"    等待完整 JSON (旧)   首个操作 {old_first * 1000:7.1f} ms | 整回合 {old_total * 1000:7.1f} ms")
+    print(f"    流式提前执行         首个操作 {new_first * 1000:7.1f} ms | 整回合 {new_total * 1000:7.1f} ms"
+          f"  (首段文本 {first_token * 1000:.1f} ms)")
+
+
+def record_session_polls(seed, max_turns=20, chunk_lines=8, noise_every=2):
+    """录制一局会话的轮询序列：每 noise_every 次正常轮询之间插入一次只有计时器/表情类 tag 的轮询"""
+    log = generate_power_log(num_games=1, max_turns=max_turns, seed=seed, discover_every=3)
+    polls = []
+    for i, chunk in enumerate(split_chunks(log, chunk_lines)):
+        polls.append(chunk)
+        if i % noise_every == 0:
+            ts = chunk.rstrip("\n").rsplit("\n", 1)[-1].split(" ")[1]
+            polls.append(f"D {ts} GameState.DebugPrintPower() - TAG_CHANGE Entity={SYNTHETIC_PLAYERS[0]} "
+                         f"tag=TIMEOUT value={75 - i % 30} \n")
+    return polls
+
+
+def make_replay_app(tmp, base_url, **config):
+    """在临时目录中创建无界面的 HearthstoneAutoPilot，读取 tmp/Power.log，模型请求发往 base_url"""
+    import contextlib
+    import io
+    from hearthstone_copilot import HearthstoneAutoPilot
+
+    log_path = os.path.join(tmp, "Power.log")
+    open(log_path, "w").close()
+    config_path = os.path.join(tmp, "config.json")
+    with open(config_path, "w") as f:
+        json.dump(dict({"LOG_PATH": log_path, "API_KEY": "x", "BASE_URL": base_url, "STREAMING": False}, **config), f)
+    with contextlib.redirect_stdout(io.StringIO()):
+        app = HearthstoneAutoPilot(config_path=config_path, headless=True)
+    app.tracker = get_tracker()
+    if config.get("DECK_CODE"):
+        with contextlib.redirect_stdout(io.StringIO()):
+            app.tracker.apply_deck_code(config["DECK_CODE"])
+    return app, log_path
+
+
+def bench_decisions(args):
+    """决策缓存：按局面指纹去重后的模型调用次数 (录制会话回放)"""
+    import contextlib
+    import io
+    import tempfile
+
+    polls = record_session_polls(args.seed)
+    stub = StubLLMServer(handshake_delay=0, think_delay=0, reply={"thought": "stub", "actions": []})
+    with tempfile.TemporaryDirectory() as tmp:
+        # 只统计模型调用和缓存：本地规则直接给出的决策不经过两者
+        app, log_path = make_replay_app(tmp, stub.url, LOCAL_FAST_PATH=False)
+
+        decisions = 0
+        try:
+            with open(log_path, "a", encoding="utf-8") as log, contextlib.redirect_stdout(io.StringIO()):
+                for chunk in polls:
+                    log.write(chunk)
+                    log.flush()
+                    state = app.get_game_state()
+                    if not state or state.get("game_over"):
+                        continue
+                    # 与 run() 相同的条件：我的回合或调度阶段才请求决策
+                    if app.tracker.is_my_turn() or state.get("game_phase") == "MULLIGAN":
+                        decisions += 1
+                        app.act_on_state(state, hand_size=len(state.get("hand_cards", [])))
+        finally:
+            app.router.close()
+            stub.close()
+            if app.tailer:
+                app.tailer.close()
+
+    cache = app.decision_cache
+    print(f"[*] 回放 {len(polls)} 次轮询 (含计时器类无关日志)，其中 {decisions} 次需要决策")
+    print(f"    无缓存: 模型调用 {decisions} 次")
+    print(f"    指纹缓存: 模型调用 {stub.requests} 次 | 命中 {cache.hits} 次 | 命中率 {cache.hits / max(1, decisions):.0%}"
+          f" | 节省 {decisions - stub.requests} 次调用")
+    assert stub.requests + cache.hits == decisions
+
+
+def legacy_build_prompt(state):
+    """原版提示词：整个状态 (含 initial_deck 的全部卡牌描述) 以 json.dumps 嵌入"""
+    # 针对 Mulligan 阶段的特殊 Prompt
+    if state.get("game_phase") == "MULLIGAN":
+        prompt = f"""
+        你是一个炉石传说AI助手。现在是起手调度阶段 (Mulligan)。
+        
+        你的手牌: {state.get("hand_cards", [])}
+        你的牌库剩余: {state.get("my_deck", [])}
+        
+        请决定替换掉哪些牌。通常保留低费随从，替换高费牌。
+        请输出 JSON 响应，格式如下：
+        {{
+            "thought": "简短的一句话思考过程",
+            "actions": [
+                {{ "type": "MULLIGAN_REPLACE", "hand_index": 0, "desc": "替换第1张" }},
+                {{ "type": "MULLIGAN_CONFIRM", "desc": "确认" }}
+            ]
+        }}
+        注意：如果不替换任何牌，直接输出 MULLIGAN_CONFIRM。
+        只输出 JSON。
+        """
+    else:
+        # 常规回合 Prompt - 职业选手版 (Professional Player)
+        prompt = f"""
+        Role: You are a professional Hearthstone player aiming for the highest win rate.
+        
+        Current Game State (JSON):
+        {json.dumps(state, ensure_ascii=False)}
+        
+        Your Strategic Priorities (in order):
+        0. **DECK AWARENESS**: Check your 'my_deck' in the state JSON to know what cards are remaining.
+        1. **HANDLE CHOICES**: If "choices" list is present and not empty, you MUST return a "CHOOSE" action immediately. Do not do anything else.
+        2. **CHECK LETHAL**: Calculate if you can kill the enemy hero this turn (Board damage + Hand damage). If yes, IGNORE TRADING and go face.
+        3. **SURVIVAL**: If your Health is low, prioritize Taunt, Healing, or Clearing the board.
+        4. **VALUE TRADING**: If not lethal, make favorable trades (kill enemy minion while keeping yours alive).
+        5. **TEMPO**: Spend as much Mana as possible. Develop the board.
+        6. **FACE**: If no good trades, attack Enemy Hero.
+        
+        Rules:
+        - Minions with "exhausted": true cannot attack (unless they have Rush/Charge, but assume mostly no).
+        - Minions with "attack": 0 cannot attack.
+        - You cannot target "immune" or "stealth" characters.
+        
+        Output Format:
+        Provide a strictly valid JSON response.
+        IMPORTANT: Your 'thought' content MUST be in CHINESE.
+        {{
+            "thought": "简短的中文战术思考。例如：'斩杀线不够，优先解场。' / '发现法术。'",
+            "actions": [
+                {{ "type": "CHOOSE", "index": 0, "desc": "Pick option 0" }},
+                {{ "type": "PLAY_MINION", "hand_index": 0, "desc": "Play Card X" }},
+                {{ "type": "PLAY_TARGET", "hand_index": 0, "target_type": "enemy_hero", "desc": "Fireball to Face" }},
+                {{ "type": "PLAY_TARGET", "hand_index": 0, "target_type": "minion", "target_index": 0, "desc": "Buff my minion 0" }},
+                {{ "type": "ATTACK", "attacker_index": 0, "target_type": "minion", "target_index": 0, "desc": "My Minion 0 trades Enemy Minion 0" }},
+                {{ "type": "ATTACK", "attacker_index": 0, "target_type": "enemy_hero", "desc": "Go Face" }},
+                {{ "type": "HERO_POWER", "desc": "Use Hero Power" }},
+                {{ "type": "END_TURN", "desc": "End Turn" }}
+            ]
+        }}
+        
+        IMPORTANT: Return ONLY the JSON. No markdown formatting.
+        """
+    return prompt
+
+
+def bench_prompt(args):
+    """提示词大小：紧凑编码 + 卡牌词典 vs 原版 json.dumps(state)，以及本地桩服务器上的模型延迟"""
+    import contextlib
+    import io
+    import tempfile
+    from hearthstone_copilot import STATE_LEGEND, PromptEncoder, estimate_tokens, state_fingerprint
+
+    # 牌库没有变化的第二次编码不再带 d
+    encoder = PromptEncoder()
+    state = {"turn": 3, "my_deck": ["火球术 x2", "寒冰箭 x1"]}
+    first, second = json.loads(encoder.encode(state)), json.loads(encoder.encode(dict(state, turn=4)))
+    third = json.loads(encoder.encode(dict(state, my_deck=["火球术 x2"])))
+    assert first["d"] == state["my_deck"] and "d" not in second and third["d"] == ["火球术 x2"], (first, second, third)
+
+    prefill = 0.0005  # 模拟预填充速度：约 2000 token/s
+    stub = StubLLMServer(handshake_delay=0, think_delay=0.02, prefill_per_token=prefill)
+    with tempfile.TemporaryDirectory() as tmp:
+        # 与实际使用一致：config.json 中配置了套牌代码，initial_deck 带有整套牌的描述
+        with open("config.json", encoding="utf-8") as f:
+            deck_code = json.load(f)["DECK_CODE"]
+        app, log_path = make_replay_app(tmp, stub.url, DECK_CODE=deck_code)
+        states, seen = [], set()
+        try:
+            with open(log_path, "a", encoding="utf-8") as log, contextlib.redirect_stdout(io.StringIO()):
+                for chunk in record_session_polls(args.seed, max_turns=30, noise_every=10 ** 9):
+                    log.write(chunk)
+                    log.flush()
+                    state = app.get_game_state()
+                    if not state or state.get("game_over"):
+                        continue
+                    if app.tracker.is_my_turn() or state.get("game_phase") == "MULLIGAN":
+                        fingerprint = state_fingerprint(state)
+                        if fingerprint not in seen:
+                            seen.add(fingerprint)
+                            states.append(state)
+
+            def messages_for(state, legacy):
+                if legacy:
+                    return [{"role": "system", "content": "You are a JSON-only response bot. Output ONLY valid JSON."},
+                            {"role": "user", "content": legacy_build_prompt(state)}]
+                return app.build_messages(app.build_prompt(state))
+
+            for label, legacy in (("原版 json.dumps(state)", True), ("紧凑编码 + 词典", False)):
+                chars, tokens, state_tokens, latency = [], [], [], []
+                decks = 0
+                with contextlib.redirect_stdout(io.StringIO()):
+                    for state in states:
+                        start = time.perf_counter()
+                        messages = messages_for(state, legacy)
+                        build = time.perf_counter() - start
+                        chars.append(sum(len(m["content"]) for m in messages))
+                        tokens.append(sum(estimate_tokens(m["content"]) for m in messages))
+                        # 随局面变化的部分 (其余是固定说明 / 本局不变的词典，可命中服务端前缀缓存)
+                        if legacy:
+                            state_text = json.dumps(state, ensure_ascii=False)
+                        else:
+                            state_text = messages[1]["content"].partition(f"{STATE_LEGEND}\n")[2]
+                            state_text = state_text.removeprefix("Current Game State:\n").partition("\n")[0]
+                            decks += "d" in json.loads(state_text)
+                        state_tokens.append(estimate_tokens(state_text))
+                        start = time.perf_counter()
+                        app.router.request_plan(messages)
+                        latency.append(build + time.perf_counter() - start)
+                print(f"[*] {label} ({len(states)} 个决策局面)")
+                print(f"    字符数: 平均 {statistics.mean(chars):.0f} | 最大 {max(chars)}")
+                print(f"    token (估算): 平均 {statistics.mean(tokens):.0f} | 最大 {max(tokens)}"
+                      f" | 其中状态部分平均 {statistics.mean(state_tokens):.0f}")
+                if not legacy:
+                    print(f"    牌库列表只在变化时发送: {decks}/{len(states)} 个提示词带 d")
+                summarize("构建提示词 + 模型调用", latency)
+        finally:
+            app.router.close()
+            stub.close()
+            if app.tailer:
+                app.tailer.close()
+    print(f"    (桩服务器按 {prefill * 1000:.1f} ms/token 模拟预填充)")
+
+
+def replay_turn_latency(polls, speculative, poll_interval, stub_config):
+    """后台线程按固定节奏写入日志，主线程与 run() 相同地读取并调用 handle_state
+
+    返回 (每个回合从开始到第一个操作的耗时, 模型请求次数, 规划器)。
+    """
+    import contextlib
+    import io
+    import tempfile
+    import threading
+
+    stub = StubLLMServer(handshake_delay=0, reply=STREAM_PLAN, **stub_config)
+    with tempfile.TemporaryDirectory() as tmp:
+        # 抽牌动画等待和动作结算等待按同样的比例缩短
+        app, log_path = make_replay_app(tmp, stub.url, SPECULATIVE_PLANNING=speculative,
+                                        TURN_START_DELAY=poll_interval * 4, ACTION_SETTLE_DELAY=poll_interval)
+        latencies = []
+        turn_start = None
+        real_perform_action = app.perform_action
+
+        def perform_action(action, hand_size=0):
+            nonlocal turn_start
+            if turn_start is not None:
+                latencies.append(time.perf_counter() - turn_start)
+                turn_start = None
+            real_perform_action(action, hand_size)
+
+        app.perform_action = perform_action
+
+        def write_log():
+            with open(log_path, "a", encoding="utf-8") as log:
+                for chunk in polls:
+                    log.write(chunk)
+                    log.flush()
+                    time.sleep(poll_interval)  # 日志写入节奏 (加速后的对局时钟)
+
+        writer = threading.Thread(target=write_log, daemon=True)
+        with contextlib.redirect_stdout(io.StringIO()):
+            try:
+                writer.start()
+                while True:
+                    state = app.get_game_state()
+                    if state:
+                        if turn_start is None and app.tracker.is_my_turn() and not app.last_is_my_turn \
+                                and state.get("game_phase") == "PLAYING":
+                            turn_start = time.perf_counter()
+                        app.handle_state(state)
+                    elif not writer.is_alive():
+                        break
+                    else:
+                        app.tailer.wait(poll_interval)
+            finally:
+                app.router.close()
+                if app.planner:
+                    app.planner.close()
+                stub.close()
+                if app.tailer:
+                    app.tailer.close()
+    return latencies, stub.requests, app.planner
+
+
+def bench_speculative(args):
+    """对手回合预先规划：回合开始到第一个鼠标操作的耗时 (回放日志，加速时钟)"""
+    polls = split_chunks(generate_power_log(num_games=1, max_turns=16, seed=args.seed), 8)
+    # 加速时钟：每 0.1 s 写入一次日志；桩服务器约 0.2 s 思考 + 按 token 预填充
+    stub_config = {"think_delay": 0.2, "prefill_per_token": 0.0002}
+    print("[*] 回合开始后固定等待 0.4 s 抽牌动画 (对应实际的 3.5 s)，两种方式都包含在耗时中")
+    for label, speculative in (("回合开始后才请求模型", False), ("对手回合预先规划", True)):
+        latencies, requests, planner = replay_turn_latency(polls, speculative, 0.1, stub_config)
+        print(f"[*] {label}: 模型请求 {requests} 次", end="")
+        if planner:
+            print(f" | 预测命中 {planner.hits} 次，丢弃 {planner.misses} 次", end="")
+        print()
+        summarize("回合开始 -> 第一个操作", latencies)
+
+
+def run_router(backends, calls, hedge_delay=0.3, stream=False):
+    """用给定的桩服务器组成后端池，连续请求 calls 次，返回 (每次耗时, 有效计划数, 路由器)
+
+    stream=True 时走流式竞速 (open_stream)，耗时为第一个完整操作到达的时间 (流式决策从这时开始执行)。
+    """
+    import contextlib
+    import io
+    import threading
+    from hearthstone_copilot import ActionStreamParser, LLMRouter
+
+    config = {"BACKENDS": [{"NAME": name, "BASE_URL": stub.url, "API_KEY": "x", "TIMEOUT": 5}
+                           for name, stub in backends],
+              "HEDGE_DELAY": hedge_delay}
+    router = LLMRouter.from_config(config)
+    messages = [{"role": "user", "content": "state"}]
+    latencies, valid = [], 0
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(calls):
+            start = time.perf_counter()
+            if not stream:
+                plan = router.request_plan(messages)
+                latencies.append(time.perf_counter() - start)
+                valid += plan is not None
+                continue
+            parser, first = ActionStreamParser(), None
+            _, deltas = router.open_stream(messages)
+            for delta in deltas or []:
+                if parser.feed(delta) and first is None:
+                    first = time.perf_counter() - start
+            latencies.append(first if first is not None else time.perf_counter() - start)
+            valid += parser.result() is not None
+        # 等待被取消的流读完 (它们的输出也重定向掉)
+        while any(t.name.startswith("stream-") for t in threading.enumerate()):
+            time.sleep(0.01)
+    router.close()
+    return latencies, valid, router
+
+
+def bench_backends(args):
+    """多后端竞速与故障转移：长尾延迟 / 报错 / 格式错误的桩服务器"""
+    calls = 20
+    # 主后端通常 0.1 s，但每 4 个请求有一个多等 1.5 s；备用后端稳定 0.25 s
+    tail = lambda: StubLLMServer(handshake_delay=0, think_delay=0.1, slow_every=4, slow_delay=1.5)
+    steady = lambda: StubLLMServer(handshake_delay=0, think_delay=0.25)
+    scenarios = [
+        ("单个后端 (长尾延迟)", lambda: [("tail", tail())]),
+        ("竞速: 长尾主后端 + 稳定备用", lambda: [("tail", tail()), ("steady", steady())]),
+        ("流式, 单个后端 (长尾延迟)", lambda: [("tail", tail())]),
+        ("流式竞速: 长尾主后端 + 稳定备用", lambda: [("tail", tail()), ("steady", steady())]),
+        ("单个后端 (HTTP 500)", lambda: [("failing", StubLLMServer(handshake_delay=0, status=500))]),
+        ("故障转移: 500 + 格式错误 + 正常", lambda: [
+            ("failing", StubLLMServer(handshake_delay=0, status=500)),
+            ("malformed", StubLLMServer(handshake_delay=0, reply="这不是 JSON")),
+            ("steady", steady()),
+        ]),
+    ]
+    worst = {}
+    for label, make in scenarios:
+        backends = make()
+        try:
+            latencies, valid, router = run_router(backends, calls, stream=label.startswith("流式"))
+        finally:
+            for _, stub in backends:
+                stub.close()
+        print(f"[*] {label}: 有效计划 {valid}/{calls}")
+        summarize("请求耗时", latencies)
+        stats = " | ".join(f"{b.name}: EWMA {b.ewma * 1000:.0f} ms, 失败 {b.failures}"
+                           for b in router.backends if b.ewma is not None)
+        print(f"    {stats}")
+        print(f"    各后端收到的请求: {', '.join(f'{name} {stub.requests}' for name, stub in backends)}")
+        worst[label] = max(latencies)
+    # 竞速后不应再出现长尾主后端的 1.5 s 等待 (流式以第一个完整操作计)
+    for label in ("竞速: 长尾主后端 + 稳定备用", "流式竞速: 长尾主后端 + 稳定备用"):
+        assert worst[label] < 1.0, f"{label}: 最慢 {worst[label]:.2f} s，竞速没有生效"
+
+
+def bench_fastpath(args):
+    """本地规则快速路径：录制对局中不请求模型的决策占比与节省的时间"""
+    import contextlib
+    import io
+    import tempfile
+    from hearthstone_copilot import local_plan
+
+    log = generate_power_log(num_games=3, max_turns=24, seed=args.seed, discover_every=4)
+    stub = StubLLMServer(handshake_delay=0, think_delay=0.3)
+    counts = Counter()
+    model_latency, local_latency = [], []
+    with tempfile.TemporaryDirectory() as tmp:
+        app, log_path = make_replay_app(tmp, stub.url, SPECULATIVE_PLANNING=False, LOCAL_FAST_PATH=True)
+        cache = app.decision_cache
+        try:
+            with open(log_path, "a", encoding="utf-8") as f, contextlib.redirect_stdout(io.StringIO()):
+                for chunk in split_chunks(log, 8):
+                    f.write(chunk)
+                    f.flush()
+                    state = app.get_game_state()
+                    if not state or state.get("game_over"):
+                        continue
+                    if not (app.tracker.is_my_turn() or state.get("game_phase") == "MULLIGAN"):
+                        continue
+                    hits, requests = cache.hits, stub.requests
+                    start = time.perf_counter()
+                    plan = app.act_on_state(state, hand_size=len(state.get("hand_cards", [])))
+                    elapsed = time.perf_counter() - start
+                    if cache.hits > hits:
+                        counts["cache"] += 1
+                    elif stub.requests > requests:
+                        counts["model"] += 1
+                        model_latency.append(elapsed)
+                    elif plan:
+                        counts["local"] += 1
+                        kind = plan["actions"][0]["type"]
+                        counts[f"local:{kind}"] += 1
+                        start = time.perf_counter()
+                        local_plan(state)
+                        local_latency.append(time.perf_counter() - start)
+        finally:
+            app.router.close()
+            stub.close()
+            if app.tailer:
+                app.tailer.close()
+
+    decided = counts["model"] + counts["local"]
+    print(f"[*] 3 局录制对局：{decided} 次需要新决策 (另有 {counts['cache']} 次命中决策缓存)")
+    print(f"    本地规则处理 {counts['local']} 次 ({counts['local'] / max(1, decided):.0%})："
+          + ", ".join(f"{key[6:]} {value}" for key, value in sorted(counts.items()) if key.startswith("local:")))
+    print(f"    请求模型 {counts['model']} 次")
+    summarize("本地规则决策 (local_plan)", local_latency)
+    summarize("模型决策 (桩服务器 0.3 s)", model_latency)
+    saved = counts["local"] * statistics.mean(model_latency) if model_latency else 0.0
+    print(f"    节省约 {saved:.1f} s 的模型等待时间")
+
+
+def random_board(rng, size, taunt_rate=0.2, shield_rate=0.3, ready=True):
+    """随机生成一方的场面 (get_my_board / get_opp_board 格式)"""
+    board = []
+    for _ in range(size):
+        minion = {"atk": rng.randint(1, 8), "health": rng.randint(1, 8),
+                  "divine_shield": rng.random() < shield_rate, "taunt": rng.random() < taunt_rate}
+        if ready:
+            minion["can_attack"] = True
+        board.append(minion)
+    return board
+
+
+def brute_force_trades(my_minions, enemy_minions):
+    """穷举所有攻击顺序与目标 (包括多个随从削血) 的最优收益，用于校验 CombatSearch"""
+    from hearthstone_copilot import FACE_WEIGHT, _combat_unit, _take_damage, _unit_value
+
+    def search(ready, enemies):
+        taunts = [j for j, e in enumerate(enemies) if e[3]]
+        best = 0.0
+        for i, attacker in enumerate(ready):
+            rest = ready[:i] + ready[i + 1:]
+            if not taunts:
+                best = max(best, FACE_WEIGHT * attacker[0] + search(rest, enemies))
+            for j in taunts or range(len(enemies)):
+                defender = enemies[j]
+                hit = _take_damage(defender, attacker[0])
+                gain = (_unit_value(defender) - _unit_value(hit)
+                        + _unit_value(_take_damage(attacker, defender[0])) - _unit_value(attacker))
+                remaining = enemies[:j] + ((hit,) if hit else ()) + enemies[j + 1:]
+                best = max(best, gain + search(rest, remaining))
+        return best
+
+    return search(tuple(_combat_unit(m) for m in my_minions), tuple(_combat_unit(m) for m in enemy_minions))
+
+
+def bench_combat(args):
+    """战斗搜索：7v7 斩杀 / 交换 (启发式) 的耗时，以及小场面上与穷举结果的对比"""
+    from hearthstone_copilot import CombatSearch
+
+    rng = random.Random(args.seed)
+    lethal_times, trade_times = [], []
+    lethal_found = 0
+    for _ in range(300):
+        # 7v7：全部可攻击，嘲讽较少时可打脸的状态最多 (最坏情况)
+        mine = random_board(rng, 7, taunt_rate=0.1)
+        enemy = random_board(rng, 7, taunt_rate=rng.choice((0.0, 0.2, 0.5)), ready=False)
+        hero = {"health": rng.randint(5, 30), "armor": rng.choice((0, 0, 5))}
+        start = time.perf_counter()
+        lethal = CombatSearch(mine, enemy, hero).find_lethal()
+        lethal_times.append(time.perf_counter() - start)
+        lethal_found += lethal is not None
+        start = time.perf_counter()
+        CombatSearch(mine, enemy, hero).best_trades()
+        trade_times.append(time.perf_counter() - start)
+    print(f"[*] 300 个随机 7v7 场面 (其中 {lethal_found} 个可斩杀)")
+    summarize("斩杀搜索 find_lethal", lethal_times)
+    summarize("交换 best_trades", trade_times)
+
+    exact = 0
+    trials = 200
+    for _ in range(trials):
+        size = rng.randint(2, 4)
+        mine, enemy = random_board(rng, size), random_board(rng, size, ready=False)
+        score, _ = CombatSearch(mine, enemy, {"health": 30}).best_trades()
+        optimum = brute_force_trades(mine, enemy)
+        assert score <= optimum + 1e-9
+        exact += abs(score - optimum) < 1e-9
+    print(f"[*] 2v2 ~ 4v4 场面与穷举所有攻击顺序对比: {exact}/{trials} 个达到最优")
+
+
+def legacy_subset_tables(search):
+    """旧版逐个子集的纯 Python 评估 (CombatEvaluator 之前的 CombatSearch._subset_table)，作为对照"""
+    from hearthstone_copilot import _take_damage, _unit_value
+
+    ready, units = search.ready, search.my_units
+    search._atk_sum = [sum(units[i][0] for bit, i in enumerate(ready) if mask >> bit & 1)
+                       for mask in range(1 << len(ready))]
+    tables = []
+    for target in search.targets:
+        unit = search.enemy_units[target]
+        table = []
+        for mask in range(1, 1 << len(ready)):
+            current, gain = unit, _unit_value(unit)
+            for bit, i in enumerate(ready):
+                if mask >> bit & 1:
+                    if current is None:
+                        break
+                    attacker = units[i]
+                    gain += _unit_value(_take_damage(attacker, current[0])) - _unit_value(attacker)
+                    current = _take_damage(current, attacker[0])
+            else:
+                if current is None or not mask & (mask - 1):
+                    table.append((mask, gain - _unit_value(current), current is None))
+        tables.append(table)
+    return tables
+
+
+def bench_evaluator(args):
+    """攻击方案评估：NumPy 批量 (CombatEvaluator) vs 逐个子集的纯 Python 循环，结果必须一致"""
+    from hearthstone_copilot import CombatSearch, np
+
+    class LegacyCombatSearch(CombatSearch):
+        _subset_tables = legacy_subset_tables
+
+    np.zeros(1)  # 预先加载 numpy，不计入耗时
+    rng = random.Random(args.seed)
+    for size in (3, 5, 7):
+        boards = []
+        for _ in range(200):
+            mine = random_board(rng, size, taunt_rate=0.1)
+            enemy = random_board(rng, size, taunt_rate=rng.choice((0.0, 0.2, 0.5)), ready=False)
+            boards.append((mine, enemy, {"health": rng.randint(5, 30), "armor": rng.choice((0, 0, 5))}))
+        results = {}
+        for label, cls in (("纯 Python", LegacyCombatSearch), ("NumPy 批量", CombatSearch)):
+            table_times, trade_times, outputs = [], [], []
+            for mine, enemy, hero in boards:
+                search = cls(mine, enemy, hero)
+                start = time.perf_counter()
+                tables = search._subset_tables()
+                table_times.append(time.perf_counter() - start)
+                start = time.perf_counter()
+                trades = cls(mine, enemy, hero).best_trades()
+                trade_times.append(time.perf_counter() - start)
+                outputs.append((tables, search._atk_sum, trades, cls(mine, enemy, hero).find_lethal()))
+            results[label] = outputs
+            summarize(f"{size}v{size} {label} 子集评估", table_times)
+            summarize(f"{size}v{size} {label} best_trades", trade_times)
+        assert results["纯 Python"] == results["NumPy 批量"]
+        print(f"[*] {size}v{size}: {len(boards)} 个场面的评估表、交换与斩杀结果完全一致")
+
+
+class FixtureScreen:
+    """用保存的截图代替显示器 (替换 hearthstone_copilot.pyautogui，供旧实现使用)：截图返回 RGB 数组，moveTo 按 duration 等待"""
+
+    def __init__(self):
+        self.image = None
+        self.screenshots = 0
+
+    def size(self):
+        return self.image.shape[1], self.image.shape[0]
+
+    def screenshot(self, region=None):
+        self.screenshots += 1
+        if region is None:
+            return self.image
+        left, top, width, height = region
+        return self.image[top:top + height, left:left + width]
+
+    def moveTo(self, x, y, duration=0.0):
+        time.sleep(duration)
+
+
+# 合成手牌截图的几何参数：独立给出，不取自 get_hand_card_pos / HAND_PROBE_OFFSETS，每张图在范围内随机取值
+FIXTURE_HAND_CENTER = (0.45, 0.49)   # 手牌中心 x 的范围
+FIXTURE_HAND_Y = (0.92, 0.95)        # 手牌中心 y 的范围
+FIXTURE_HAND_WIDTH = (0.27, 0.34)    # 两端手牌中心距离的范围 (相邻两张最多相距 0.1)
+FIXTURE_CARD = (44, 104)             # 牌面宽高 (像素)，可打出的牌外有 8 像素的高亮描边
+
+
+def render_hand_fixture(rng, hand_size, size=(1920, 1080)):
+    """合成一张手牌截图 (RGB)：按 FIXTURE_HAND_* 的随机几何从左到右叠放手牌，每张牌再各自偏移最多 12 像素，
+    可打出的牌带绿色/黄色描边"""
+    import numpy as np
+    import cv2
+
+    width, height = size
+    image = np.full((height, width, 3), 40, dtype=np.uint8)
+    center_x, y = rng.uniform(*FIXTURE_HAND_CENTER), rng.uniform(*FIXTURE_HAND_Y)
+    spacing = min(0.1, rng.uniform(*FIXTURE_HAND_WIDTH) / max(1, hand_size - 1))
+    half_w, half_h = FIXTURE_CARD[0] // 2, FIXTURE_CARD[1] // 2
+    for idx in range(hand_size):  # 右边的牌压在左边的牌上
+        x = center_x + (idx - (hand_size - 1) / 2) * spacing
+        cx, cy = int(x * width) + rng.randint(-12, 12), int(y * height)
+        if rng.random() < 0.7:
+            glow = (255, 215, 0) if rng.random() < 0.2 else (0, 255, 0)
+            cv2.rectangle(image, (cx - half_w - 8, cy - half_h - 8), (cx + half_w + 8, cy + half_h + 8), glow, -1)
+        cv2.rectangle(image, (cx - half_w, cy - half_h), (cx + half_w, cy + half_h), (110, 90, 70), -1)
+    return image
+
+
+def legacy_vision_verify_highlight(x, y, radius=30):
+    """旧实现：每次探测都截一小块屏幕并重新计算 HSV 和两个 inRange 掩码"""
+    from hearthstone_copilot import cv2, np, pyautogui
+
+    screenshot = pyautogui.screenshot(region=(int(x - radius), int(y - radius), radius * 2, radius * 2))
+    hsv = cv2.cvtColor(cv2.cvtColor(np.array(screenshot), cv2.COLOR_RGB2BGR), cv2.COLOR_BGR2HSV)
+    green = cv2.countNonZero(cv2.inRange(hsv, np.array([35, 100, 100]), np.array([85, 255, 255])))
+    yellow = cv2.countNonZero(cv2.inRange(hsv, np.array([20, 100, 100]), np.array([35, 255, 255])))
+    return green + yellow > 50
+
+
+def legacy_find_hand_card(app, idx, hand_size):
+    """旧实现：悬停后逐个偏移移动鼠标、等待、截图检测"""
+    from hearthstone_copilot import pyautogui
+
+    start_pos = app.get_scaled_coord(app.get_hand_card_pos(idx, hand_size))
+    pyautogui.moveTo(start_pos[0], start_pos[1], duration=0.2)
+    time.sleep(0.3)
+    if legacy_vision_verify_highlight(start_pos[0], start_pos[1]):
+        return start_pos
+    for offset in [-20, 20, -40, 40, -60, 60]:
+        test_x = start_pos[0] + offset
+        pyautogui.moveTo(test_x, start_pos[1], duration=0.1)
+        time.sleep(0.1)
+        if legacy_vision_verify_highlight(test_x, start_pos[1]):
+            return (test_x, start_pos[1])
+    return start_pos
+
+
+def bench_vision(args):
+    """手牌定位：单帧截图 + 每帧一次的 HSV 掩码 vs 每次探测都截图 (合成截图，几何参数与被测代码无关，不需要显示器)"""
+    import cv2
+    import tempfile
+    import hearthstone_copilot
+    from contextlib import redirect_stdout
+
+    rng = random.Random(args.seed)
+    screen = FixtureScreen()
+    original = hearthstone_copilot.pyautogui
+    hearthstone_copilot.pyautogui = screen
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            fixtures = []
+            for _ in range(6):
+                hand_size = rng.randint(3, 10)
+                fixtures.append((cv2.cvtColor(render_hand_fixture(rng, hand_size), cv2.COLOR_RGB2BGR), hand_size))
+            app, _ = make_replay_app(tmp, "http://127.0.0.1:9/v1", SPECULATIVE_PLANNING=False)
+            app.input = hearthstone_copilot.MockInput(realtime=True)  # 移动按 duration 等待，截图来自合成的 fixture
+            app.capture.backend = "input"
+            cards = [(frame, hand_size, idx) for frame, hand_size in fixtures for idx in rng.sample(range(hand_size), 2)]
+            positions, shots = {}, {}
+            for label, find in (("每次探测截图 (旧)", lambda i, h: legacy_find_hand_card(app, i, h)),
+                                ("单帧截图 (当前)", lambda i, h: app._find_hand_card(i, h, {}, False))):
+                samples, found = [], []
+                screen.screenshots = app.input.screenshots = 0
+                for frame, hand_size, idx in cards:
+                    app.input.frame = frame
+                    screen.image = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+                    start = time.perf_counter()
+                    with redirect_stdout(StringIO()):
+                        found.append(find(idx, hand_size))
+                    samples.append(time.perf_counter() - start)
+                positions[label], shots[label] = found, screen.screenshots + app.input.screenshots
+                summarize(label, samples)
+
+            # 只比较视觉计算 (不含鼠标移动和等待)：同一张截图上探测全部手牌位置
+            compute = {"旧": [], "当前": []}
+            for frame, hand_size in fixtures:
+                app.input.frame = frame
+                screen.image = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+                points = [app.get_scaled_coord(app.get_hand_card_pos(i, hand_size)) for i in range(hand_size)]
+                start = time.perf_counter()
+                old = [legacy_vision_verify_highlight(x + d, y) for x, y in points for d in (0, -20, 20, -40, 40, -60, 60)]
+                compute["旧"].append(time.perf_counter() - start)
+                start = time.perf_counter()
+                with redirect_stdout(StringIO()):
+                    app.capture.grab()
+                    new = [app.vision_verify_highlight(x + d, y, grab=False)
+                           for x, y in points for d in (0, -20, 20, -40, 40, -60, 60)]
+                compute["当前"].append(time.perf_counter() - start)
+                assert old == new
+    finally:
+        hearthstone_copilot.pyautogui = original
+    summarize("全部手牌位置 x 7 个偏移 (旧)", compute["旧"])
+    summarize("全部手牌位置 x 7 个偏移 (当前)", compute["当前"])
+    old_label, new_label = list(positions)
+    assert positions[old_label] == positions[new_label]
+    print(f"[*] {len(cards)} 次手牌定位结果一致；截图次数 {shots[old_label]} -> {shots[new_label]}")
+    print("    fixture 截图几乎不花时间；真实显示器上每次截图另需数毫秒到数十毫秒")
+
+
+LEGACY_ENEMY_MINIONS = [[0.30, 0.37], [0.37, 0.37], [0.43, 0.37], [0.50, 0.37],
+                        [0.57, 0.37], [0.63, 0.37], [0.70, 0.37]]  # 旧 config.json 中固定的敌方随从槽位
+
+
+# 合成场面截图的几何参数：独立给出，不取自定位器的 BOARD_ROWS / MINION_SIZE / minion_layout，
+# 每张图在范围内随机取值 (不同分辨率下的缩放差异)
+FIXTURE_ROWS = {"enemy": (0.355, 0.385), "mine": (0.545, 0.575)}  # 随从中心 y 的范围
+FIXTURE_SPACING = (0.063, 0.071)                                  # 相邻随从中心 x 间距的范围
+FIXTURE_PORTRAIT = ((0.046, 0.058), (0.115, 0.14))                # 肖像宽、高的范围
+FIXTURE_GAP = 0.25                                                # 一行随从为入场的随从让出空位的概率
+
+
+def render_board_fixture(rng, counts, size=(1920, 1080)):
+    """合成一张场面截图 (BGR)：带纹理的桌面，两行椭圆随从肖像；返回 (图像, {side: 真实中心})
+
+    随从按 FIXTURE_* 的随机几何排列，每个随从再各自偏移几个像素；
+    部分行在随机位置让出半个间距的空位 (拖入随从时的场面)，此时各随从不再居中对齐。
+    """
+    import numpy as np
+    import cv2
+
+    width, height = size
+    noise = np.array([[rng.randint(70, 100) for _ in range(width // 48)] for _ in range(height // 48)], dtype=np.uint8)
+    table = cv2.resize(noise, size, interpolation=cv2.INTER_CUBIC)
+    image = cv2.merge([table // 2, table // 4 * 3, table])  # 带起伏的棕色桌面
+    spacing = rng.uniform(*FIXTURE_SPACING)
+    axes = tuple(int(rng.uniform(*span) * extent / 2) for span, extent in zip(FIXTURE_PORTRAIT, size))
+    centers = {}
+    for side, count in counts.items():
+        centers[side] = []
+        row_y = rng.uniform(*FIXTURE_ROWS[side])
+        gap = rng.randint(0, count) if count < 7 and rng.random() < FIXTURE_GAP else None
+        for i in range(count):
+            x = 0.5 + (i - (count - 1) / 2) * spacing
+            if gap is not None:
+                x += spacing / 2 if i >= gap else -spacing / 2
+            cx, cy = int(x * width) + rng.randint(-6, 6), int(row_y * height) + rng.randint(-4, 4)
+            art = tuple(rng.randint(30, 220) for _ in range(3))
+            cv2.ellipse(image, (cx, cy), axes, 0, 0, 360, art, -1)
+            for _ in range(4):  # 肖像里的细节
+                p1 = (cx + rng.randint(-20, 20), cy + rng.randint(-40, 40))
+                p2 = (cx + rng.randint(-20, 20), cy + rng.randint(-40, 40))
+                cv2.line(image, p1, p2, tuple(rng.randint(0, 255) for _ in range(3)), 3)
+            border = (40, 180, 220) if rng.random() < 0.3 else (150, 150, 150)
+            cv2.ellipse(image, (cx, cy), axes, 0, 0, 360, border, 5)
+            centers[side].append((cx, cy))
+    return image, centers
+
+
+def bench_locator(args):
+    """随从定位：单帧模板匹配 vs 旧的固定槽位 (合成截图，几何参数与定位器无关，不需要显示器)"""
+    from hearthstone_copilot import BoardLocator, ScreenCapture, minion_layout
+
+    rng = random.Random(args.seed)
+    capture = ScreenCapture(lambda: (1920, 1080))
+    locator = BoardLocator(capture)
+    tolerance = 0.026 * 1920  # 半个随从宽度以内算点中
+    hits = Counter()
+    total = Counter()
+    first, cached = [], []
+    for _ in range(40):
+        counts = {"enemy": rng.randint(1, 7), "mine": rng.randint(1, 7)}
+        image, centers = render_board_fixture(rng, counts)
+        capture.load(image)
+        start = time.perf_counter()
+        for side in centers:
+            locator.detect(side)
+        first.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        for side in centers:
+            locator.detect(side)
+        cached.append(time.perf_counter() - start)
+        for side, truth in centers.items():
+            for index, (tx, ty) in enumerate(truth):
+                # 已知数量准确 / 日志还没更新 (刚死了一个随从，已知数量多 1)；
+                # 对照：不看截图，只按同样的已知数量计算居中布局
+                for count, suffix in ((len(truth), "数量准确"), (len(truth) + 1, "数量过时 +1")):
+                    for label, (x, y) in ((f"识别, {suffix}", locator.locate(side, index, count)),
+                                          (f"居中布局, {suffix}", minion_layout(count, locator.rows[side])[index])):
+                        total[label] += 1
+                        hits[label] += abs(x * 1920 - tx) <= tolerance and abs(y * 1080 - ty) <= tolerance
+                if side == "enemy":
+                    x, y = LEGACY_ENEMY_MINIONS[index]
+                else:
+                    x, y = 0, 0  # 旧 config.json 没有 MY_MINIONS，攻击从 (0, 0) 拖出
+                total["固定槽位 (旧)"] += 1
+                hits["固定槽位 (旧)"] += abs(x * 1920 - tx) <= tolerance and abs(y * 1080 - ty) <= tolerance
+    summarize("两行随从识别 (每帧首次)", first)
+    summarize("两行随从识别 (同一帧缓存)", cached)
+    for label in ("固定槽位 (旧)", "居中布局, 数量准确", "识别, 数量准确", "居中布局, 数量过时 +1", "识别, 数量过时 +1"):
+        print(f"[*] {label:<16} 点中 {hits[label]}/{total[label]} 个随从")
+    # 识别不可信或数量不一致时退回布局：同样的已知数量下不应比布局差
+    for suffix in ("数量准确", "数量过时 +1"):
+        assert hits[f"识别, {suffix}"] >= hits[f"居中布局, {suffix}"], suffix
+
+
+class LogReplayer:
+    """MockInput 的 on_input：模拟客户端对操作的响应
+
+    每次拖拽/点击后经过 latency 秒，把录制日志的下一段追加到 Power.log (latency=0 时立即写入)；
+    drop 中的第 N 次输入 "点歪了"：不产生日志。
+    """
+
+    def __init__(self, log_path, latency=0.3):
+        self.log_path = log_path
+        self.latency = latency
+        self.segments = []
+        self.inputs = 0
+        self.drop = set()
+        self._timers = []
+
+    def __call__(self, event):
+        import threading
+
+        self.inputs += 1
+        if self.inputs in self.drop or not self.segments:
+            return
+        segment = self.segments.pop(0)
+        if self.latency <= 0:
+            self._write(segment)
+            return
+        timer = threading.Timer(self.latency, self._write, (segment,))
+        self._timers.append(timer)
+        timer.start()
+
+    def _write(self, text):
+        with open(self.log_path, "a") as f:
+            f.write(text)
+
+    def join(self):
+        for timer in self._timers:
+            timer.join()
+
+
+def record_turns(seed, max_turns=12, turns=3):
+    """录制一局合成对局中我方 (玩家 1) 的操作，按操作切分日志
+
+    返回 (开头的日志, [(我方一回合的操作 [(类型, 实体 ID)], 每个操作对应的日志段)])：
+    从我方第一次出牌开始录制 turns 个回合；每回合最后一个操作是 END_TURN，它的日志段包括对手回合和我方下一回合开始。
+    """
+    import re
+
+    lines = generate_power_log(1, max_turns=max_turns, seed=seed).splitlines(keepends=True)
+    action_re = re.compile(r"GameState\.DebugPrintPower\(\) - BLOCK_START BlockType=(PLAY|ATTACK) "
+                           r"Entity=\[entityName=\S+ id=(\d+) zone=\w+ zonePos=\d+ cardId=\S* player=1\]")
+    turn_re = re.compile(r"GameState\.DebugPrintPower\(\) - TAG_CHANGE Entity=GameEntity tag=TURN value=(\d+)")
+    cuts = []  # (行号, 类型, 实体 ID)；回合结束记为 END_TURN
+    for i, line in enumerate(lines):
+        if (m := action_re.search(line)):
+            cuts.append((i, "PLAY_MINION" if m.group(1) == "PLAY" else "ATTACK", int(m.group(2))))
+        elif (m := turn_re.search(line)) and int(m.group(1)) % 2 == 0:
+            cuts.append((i, "END_TURN", None))
+    # 从我方第一次出牌开始；每个操作的日志段从它的 BLOCK_START (或回合结束) 到下一个操作
+    first = next(n for n, cut in enumerate(cuts) if cut[1] != "END_TURN")
+    cuts = cuts[first:] + [(len(lines), None, None)]
+    turns_out, current, segments = [], [], []
+    for (line_no, kind, eid), (next_line, _, _) in zip(cuts, cuts[1:]):
+        current.append((kind, eid))
+        segments.append("".join(lines[line_no:next_line]))
+        if kind == "END_TURN":
+            turns_out.append((current, segments))
+            current, segments = [], []
+            if len(turns_out) == turns:
+                break
+    return "".join(lines[:cuts[0][0]]), turns_out
+
+
+def replay_action(app, kind, eid):
+    """把录制的操作换算成当前追踪器状态下的下标"""
+    from hearthstone_copilot import CardType, Zone
+
+    tracker = app.tracker
+    pid = tracker.friendly_player_id
+    if kind == "PLAY_MINION":
+        hand = [e.id for e in tracker._zone_entities(pid, Zone.HAND)]
+        return {"type": kind, "hand_index": hand.index(eid), "desc": f"打出 {eid}"}, len(hand)
+    if kind == "ATTACK":
+        board = [e.id for e in tracker._zone_entities(pid, Zone.PLAY, CardType.MINION)]
+        return {"type": kind, "attacker_index": board.index(eid), "target_type": "enemy_hero", "desc": f"{eid} 攻击"}, 0
+    return {"type": "END_TURN", "desc": "结束回合"}, 0
+
+
+def bench_executor(args):
+    """闭环执行：每步等待日志确认 vs 固定停顿 (PAUSE=1s + 回合后 5s)，回放录制日志，鼠标为 MockInput"""
+    import tempfile
+    from hearthstone_copilot import MockInput
+    from contextlib import redirect_stdout
+
+    prefix, turns = record_turns(args.seed)
+    results = {}
+    for label, closed_loop in (("固定停顿 (旧)", False), ("日志确认 (当前)", True)):
+        with tempfile.TemporaryDirectory() as tmp:
+            app, log_path = make_replay_app(tmp, "http://127.0.0.1:9/v1", SPECULATIVE_PLANNING=False,
+                                            ACTION_CONFIRM_TIMEOUT=2.0)
+            replayer = LogReplayer(log_path)
+            pause = app.config.get("INPUT_PAUSE", 0.1) if closed_loop else 1.0
+            app.input = MockInput(realtime=True, pause=pause, on_input=replayer)
+            with open(log_path, "w") as f:
+                f.write(prefix)
+            with redirect_stdout(StringIO()):
+                app.get_game_state()
+            samples, actions = [], 0
+            for recorded, segments in turns:
+                replayer.segments = list(segments)
+                start = time.perf_counter()
+                with redirect_stdout(StringIO()):
+                    for kind, eid in recorded:
+                        app.poll_log()
+                        action, hand_size = replay_action(app, kind, eid)
+                        if closed_loop:
+                            assert app.execute_action(action, hand_size)
+                        else:
+                            app.perform_action(action, hand_size)
+                        actions += 1
+                    if not closed_loop:
+                        time.sleep(5)  # handle_state 中的 ACTION_SETTLE_DELAY
+                samples.append(time.perf_counter() - start)
+            replayer.join()
+            results[label] = samples
+            summarize(f"{label} 每回合", samples)
+
+        # 第一次拖拽没有生效：剩余操作还会盲点几次
+        with tempfile.TemporaryDirectory() as tmp:
+            app, log_path = make_replay_app(tmp, "http://127.0.0.1:9/v1", SPECULATIVE_PLANNING=False,
+                                            ACTION_CONFIRM_TIMEOUT=2.0)
+            replayer = LogReplayer(log_path)
+            replayer.drop = {1}
+            app.input = MockInput(realtime=True, on_input=replayer)
+            with open(log_path, "w") as f:
+                f.write(prefix)
+            recorded, segments = turns[0]
+            replayer.segments = list(segments)
+            with redirect_stdout(StringIO()):
+                app.get_game_state()
+                # 后续操作的下标依赖第一步的结果，这里只需要它们被执行 (或被拦下)
+                plan = {"actions": [replay_action(app, *recorded[0])[0]]
+                        + [{"type": kind, "attacker_index": 0, "target_type": "enemy_hero"} for kind, _ in recorded[1:]]}
+                if closed_loop:
+                    app.perform_mouse_actions(plan)
+                else:
+                    for action in plan["actions"]:
+                        app.perform_action(action)
+            replayer.join()
+            print(f"    {label}: 第 1 个操作没有生效后又执行了 {replayer.inputs - 1} 次拖拽/点击")
+    print(f"[*] {len(turns)} 个回合、{actions} 个操作；客户端响应延迟 0.3 s")
+
+
+def bench_inputs(args):
+    """输入后端：每次 move_to 的调用开销，以及用 MockInput 全速回放录制对局 (不等待鼠标动画和客户端)"""
+    import tempfile
+    from hearthstone_copilot import INPUT_BACKENDS, MockInput
+    from contextlib import redirect_stdout
+
+    for name, backend in INPUT_BACKENDS.items():
+        try:
+            driver = backend() if backend is MockInput else backend(pause=0.0)
+        except Exception as e:  # 没有显示器 / 不是 X11
+            print(f"[!] {name}: 不可用 ({type(e).__name__}: {e})")
+            continue
+        width, height = driver.size()
+        samples = []
+        for i in range(200):
+            start = time.perf_counter()
+            driver.move_to(width // 2 + i % 20, height // 2)
+            samples.append(time.perf_counter() - start)
+        summarize(f"{name} move_to", samples)
+
+    prefix, turns = record_turns(args.seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        app, log_path = make_replay_app(tmp, "http://127.0.0.1:9/v1", SPECULATIVE_PLANNING=False,
+                                        INPUT_BACKEND="mock", POST_CONFIRM_DELAY=0.0)
+        assert isinstance(app.input, MockInput) and not app.input.realtime
+        replayer = LogReplayer(log_path, latency=0.0)
+        app.input.on_input = replayer
+        with open(log_path, "w") as f:
+            f.write(prefix)
+        with redirect_stdout(StringIO()):
+            app.get_game_state()
+        samples = []
+        start_all = time.perf_counter()
+        for recorded, segments in turns:
+            replayer.segments = list(segments)
+            with redirect_stdout(StringIO()):
+                for kind, eid in recorded:
+                    app.poll_log()
+                    action, hand_size = replay_action(app, kind, eid)
+                    start = time.perf_counter()
+                    assert app.execute_action(action, hand_size)
+                    samples.append(time.perf_counter() - start)
+        total = time.perf_counter() - start_all
+    summarize("全速回放 每个操作 (输入 + 日志确认)", samples)
+    kinds = {}
+    for _, kind, _, _ in app.input.events:
+        kinds[kind] = kinds.get(kind, 0) + 1
+    print(f"[*] {len(turns)} 个回合、{len(samples)} 个操作共 {total:.3f} s；记录的输入事件 {kinds}")
+
+
+def trade_lethal_game(my_board, enemy_board, enemy_health):
+    """我方回合开始、双方场面为给定随从 [(攻击力, 生命值, 关键字)] 的对局 (生成器，日志从中取 lines)"""
+    game = _SyntheticGame(random.Random(0), [datetime(2026, 1, 31, 0, 43, 47)], max_turns=1, discover_every=0)
+    game.create_game()
+    game.mulligan()
+    game.tag("GameEntity", "TURN", 1)
+    game.tag(SYNTHETIC_PLAYERS[0], "CURRENT_PLAYER", 1)
+    game.tag(SYNTHETIC_PLAYERS[1], "CURRENT_PLAYER", 0)
+    game.tag("GameEntity", "STEP", "MAIN_ACTION")
+    for player, board in ((1, my_board), (2, enemy_board)):
+        for atk, health, keyword in board:
+            pos = len(game.zone_of(player, "PLAY")) + 1
+            eid = game.new_card(player, "PLAY", revealed=True)
+            game.entities[eid].update(type="MINION", card_id=SYNTHETIC_MINIONS[0][0], cost=1, atk=atk,
+                                      health=health, keyword=keyword, pos=pos)
+            game.power(f"FULL_ENTITY - Creating ID={eid} CardID={SYNTHETIC_MINIONS[0][0]}")
+            game.stat_tags(eid, 1)
+    game.damage(5, game.max_health - enemy_health)
+    game.flush_task_list()
+    return game
+
+
+def check_trade_lethal(tmp):
+    """场攻斩杀线先用 3/1 解 3/3 嘲讽 (攻击者阵亡、右侧随从左移)，再用 5/5、6/6 打脸：
+    local_plan 给出规划时的下标，PlanValidator 逐步换算后整条斩杀线都必须执行成功"""
+    from hearthstone_copilot import CardType, PlanValidator, Zone, local_plan
+
+    game = trade_lethal_game([(3, 1, ""), (5, 5, ""), (6, 6, "")], [(3, 3, "TAUNT")], enemy_health=11)
+    app, log_path = make_replay_app(tmp, "http://127.0.0.1:9/v1")
+    tracker = app.tracker
+    with open(log_path, "w", encoding="utf-8") as f:
+        f.write("".join(game.lines))
+    written = len(game.lines)
+    state = app.get_game_state()
+    plan = local_plan(state)
+    assert plan and len(plan["actions"]) == 3, plan
+    validator = PlanValidator(tracker)
+    pid = tracker.friendly_player_id
+    traded = []
+    for action in plan["actions"]:
+        checked, reason = validator.check(action)
+        assert reason is None, (action, reason)
+        attacker = tracker._zone_entities(pid, Zone.PLAY, CardType.MINION)[checked["attacker_index"]].id
+        target = 5
+        if checked["target_type"] == "minion":
+            target = tracker._zone_entities(3 - pid, Zone.PLAY, CardType.MINION)[checked["target_index"]].id
+            traded.append(attacker)
+        game.attack(attacker, target)
+        game.deaths()
+        game.flush_task_list()
+        with open(log_path, "a", encoding="utf-8") as f:
+            f.write("".join(game.lines[written:]))
+        written = len(game.lines)
+        app.poll_log()
+    assert [(game.entities[eid]["atk"], game.entities[eid]["zone"]) for eid in traded] == [(3, "GRAVEYARD")], traded
+    assert game.hero_health[2] <= 0, f"斩杀线没有打完，敌方英雄剩 {game.hero_health[2]} 血"
+    assert tracker.get_hero_state(3 - pid)["health"] <= 0
+    return plan["actions"]
+
+
+def turn_plan(app, recorded, segments):
+    """按回合开始时的局面写出整回合的计划 (模型看到的下标)
+
+    返回 [(操作, 日志段, 预期的实体)]，预期实体为 PLAY 的手牌 ID 或 ATTACK 的 (攻击者 ID, 目标 ID / "hero")。
+    合成日志里新打出的随从当回合就能攻击，这类攻击不会出现在模型的计划里，日志段并入前一个操作。
+    END_TURN 之前加入两个此时已不可执行的操作 (预期实体为 None)：已经攻击过的随从再次攻击、费用不够的手牌。
+    """
+    import re
+    from hearthstone_copilot import CardType, GameTag, Zone
+
+    tracker = app.tracker
+    pid = tracker.friendly_player_id
+    hand = [e.id for e in tracker._zone_entities(pid, Zone.HAND)]
+    mine = [e.id for e in tracker._zone_entities(pid, Zone.PLAY, CardType.MINION)]
+    enemy = [e.id for e in tracker._zone_entities(3 - pid, Zone.PLAY, CardType.MINION)]
+    target_re = re.compile(r"BlockType=ATTACK .* Target=\[entityName=\S+ id=(\d+)")
+    plan, played = [], set()
+    for (kind, eid), segment in zip(recorded, segments):
+        if kind == "ATTACK" and eid not in mine:
+            plan[-1] = (plan[-1][0], plan[-1][1] + segment, plan[-1][2])
+            continue
+        if kind == "PLAY_MINION":
+            played.add(eid)
+            plan.append(({"type": kind, "hand_index": hand.index(eid), "desc": f"打出 {eid}"}, segment, eid))
+        elif kind == "ATTACK":
+            target = int(target_re.search(segment).group(1))
+            action = {"type": kind, "attacker_index": mine.index(eid), "target_type": "enemy_hero", "desc": f"{eid} 攻击"}
+            if target in enemy:
+                action.update(target_type="minion", target_index=enemy.index(target))
+            plan.append((action, segment, (eid, target if target in enemy else "hero")))
+        else:
+            attacks = [action for action, _, _ in plan if action["type"] == "ATTACK"]
+            if attacks:
+                plan.append((dict(attacks[0], desc="再次攻击"), "", None))
+            costly = [i for i, card in enumerate(hand) if card not in played]
+            if costly:
+                cost = tracker._get_entity_by_id(hand[costly[0]]).tags.get(GameTag.COST, 0)
+                plan.append(({"type": "PLAY_MINION", "hand_index": costly[0], "desc": f"打出 ({cost} 费)"}, "", None))
+            plan.append(({"type": "END_TURN", "desc": "结束回合"}, segment, "end"))
+    return plan
+
+
+def acted_on(app, action):
+    """操作此刻实际作用的实体 (与 turn_plan 的预期实体格式相同)"""
+    from hearthstone_copilot import CardType, Zone
+
+    tracker = app.tracker
+    pid = tracker.friendly_player_id
+
+    def pick(player, zone, index, cardtype=None):
+        entities = tracker._zone_entities(player, zone, cardtype)
+        return entities[index].id if 0 <= index < len(entities) else None
+
+    kind = action.get("type")
+    if kind == "PLAY_MINION":
+        return pick(pid, Zone.HAND, action.get("hand_index", 0))
+    if kind == "ATTACK":
+        target = "hero"
+        if action.get("target_type") == "minion":
+            target = pick(3 - pid, Zone.PLAY, action.get("target_index", 0), CardType.MINION)
+        return pick(pid, Zone.PLAY, action.get("attacker_index", 0), CardType.MINION), target
+    return "end"
+
+
+def bench_validator(args):
+    """计划校验：按回合开始时的下标执行整回合计划，逐步按实体 ID 重映射并拦下已不可执行的操作 (回放录制日志)"""
+    import tempfile
+    from hearthstone_copilot import MockInput, PlanValidator
+    from contextlib import redirect_stdout
+
+    with tempfile.TemporaryDirectory() as tmp, redirect_stdout(StringIO()):
+        lethal = check_trade_lethal(tmp)
+    print("[*] 解嘲讽时攻击者阵亡的斩杀线 (规划时下标): "
+          + ", ".join(f"{a['attacker_index']}->{a.get('target_index', 'face')}" for a in lethal) + " 全部执行成功")
+
+    games = [record_turns(args.seed + n, max_turns=30, turns=6) for n in range(3)]
+    for label, validate in (("按原下标盲执行 (旧)", False), ("校验并重映射 (当前)", True)):
+        counts = dict(actions=0, correct=0, misplays=0, infeasible=0, rejected=0)
+        samples = []
+        for prefix, turns in games:
+            with tempfile.TemporaryDirectory() as tmp:
+                app, log_path = make_replay_app(tmp, "http://127.0.0.1:9/v1", SPECULATIVE_PLANNING=False,
+                                                ACTION_CONFIRM_TIMEOUT=1.0, POST_CONFIRM_DELAY=0.0)
+                replayer = LogReplayer(log_path, latency=0.0)
+                app.input = MockInput(on_input=replayer)
+                executed = []
+                perform = app.perform_action
+
+                def perform_action(action, hand_size=0):
+                    executed.append(acted_on(app, action))
+                    perform(action, hand_size)
+
+                app.perform_action = perform_action
+                with open(log_path, "w") as f:
+                    f.write(prefix)
+                with redirect_stdout(StringIO()):
+                    app.get_game_state()
+                for recorded, segments in turns:
+                    start = time.perf_counter()
+                    with redirect_stdout(StringIO()):
+                        app.poll_log()
+                        plan = turn_plan(app, recorded, segments)
+                        hand_size = len(app.tracker.get_my_hand())
+                        app.validator = PlanValidator(app.tracker) if validate else None
+                        for action, segment, intended in plan:
+                            app.poll_log()
+                            replayer.segments = [segment] if segment else []
+                            executed.clear()
+                            app.execute_action(action, hand_size)
+                            if segment and replayer.segments:  # 操作被拦下：日志照常推进 (重新决策后的操作)
+                                replayer._write(replayer.segments.pop())
+                            counts["actions"] += 1
+                            if not executed:
+                                counts["rejected"] += 1
+                            elif intended is None:
+                                counts["infeasible"] += 1
+                            elif executed[0] == intended:
+                                counts["correct"] += 1
+                            else:
+                                counts["misplays"] += 1
+                        app.validator = None
+                    samples.append(time.perf_counter() - start)
+        summarize(f"{label} 每回合", samples)
+        print(f"    {label}: {counts['actions']} 个操作 | 正确 {counts['correct']} | 点错对象 {counts['misplays']}"
+              f" | 无效输入 {counts['infeasible']} | 执行前拦下 {counts['rejected']}")
+    print(f"[*] {len(games)} 局、{sum(len(turns) for _, turns in games)} 个回合；"
+          "无效输入和点错对象都要等到确认超时 (ACTION_CONFIRM_TIMEOUT=1s)")
+
+
+def bench_replay(args):
+    """回放模式：录制日志按虚拟时钟分段写入，驱动完整决策循环 (模型桩 + mock 鼠标)；不同倍速下结果必须一致"""
+    import tempfile
+    from hearthstone_copilot import run_replay
+    from contextlib import redirect_stdout
+
+    with tempfile.TemporaryDirectory() as tmp:
+        recorded = os.path.join(tmp, "Power.log")
+        with open(recorded, "w", encoding="utf-8") as f:
+            f.write(generate_power_log(2, max_turns=14, seed=args.seed))
+        runs = {}
+        for label, speed in (("不等待 #1", 0.0), ("不等待 #2", 0.0), ("20 倍速", 20.0)):
+            out = StringIO()
+            start = time.perf_counter()
+            with redirect_stdout(out):
+                app = run_replay(recorded, speed, llm_latency=0.5, STREAMING=False)
+            elapsed = time.perf_counter() - start
+            events = [(round(t, 6), kind, x, y) for t, kind, x, y in app.input.events]
+            runs[label] = (events, app.router.backends[0].client.requests)
+            print(f"    {label:<10} 实际用时 {elapsed:6.2f} s | 虚拟时间 {app.clock.now:6.1f} s"
+                  f" | 模型请求 {runs[label][1]} 次 | 鼠标事件 {len(events)} 个")
+        report = out.getvalue()
+        print(report[report.index("[*] 回放结束"):].rstrip())
+    first = runs["不等待 #1"]
+    assert all(run == first for run in runs.values()), "回放结果与倍速有关"
+    print("[*] 三次回放的鼠标事件 (含虚拟时间戳) 和模型请求完全一致")
+
+
+HEAVY_MODULES = ("cv2", "numpy", "pyautogui", "tkinter", "openai", "requests", "hearthstone.cardxml")
+
+IMPORT_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+for name in sys.argv[1:]:
+    try:
+        __import__(name)
+    except Exception as e:  # pyautogui 在无显示器环境下 import 即失败
+        print(f"SKIP {name} {type(e).__name__}")
+import hearthstone_copilot
+elapsed = time.perf_counter() - start
+loaded = [m for m in %r if m in sys.modules]
+print(f"RESULT {elapsed} {','.join(loaded)}")
+""" % (HEAVY_MODULES,)
+
+HEADLESS_SCRIPT = """
+import json, os, sys, tempfile
+from hearthstone_copilot import HearthstoneAutoPilot
+with tempfile.TemporaryDirectory() as tmp:
+    config = os.path.join(tmp, "config.json")
+    with open(config, "w") as f:
+        json.dump({"LOG_PATH": os.path.join(tmp, "Power.log"), "API_KEY": "", "BASE_URL": ""}, f)
+    app = HearthstoneAutoPilot(config_path=config, headless=True)
+    app.perform_mouse_actions({"actions": [{"type": "END_TURN"}, {"type": "CHOOSE", "index": 0}]}, hand_size=3)
+loaded = [m for m in %r if m in sys.modules]
+print(f"RESULT {','.join(loaded)}")
+""" % (HEAVY_MODULES,)
+
+
+def run_script(script, *argv, env=None):
+    out = subprocess.run(
+        [sys.executable, "-c", script, *argv],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True, text=True, check=True, env=env,
+    ).stdout
+    return next(l for l in out.splitlines() if l.startswith("RESULT")).split()[1:]
+
+
+def bench_imports(args):
+    """import hearthstone_copilot 的耗时：延迟加载 vs 启动时导入全部重量级模块"""
+    eager_modules = ["cv2", "numpy", "pyautogui", "requests", "tkinter", "openai", "hearthstone.cardxml"]
+    for label, preload in (("延迟加载 (当前)", []), ("全部预先导入 (旧)", eager_modules)):
+        samples, loaded = [], ""
+        for _ in range(5):
+            result = run_script(IMPORT_SCRIPT, *preload)
+            samples.append(float(result[0]))
+            loaded = result[1] if len(result) > 1 else ""
+        print(f"    {label:<20} 中位数 {statistics.median(samples) * 1000:7.1f} ms  已加载: {loaded or '-'}")
+        if not preload:
+            assert not loaded, f"导入 tracker 时不应加载重量级模块: {loaded}"
+
+    # headless: 去掉 DISPLAY 和桩模块路径，确认不需要显示器、不加载 GUI/视觉/输入模块
+    env = {k: v for k, v in os.environ.items() if k not in ("DISPLAY", "PYTHONPATH")}
+    result = run_script(HEADLESS_SCRIPT, env=env)
+    loaded = result[0] if result else ""
+    print(f"[*] headless 模式 (无 DISPLAY) 构造 HearthstoneAutoPilot 并执行操作: 已加载 {loaded or '-'}")
+    assert not loaded, f"headless 模式不应加载: {loaded}"
+
+
+BENCHMARKS = {
+    "parse": bench_parse,
+    "memory": bench_memory,
+    "startup": bench_startup,
+    "tail": bench_tail,
+    "snapshot": bench_snapshot,
+    "cardtext": bench_cardtext,
+    "cardcache": bench_cardcache,
+    "imports": bench_imports,
+    "postparse": bench_postparse,
+    "deck": bench_deck,
+    "llm": bench_llm,
+    "stream": bench_stream,
+    "decisions": bench_decisions,
+    "prompt": bench_prompt,
+    "speculative": bench_speculative,
+    "backends": bench_backends,
+    "fastpath": bench_fastpath,
+    "combat": bench_combat,
+    "evaluator": bench_evaluator,
+    "vision": bench_vision,
+    "locator": bench_locator,
+    "executor": bench_executor,
+    "inputs": bench_inputs,
+    "validator": bench_validator,
+    "replay": bench_replay,
+}
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="ai-hearthstone 性能基准测试")
+    ap.add_argument("names", nargs="*", help="要运行的基准 (默认全部)")
+    ap.add_argument("--list", action="store_true", help="列出可用基准")
+    ap.add_argument("--games", type=int, default=3, help="合成日志包含的对局数")
+    ap.add_argument("--chunk-lines", type=int, default=100, help="每次轮询读取的行数")
+    ap.add_argument("--seed", type=int, default=0, help="合成日志随机种子")
+    ap.add_argument("--log-sizes", type=int, nargs="+", default=[10, 100], help="startup 基准使用的日志大小 (MB)")
+    ap.add_argument("--skip-full-replay", action="store_true", help="startup 基准不运行从头重放对照组")
+    args = ap.parse_args(argv)
+
+    if args.list:
+        for name, func in BENCHMARKS.items():
+            print(f"{name:<12} {func.__doc__}")
+        return
+
+    names = args.names or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            sys.exit(f"[!] 未知基准: {name}")
+        print(f"\n=== {name}: {BENCHMARKS[name].__doc__} ===")
+        BENCHMARKS[name](args)
+
+
+if __name__ == "__main__":
+    main()
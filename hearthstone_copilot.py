@@ -1,74 +1,544 @@
-import cv2
-import numpy as np
 import time
 import os
+import re
+import sys
+import gc
 import json
-import pyautogui  # pip install pyautogui
-import requests
+import mmap
+import marshal
+import codecs
+import select
+import struct
+import ctypes
+import ctypes.util
+import hashlib
+import importlib
+import queue
+import tempfile
 import threading
-import tkinter as tk
-from io import StringIO
-from openai import OpenAI
+import contextlib
+from collections import Counter, OrderedDict
 
 # python-hslog 库用于解析炉石日志
 from hslog import LogParser
+from hslog import packets as hs_packets
 from hslog.export import EntityTreeExporter, FriendlyPlayerExporter
-from hearthstone.enums import GameTag, Zone, CardType, Mulligan, Step, BlockType, CardClass
-from hearthstone import cardxml
+from hearthstone.enums import GameTag, Zone, CardType, Mulligan, Step, BlockType, CardClass, State
+from importlib.metadata import version as package_version, PackageNotFoundError
+from hearthstone.entities import Card
 from hearthstone.deckstrings import parse_deckstring
 
 
+class LazyModule:
+    """模块代理：第一次访问属性时才真正 import
+
+    cv2 / numpy / pyautogui / tkinter / requests 只在视觉校验、鼠标操作、悬浮窗和调用模型时才需要。
+    只使用 GameStateTracker 做离线日志分析时不会加载它们；pyautogui 在没有显示器的机器上
+    import 即报错，延迟加载后 headless 模式也能正常运行。
+    """
+
+    def __init__(self, name):
+        object.__setattr__(self, "_name", name)
+        object.__setattr__(self, "_module", None)
+
+    def _load(self):
+        module = self._module
+        if module is None:
+            module = importlib.import_module(self._name)
+            object.__setattr__(self, "_module", module)
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+
+cv2 = LazyModule("cv2")
+np = LazyModule("numpy")
+pyautogui = LazyModule("pyautogui")  # pip install pyautogui
+requests = LazyModule("requests")
+tk = LazyModule("tkinter")
+
+
+CREATE_GAME_MARKER = b"GameState.DebugPrintPower() - CREATE_GAME"
+
+
+def find_last_game_offset(log_path):
+    """从文件末尾向前查找最后一个 CREATE_GAME，返回其所在行的字节偏移 (找不到返回 0)
+
+    使用 mmap 反向搜索，不需要把整个 Power.log 读进内存，耗时与文件大小基本无关。
+    """
+    try:
+        with open(log_path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return 0
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                pos = mm.rfind(CREATE_GAME_MARKER)
+                if pos < 0:
+                    return 0
+                return mm.rfind(b"\n", 0, pos) + 1
+    except (OSError, ValueError) as e:
+        print(f"[!] 定位最后一局失败，将从头读取: {e}")
+        return 0
+
+
+class _InotifyWatch:
+    """Linux inotify 封装 (ctypes 直接调用 libc)：监视日志所在目录中指定文件的变化"""
+
+    IN_MODIFY = 0x00000002
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    EVENT_HEADER = struct.Struct("iIII")
+
+    def __init__(self, log_path):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.filename = os.fsencode(os.path.basename(log_path))
+        directory = os.path.dirname(os.path.abspath(log_path))
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 失败")
+        mask = self.IN_MODIFY | self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), mask) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch 失败: {directory}")
+
+    def wait(self, timeout):
+        """阻塞直到日志文件有变化或超时，返回是否有相关事件"""
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            ready, _, _ = select.select([self.fd], [], [], remaining)
+            if not ready:
+                return False
+            if self._drain():
+                return True
+
+    def _drain(self):
+        """读出所有排队的事件，只关心目标文件名"""
+        relevant = False
+        while True:
+            try:
+                buf = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return relevant
+            offset = 0
+            while offset + self.EVENT_HEADER.size <= len(buf):
+                _, _, _, name_len = self.EVENT_HEADER.unpack_from(buf, offset)
+                offset += self.EVENT_HEADER.size
+                name = buf[offset:offset + name_len].rstrip(b"\0")
+                offset += name_len
+                if name == self.filename:
+                    relevant = True
+
+    def close(self):
+        os.close(self.fd)
+
+
+class LogTailer:
+    """持续跟踪 Power.log 的新增内容
+
+    文件句柄保持打开，不再每次轮询都重新打开文件；Linux 上用 inotify 等待写入事件，
+    其他平台退化为 stat 检查 + 自适应退避 (有新数据时 10ms，空闲时逐步放宽到 100ms)。
+    客户端重启导致的日志截断或替换 (轮换) 会被检测到：旧文件剩余的内容先读完，再从新文件开头继续读取。
+    """
+
+    MIN_BACKOFF = 0.01
+    MAX_BACKOFF = 0.1
+
+    def __init__(self, log_path, start_offset=0, on_reset=None, use_inotify=True):
+        self.log_path = log_path
+        self.position = start_offset
+        self.on_reset = on_reset  # 日志被截断/替换时回调
+        self._file = None
+        self._inode = None
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        self._backoff = self.MIN_BACKOFF
+        self._rotated = None  # 已检测到轮换但旧文件还有内容没读完时为原因，下次读取再切换
+        self._watch = None
+        if use_inotify and sys.platform.startswith("linux"):
+            try:
+                self._watch = _InotifyWatch(log_path)
+            except OSError as e:
+                print(f"[!] inotify 不可用，改用轮询: {e}")
+
+    @property
+    def backend(self):
+        return "inotify" if self._watch else "poll"
+
+    def _open(self):
+        try:
+            self._file = open(self.log_path, "rb")
+        except OSError:
+            self._file = None
+            return False
+        self._inode = os.fstat(self._file.fileno()).st_ino
+        self._file.seek(self.position)
+        return True
+
+    def _reopen_from_start(self, reason):
+        print(f"[*] 检测到日志{reason}，从头开始读取新日志")
+        if self._file:
+            self._file.close()
+        self._file = None
+        self.position = 0
+        self._decoder.reset()
+        if self.on_reset:
+            self.on_reset()
+
+    def _check_rotation(self):
+        """当前句柄对应的文件被替换时返回 "轮换"，被截断时返回 "截断"，否则返回 False"""
+        try:
+            st = os.stat(self.log_path)
+        except OSError:
+            return False  # 文件暂时不存在 (客户端正在重建)，继续读旧句柄
+        if st.st_ino != self._inode:
+            return "轮换"
+        if st.st_size < self.position:
+            return "截断"
+        return False
+
+    def read(self):
+        """读取自上次以来新增的文本 (可能以不完整的行结尾)"""
+        if self._file is None and not self._open():
+            return ""
+
+        data = self._file.read()
+        reason = self._rotated or self._check_rotation()
+        if reason and data:
+            # 旧文件剩余的内容属于旧对局，要在 on_reset 之前解析：先返回，下次读取时再切换到新文件
+            self._rotated = reason
+        elif reason:
+            self._rotated = None
+            self._reopen_from_start(reason)
+            if not self._open():
+                return ""
+            data = self._file.read()
+
+        if not data:
+            return ""
+        self.position = self._file.tell()
+        self._backoff = self.MIN_BACKOFF
+        return self._decoder.decode(data)
+
+    def wait(self, timeout=1.0):
+        """等待日志出现新内容或超时"""
+        if self._rotated:
+            return True  # 还没切换到新文件
+        if self._watch:
+            return self._watch.wait(timeout)
+
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                st = os.stat(self.log_path)
+                if st.st_size != self.position or st.st_ino != self._inode:
+                    return True
+            except OSError:
+                pass
+            time.sleep(min(self._backoff, max(0.0, deadline - time.monotonic())))
+            self._backoff = min(self._backoff * 2, self.MAX_BACKOFF)
+        return False
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+        if self._watch:
+            self._watch.close()
+            self._watch = None
+
+
+class IncrementalEntityTreeExporter(EntityTreeExporter):
+    """增量导出器：记住上次导出到的位置，每次只把新增的 packet 应用到同一个 Game 实体树
+
+    hslog 自带的 export() 每次都从头遍历整棵 PacketTree，这里改为游标式推进，
+    单次调用的开销只与新增 packet 数量有关，与对局长度无关。
+    """
+
+    # 这些 packet 在首行之后还会继续追加 tag/选项等内容，位于最末尾时需等待后续行
+    MULTILINE_PACKETS = (
+        hs_packets.CreateGame, hs_packets.FullEntity, hs_packets.ShowEntity,
+        hs_packets.ChangeEntity, hs_packets.MetaData, hs_packets.Choices,
+        hs_packets.SendChoices, hs_packets.ChosenEntities, hs_packets.Options,
+    )
+    CONTAINER_PACKETS = (hs_packets.Block, hs_packets.SubSpell)
+
+    # 决定实体归属索引的 tag
+    INDEX_TAGS = (GameTag.CONTROLLER, GameTag.ZONE, GameTag.CARDTYPE)
+
+    def __init__(self, packet_tree):
+        super().__init__(packet_tree)
+        # 游标栈: [容器, 下一个待导出的下标]，容器为 PacketTree / Block / SubSpell
+        self._cursor = [[packet_tree, 0]]
+        self._friendly_exporter = FriendlyPlayerExporter(packet_tree)
+        self.friendly_player = None
+        # (controller, zone) -> {cardtype -> {entity_id: entity}}，随 packet 应用增量维护
+        self.zone_index = {}
+        self._index_keys = {}  # entity_id -> (controller, zone, cardtype)
+        self.pending_packet = None  # 因可能未读完而暂缓导出的末尾多行 packet
+
+    def _reindex(self, entity):
+        """根据实体当前的 CONTROLLER/ZONE/CARDTYPE 更新索引"""
+        if entity is None:
+            return
+        tags = entity.tags
+        key = (tags.get(GameTag.CONTROLLER, 0), tags.get(GameTag.ZONE, Zone.INVALID),
+               tags.get(GameTag.CARDTYPE, CardType.INVALID))
+        old_key = self._index_keys.get(entity.id)
+        if old_key == key:
+            return
+        if old_key is not None:
+            self.zone_index[old_key[:2]][old_key[2]].pop(entity.id, None)
+        self.zone_index.setdefault(key[:2], {}).setdefault(key[2], {})[entity.id] = entity
+        self._index_keys[entity.id] = key
+
+    def _rebuild_index(self):
+        self.zone_index = {}
+        self._index_keys = {}
+        for entity in self.game.entities:
+            if isinstance(entity, Card):
+                self._reindex(entity)
+
+    def entities_in(self, controller, zone, cardtype=None):
+        """返回指定控制者/区域 (可选卡牌类型) 的实体列表，开销只与该区域大小有关"""
+        by_type = self.zone_index.get((controller, zone))
+        if not by_type:
+            return []
+        if cardtype is not None:
+            return list(by_type.get(cardtype, {}).values())
+        return [e for entities in by_type.values() for e in entities.values()]
+
+    def controlled_by(self, controller):
+        """返回指定控制者的全部实体 (按区域分组遍历，无需逐个解析 controller)"""
+        return [e for (owner, _), by_type in self.zone_index.items() if owner == controller
+                for entities in by_type.values() for e in entities.values()]
+
+    def handle_full_entity(self, packet):
+        entity = super().handle_full_entity(packet)
+        self._reindex(entity)
+        return entity
+
+    def handle_show_entity(self, packet):
+        entity = super().handle_show_entity(packet)
+        self._reindex(entity)
+        return entity
+
+    def handle_change_entity(self, packet):
+        entity = super().handle_change_entity(packet)
+        self._reindex(entity)
+        return entity
+
+    def handle_tag_change(self, packet):
+        entity = super().handle_tag_change(packet)
+        if packet.tag in self.INDEX_TAGS and isinstance(entity, Card):
+            self._reindex(entity)
+        return entity
+
+    def advance(self):
+        """导出自上次调用以来新增(且已完整)的 packet，返回本次导出的 packet 列表"""
+        exported = []
+        self.pending_packet = None
+        while self._cursor:
+            node, index = self._cursor[-1]
+            node_open = not getattr(node, "ended", False)
+
+            if index >= len(node.packets):
+                # 容器尚未结束 (BLOCK_END 未到)，等待后续日志
+                if node_open or len(self._cursor) == 1:
+                    break
+                self._cursor.pop()
+                continue
+
+            packet = node.packets[index]
+            if isinstance(packet, self.CONTAINER_PACKETS):
+                self._cursor[-1][1] += 1
+                if isinstance(packet, hs_packets.Block) and packet.type == BlockType.GAME_RESET:
+                    self.game.reset()
+                    self._rebuild_index()
+                self._cursor.append([packet, 0])
+                continue
+
+            # 最末尾的多行 packet 可能还没读完 tag，留到下次再导出
+            if node_open and index == len(node.packets) - 1 and isinstance(packet, self.MULTILINE_PACKETS):
+                self.pending_packet = packet
+                break
+
+            self._cursor[-1][1] += 1
+            try:
+                self.export_packet(packet)
+            except Exception as e:
+                print(f"[!] 导出 packet 出错 ({type(packet).__name__}): {e}")
+            exported.append(packet)
+
+            if self.friendly_player is None:
+                try:
+                    self._friendly_exporter.export_packet(packet)
+                    self.friendly_player = self._friendly_exporter.friendly_player
+                except Exception:
+                    pass
+
+        return exported
+
+
+# 卡牌数据库缓存：只保存本工具用到的字段，避免每次启动都解析完整的 CardDefs.xml
+CARD_CACHE_DIR = os.path.join(
+    os.environ.get("LOCALAPPDATA") or os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+    "ai-hearthstone",
+)
+CARD_CACHE_MAGIC = b"HSCD"
+CARD_CACHE_FORMAT = 1
+CARD_CACHE_HEADER = struct.Struct("<4sHH")  # magic, 格式版本, 缓存键长度
+# 作为 mechanics 保存的关键词标签
+CARD_MECHANIC_TAGS = (
+    GameTag.TAUNT, GameTag.DIVINE_SHIELD, GameTag.CHARGE, GameTag.RUSH, GameTag.WINDFURY,
+    GameTag.STEALTH, GameTag.POISONOUS, GameTag.LIFESTEAL, GameTag.REBORN, GameTag.FREEZE,
+    GameTag.BATTLECRY, GameTag.DEATHRATTLE, GameTag.DISCOVER, GameTag.SECRET, GameTag.COMBO,
+    GameTag.OVERLOAD, GameTag.SPELLPOWER, GameTag.ELUSIVE, GameTag.CANT_ATTACK,
+)
+
+# 缓存中以整数保存枚举，加载时查表还原 (比逐个调用 CardType(...) 快得多)
+_CARD_TYPES = {int(t): t for t in CardType}
+_CARD_CLASSES = {int(c): c for c in CardClass}
+
+
+class CardRecord:
+    """卡牌数据库条目 (cardxml.CardXML 的精简版，只包含本工具用到的字段)"""
+
+    __slots__ = ("id", "dbf_id", "name", "description", "cost", "type", "card_class", "mechanics")
+
+    def __init__(self, id, dbf_id, name, description, cost, type, card_class, mechanics):
+        self.id = id
+        self.dbf_id = dbf_id
+        self.name = name
+        self.description = description
+        self.cost = cost
+        self.type = _CARD_TYPES.get(type, type)
+        self.card_class = _CARD_CLASSES.get(card_class, card_class)
+        self.mechanics = mechanics
+
+    @classmethod
+    def from_xml(cls, card):
+        mechanics = tuple(int(tag) for tag in CARD_MECHANIC_TAGS if card.tags.get(tag))
+        return cls(card.id, card.dbf_id, card.name, card.description or "", card.cost,
+                   int(card.type), int(card.card_class), mechanics)
+
+    def to_row(self):
+        return (self.id, self.dbf_id, self.name, self.description, self.cost,
+                int(self.type), int(self.card_class), self.mechanics)
+
+    def has_mechanic(self, tag):
+        return int(tag) in self.mechanics
+
+
+def card_cache_key(locale):
+    """缓存键：hearthstone / hearthstone_data 版本 + 语言，任一变化都会使缓存失效"""
+    versions = []
+    for dist in ("hearthstone", "hearthstone_data"):
+        try:
+            versions.append(package_version(dist))
+        except PackageNotFoundError:
+            versions.append("?")
+    return "|".join(versions + [locale, str(CARD_CACHE_FORMAT)])
+
+
+def _read_card_cache(path, key):
+    """读取缓存文件，键不匹配或文件损坏时返回 None"""
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except OSError:
+        return None
+    try:
+        magic, fmt, key_len = CARD_CACHE_HEADER.unpack_from(data)
+        offset = CARD_CACHE_HEADER.size
+        if magic != CARD_CACHE_MAGIC or fmt != CARD_CACHE_FORMAT:
+            return None
+        if data[offset:offset + key_len].decode("utf-8") != key:
+            return None
+        # 一次性创建数万个对象，期间暂停循环垃圾回收 (这些对象不会成环)
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            rows = marshal.loads(data[offset + key_len:])
+            return {row[0]: CardRecord(*row) for row in rows}
+        finally:
+            if gc_was_enabled:
+                gc.enable()
+    except (struct.error, ValueError, EOFError, TypeError, UnicodeDecodeError) as e:
+        print(f"[!] 卡牌缓存已损坏，将重新生成: {e}")
+        return None
+
+
+def _write_card_cache(path, key, card_db):
+    """先写临时文件再替换，避免中途退出留下半个缓存"""
+    key_bytes = key.encode("utf-8")
+    payload = marshal.dumps([card.to_row() for card in card_db.values()])
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp_path, "wb") as f:
+            f.write(CARD_CACHE_HEADER.pack(CARD_CACHE_MAGIC, CARD_CACHE_FORMAT, len(key_bytes)))
+            f.write(key_bytes)
+            f.write(payload)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"[!] 写入卡牌缓存失败 (不影响运行): {e}")
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+
+def load_card_db(locale="zhCN", cache_dir=CARD_CACHE_DIR):
+    """加载卡牌数据库 {card_id: CardRecord}
+
+    优先读取磁盘缓存；缓存不存在、版本/语言不匹配或已损坏时解析 CardDefs.xml 并重建缓存。
+    cache_dir 为 None 时不使用缓存。
+    """
+    key = card_cache_key(locale)
+    path = os.path.join(cache_dir, f"cards_{locale}.bin") if cache_dir else None
+    if path:
+        card_db = _read_card_cache(path, key)
+        if card_db is not None:
+            return card_db
+
+    from hearthstone import cardxml  # 只在重建缓存时需要 (导入本身就要 0.1 秒以上)
+    xml_db, _ = cardxml.load(locale=locale)
+    card_db = {card_id: CardRecord.from_xml(card) for card_id, card in xml_db.items()}
+    if path:
+        _write_card_cache(path, key, card_db)
+    return card_db
+
+
+# 卡牌描述中的排版标记 (<b>/<i>、[x]、换行) 一次性清理
+CARD_MARKUP_RE = re.compile(r"</?[bi]>|\[x\]|\\n|\n")
+# $N: 受法术伤害加成影响的数值；#N: 受治疗加成影响的数值
+CARD_PLACEHOLDER_RE = re.compile(r"([$#])(\d+)")
+
+
 class GameStateTracker:
     """使用 python-hslog 库解析炉石日志并追踪游戏状态"""
     
-    def __init__(self):
+    def __init__(self, card_cache_dir=CARD_CACHE_DIR):
         print("[*] 正在加载炉石卡牌数据库 (zhCN)...")
         try:
-            self.card_db, _ = cardxml.load(locale="zhCN")
+            self.card_db = load_card_db(locale="zhCN", cache_dir=card_cache_dir)
             print(f"[*] 卡牌数据库加载完成: {len(self.card_db)} 张卡牌")
-            # 建立 DBID 到卡牌对象的映射
-            self.dbid_map = {c.dbf_id: c for c in self.card_db.values()}
         except Exception as e:
             print(f"[!] 加载卡牌数据库失败: {e}")
             self.card_db = {}
-            
-        self.reset()
-
-# ... (omitted methods) ...
+        # 建立 DBID 到卡牌对象的映射
+        self.dbid_map = {c.dbf_id: c for c in self.card_db.values()}
 
-    def get_hero_state(self, player_id):
-        """获取指定玩家的英雄状态 (包含中文描述和职业)"""
-        if not self.game:
-            return {"health": 30, "armor": 0, "atk": 0, "name": "Unknown", "class": "UNKNOWN"}
-            
-        player = self.game.players[player_id - 1]
-        hero = None
-        for e in player.entities:
-            if e.tags.get(GameTag.ZONE) == Zone.PLAY and e.tags.get(GameTag.CARDTYPE) == CardType.HERO:
-                hero = e
-                break
-                
-        if not hero:
-            return {"health": 0, "armor": 0, "atk": 0, "name": "Unknown", "class": "UNKNOWN"}
-            
-        tags = hero.tags
-        card_info = self.get_card_data(hero.card_id)
-        
-        # 获取职业
-        class_enum = tags.get(GameTag.CLASS, 0)
-        try:
-            class_name = CardClass(class_enum).name
-        except:
-            class_name = "UNKNOWN"
-        
-        return {
-            "name": card_info["name"],
-            "text": card_info["text"],
-            "health": tags.get(GameTag.HEALTH, 30) - tags.get(GameTag.DAMAGE, 0),
-            "armor": tags.get(GameTag.ARMOR, 0),
-            "atk": tags.get(GameTag.ATK, 0),
-            "class": class_name
-        }
+        self._card_data_cache = {}  # card_id -> 清理后的卡牌信息
+        self._spell_text_cache = {}  # card_id -> 带 $N 占位符的原始描述 (只有受法术伤害影响的卡牌)
+        self.reset()
 
 # ... (omitted methods) ...
 
@@ -151,14 +621,47 @@ class GameStateTracker:
         
     def reset(self):
         """重置游戏状态"""
-        self.parser = LogParser()
+        self._partial_line = ""    # 上次读取末尾不完整的一行
+        self.deck_code_list = []  # 从 Deck Code 解析出的完整列表 (带描述)
+        self.deck_code_counts = Counter()  # card_id -> 套牌中的张数
+        self._deck_code_entries = []  # [(card_id, "名称: 描述")]，按描述文本排序 (与 deck_code_list 顺序一致)
+        self.games_finished = 0    # 本次会话已丢弃的对局数
+        self._start_new_game()
+
+    def on_log_rotated(self):
+        """日志文件被截断或替换 (客户端重启)：旧对局不会再有后续内容"""
+        self._partial_line = ""
+        self._start_new_game()
+
+    def _start_new_game(self):
+        """丢弃上一局的全部解析状态 (解析器、实体树、已揭示卡牌)
+
+        每局使用独立的 LogParser，内存占用只与当前对局的大小有关，
+        不会随着一次会话中的对局数增长。
+        """
+        self.parser = LogParser()  # 长期存活的解析器，只喂新增行
+        self._exporter = None      # 当前对局的增量导出器
         self.game = None
         self.friendly_player_id = None
         self.current_choices = []
-        self._log_buffer = ""  # 累积日志缓冲区
         self._revealed_cards = {} # 记忆已揭示的实体 ID -> CardID
-        self.initial_deck = []    # 初始套牌列表 (开局即确定)
-        self.deck_code_list = []  # 从 Deck Code 解析出的完整列表 (带描述)
+        # 由 _visit_packets 增量维护的 packet 状态
+        self._turn = 0                # 最近一次 GameEntity TURN 变化
+        self._last_choices = None     # 最后一个 Choices packet
+        self._choices_turn = -1       # 产生该 Choices 时的回合
+        self._choices_answered = False  # 之后是否出现过 SendChoices
+        self._announced_choices = None
+        # 牌库追踪：开局时位于牌库的实体离开己方牌库后，按 card_id 计入 _left_deck_counts；
+        # 对局中才进入己方牌库的实体 (洗入的复制等) 在牌库中时按 card_id 计入 _added_deck_counts
+        self._deck_origin = {}          # 开局时 ZONE=DECK 的实体 ID -> 创建时的 CONTROLLER
+        self._deck_sealed = False       # 已进入第一个 MAIN 步骤：之后在牌库中创建的实体不属于初始套牌
+        self._left_deck = {}            # 已离开己方牌库的实体 ID -> card_id
+        self._left_deck_counts = Counter()
+        self._added_deck = {}           # 对局中进入且仍在己方牌库的实体 ID -> card_id (未知时为空字符串)
+        self._added_deck_counts = Counter()
+        self._dirty_entities = set()    # 本次轮询 ZONE/CONTROLLER/CardID 有变化的实体
+        self._deck_tracked_player = None
+        self.initial_deck = self.deck_code_list  # 初始套牌列表 (开局即确定)
 
     def apply_deck_code(self, deck_code: str):
         """解析套牌代码并预填充初始套牌信息"""
@@ -171,6 +674,8 @@ class GameStateTracker:
             cards = result[0]
             
             full_list = []
+            counts = Counter()
+            entries = []
             for dbid, count in cards:
                 card_obj = self.dbid_map.get(dbid)
                 if card_obj:
@@ -179,8 +684,13 @@ class GameStateTracker:
                     item = f"{card_info['name']}: {card_info['text']}"
                     for _ in range(count):
                         full_list.append(item)
+                    if card_obj.id not in counts:
+                        entries.append((card_obj.id, item))
+                    counts[card_obj.id] += count
             
             self.deck_code_list = sorted(full_list)
+            self.deck_code_counts = counts
+            self._deck_code_entries = sorted(entries, key=lambda entry: entry[1])
             # 如果目前没有 initial_deck，先用这个占位
             if not self.initial_deck:
                 self.initial_deck = self.deck_code_list
@@ -190,144 +700,212 @@ class GameStateTracker:
         
     def process_log_chunk(self, content: str):
         """解析日志块，更新实体状态
-        
-        hslog 设计用于解析完整日志文件，因此我们采用累积缓冲区策略：
-        将新内容追加到缓冲区，每次重新解析整个缓冲区。
+
+        采用增量策略：同一个 LogParser 只读取新增的完整行，
+        再由 IncrementalEntityTreeExporter 把新增 packet 应用到已有的 Game 实体树上。
         """
         if not content:
             return
-            
-        # 累积日志内容
-        self._log_buffer += content
-        
+
+        lines = (self._partial_line + content).splitlines(keepends=True)
+        # 末尾没有换行符的行可能还没写完，留到下一次
+        self._partial_line = ""
+        if lines and not lines[-1].endswith(("\n", "\r")):
+            self._partial_line = lines.pop()
+
+        for line in lines:
+            if not line.strip():
+                continue
+            if self.parser.games and "GameState.DebugPrintPower() - CREATE_GAME" in line:
+                # 新对局开始：上一局移出内存
+                self.games_finished += 1
+                self._start_new_game()
+            try:
+                self.parser.read_line(line)
+            except Exception as e:
+                print(f"[!] hslog 解析出错: {e}")
+
+        self._update_from_parser()
+
+    def _update_from_parser(self):
+        """把解析器中新增的 packet 应用到实体树，并更新选择项等派生状态"""
         try:
-            # 使用 hslog 解析器读取累积的日志
-            self.parser = LogParser()  # 每次创建新解析器
-            self.parser.read(StringIO(self._log_buffer))
-            
             # 如果有游戏，导出当前状态（总是导出最后一个游戏）
             if self.parser.games:
                 packet_tree = self.parser.games[-1]
-                exporter_result = packet_tree.export()
-                # export() 返回 EntityTreeExporter，真正的 Game 对象在 .game 属性中
-                self.game = exporter_result.game if hasattr(exporter_result, 'game') else exporter_result
-                
+                if self._exporter is None or self._exporter.packet_tree is not packet_tree:
+                    # 出现新的 CREATE_GAME，为新对局创建导出器
+                    self._exporter = IncrementalEntityTreeExporter(packet_tree)
+                new_packets = self._exporter.advance()
+                self.game = self._exporter.game
+
                 # 检测友方玩家（每个新游戏都需要重新检测）
-                exporter = FriendlyPlayerExporter(packet_tree)
-                result = exporter.export()
-                if result:
-                    self.friendly_player_id = result
-                
+                if self._exporter.friendly_player:
+                    self.friendly_player_id = self._exporter.friendly_player
+
+                # 只访问本次新增的 packet：已揭示卡牌、Choices/SendChoices、回合数
+                self._visit_packets(new_packets)
+                # 等待玩家选择时 Choices 正是日志的最后一个 packet，会被导出器暂缓，这里提前访问
+                # (各处理函数都是幂等的，下次正式导出时再访问一遍不影响结果)
+                pending = self._exporter.pending_packet
+                if pending is not None:
+                    self._visit_packets((pending,))
+                self._update_deck_tracking()
+
                 # 提取当前选择项（发现/抉择）
-                self._extract_choices(packet_tree)
+                self._extract_choices()
 
-                # [NEW] 遍历所有包，更新已揭示的实体信息
-                self._update_revealed_cache(packet_tree)
-                
                 # [NEW] 如果初始套牌还没记录，记录一下
                 if not self.initial_deck:
                     # 开局时获取带有完整描述的列表
                     current_deck = self.get_my_deck(include_details=True)
-                    if len(current_deck) > 20: 
+                    if len(current_deck) > 20:
                         self.initial_deck = current_deck
-                        
+
         except Exception as e:
             print(f"[!] hslog 解析出错: {e}")
-    
-    def _extract_choices(self, packet_tree):
-        """从 PacketTree 中提取当前的选择项"""
+
+    def _visit_packets(self, packets):
+        """单次遍历新导出的 packet，按类型分派 (导出器已展开 Block/SubSpell，这里只有叶子 packet)"""
+        handlers = self.PACKET_HANDLERS
+        for packet in packets:
+            handler = handlers.get(type(packet))
+            if handler is not None:
+                handler(self, packet)
+
+    def _on_tag_change(self, packet):
+        # 检测回合切换 (TagChange: Entity=1 (Game), Tag=TURN)
+        if packet.tag == GameTag.TURN and packet.entity == 1:
+            self._turn = packet.value
+        elif packet.tag == GameTag.STEP and packet.entity == 1 and packet.value == Step.MAIN_READY:
+            self._deck_sealed = True
+        elif packet.tag in (GameTag.ZONE, GameTag.CONTROLLER):
+            self._dirty_entities.add(packet.entity)
+
+    def _on_entity_revealed(self, packet):
+        # 记录 FullEntity 和 ShowEntity 中的 CardID
+        if packet.card_id:
+            self._revealed_cards[packet.entity] = packet.card_id
+        self._dirty_entities.add(packet.entity)
+
+    def _on_change_entity(self, packet):
+        self._dirty_entities.add(packet.entity)
+
+    def _on_full_entity(self, packet):
+        self._on_entity_revealed(packet)
+        tags = dict(packet.tags)
+        if tags.get(GameTag.ZONE) == Zone.DECK and not self._deck_sealed:
+            self._deck_origin[packet.entity] = tags.get(GameTag.CONTROLLER)
+
+    def _on_choices(self, packet):
+        self._last_choices = packet
+        self._choices_turn = self._turn  # 记录产生 Choice 时的回合
+        self._choices_answered = False   # 新的 Choice 出现，重置响应状态
+
+    def _on_send_choices(self, packet):
+        # 如果出现了 SendChoices，说明之前的 Choice 已经被处理
+        self._choices_answered = True
+
+    PACKET_HANDLERS = {
+        hs_packets.TagChange: _on_tag_change,
+        hs_packets.FullEntity: _on_full_entity,
+        hs_packets.ShowEntity: _on_entity_revealed,
+        hs_packets.ChangeEntity: _on_change_entity,
+        hs_packets.Choices: _on_choices,
+        hs_packets.SendChoices: _on_send_choices,
+    }
+
+    def _left_deck_card(self, entity_id):
+        """开局位于己方牌库、现在已不在己方牌库的实体返回其 card_id，否则返回 None"""
+        if self._deck_origin.get(entity_id) != self.friendly_player_id:
+            return None
+        entity = self.game.find_entity_by_id(entity_id)
+        if entity is None:
+            return None
+        tags = entity.tags
+        if tags.get(GameTag.ZONE) == Zone.DECK and tags.get(GameTag.CONTROLLER) == self.friendly_player_id:
+            return None
+        return entity.card_id or self._revealed_cards.get(entity_id) or None
+
+    def _added_deck_card(self, entity_id):
+        """不属于初始套牌、现在位于己方牌库的实体返回其 card_id (未知时为空字符串)，否则返回 None"""
+        if entity_id in self._deck_origin:
+            return None
+        entity = self.game.find_entity_by_id(entity_id)
+        if entity is None:
+            return None
+        tags = entity.tags
+        if tags.get(GameTag.ZONE) != Zone.DECK or tags.get(GameTag.CONTROLLER) != self.friendly_player_id:
+            return None
+        return entity.card_id or self._revealed_cards.get(entity_id) or ""
+
+    @staticmethod
+    def _recount(entity_id, card_id, tracked, counts):
+        """实体的 card_id (None 表示不计入) 变化时更新对应的计数"""
+        old_card_id = tracked.get(entity_id)
+        if card_id == old_card_id:
+            return
+        if old_card_id is not None:
+            counts[old_card_id] -= 1
+            del tracked[entity_id]
+        if card_id is not None:
+            counts[card_id] += 1
+            tracked[entity_id] = card_id
+
+    def _update_deck_tracking(self):
+        """只重新计算本次有变化的实体 (友方玩家刚确定时整体重建一次)"""
+        if self.friendly_player_id != self._deck_tracked_player:
+            self._deck_tracked_player = self.friendly_player_id
+            self._left_deck, self._left_deck_counts = {}, Counter()
+            self._added_deck, self._added_deck_counts = {}, Counter()
+            dirty = set(self._deck_origin)
+            if self.friendly_player_id and self._exporter:
+                dirty.update(e.id for e in self._exporter.entities_in(self.friendly_player_id, Zone.DECK))
+        else:
+            dirty = self._dirty_entities
+        if self.friendly_player_id and self.game:
+            for entity_id in dirty:
+                self._recount(entity_id, self._left_deck_card(entity_id), self._left_deck, self._left_deck_counts)
+                self._recount(entity_id, self._added_deck_card(entity_id), self._added_deck, self._added_deck_counts)
+        self._dirty_entities = set()
+
+    def _extract_choices(self):
+        """根据最后一个 Choices 的状态生成当前的选择项"""
         self.current_choices = []
-        
-        # 遍历最后的几个 packet 寻找 Choices
-        if not packet_tree.packets:
+
+        # 判定条件：
+        # 1. 找到了 Choice
+        # 2. 没有被响应 (SendChoices)
+        # 3. Choice 发生在当前回合 (防止读取到历史 Choice)
+        packet = self._last_choices
+        if packet is None or self._choices_answered or self._choices_turn != self._turn:
             return
-            
-        # 寻找最后一个 Choices 包
-        last_choice_packet = None
-        has_response = False
-        
-        # 追踪回合
-        current_turn = 0
-        choice_turn = -1
-        
-        def find_last_choice(packets, depth=0):
-            nonlocal last_choice_packet, has_response, current_turn, choice_turn
-            if depth > 50: return # 增加深度限制
-            
-            for packet in packets:
-                # 检查包类型 (兼容 hslog 类名)
-                pkt_type = type(packet).__name__
-                
-                # 检测回合切换 (TagChange: Entity=1 (Game), Tag=TURN)
-                if pkt_type == 'TagChange':
-                    if packet.tag == GameTag.TURN and packet.entity == 1:
-                        current_turn = packet.value
-                
-                if pkt_type == 'Choices':
-                    last_choice_packet = packet
-                    choice_turn = current_turn # 记录产生 Choice 时的回合
-                    has_response = False # 新的 Choice 出现，重置响应状态
-                
-                elif pkt_type == 'SendChoices':
-                    # 如果出现了 SendChoices，说明之前的 Choice 已经被处理
-                    has_response = True
-                
-                # 递归 (注意：从 Block 中递归可能会错过外层的 Turn 变更，但通常 Turn 变更是顶层事件)
-                # 即使错过，我们主要关心 Choice 和随后发生的事件。
-                if hasattr(packet, 'packets'):
-                    find_last_choice(packet.packets, depth + 1)
-                    
+
         try:
-            find_last_choice(packet_tree.packets)
-            
-            # 判定条件：
-            # 1. 找到了 Choice
-            # 2. 没有被响应 (SendChoices)
-            # 3. Choice 发生在当前回合 (防止读取到历史 Choice)
-            if last_choice_packet and not has_response and choice_turn == current_turn:
-                # 提取选项
-                source = getattr(last_choice_packet, 'source', None) # 谁的选择
-                choices = getattr(last_choice_packet, 'choices', [])
-                
-                # 只有当这确实是我们的选择时 (source == friendly_player_id)
-                # 但 Log 中 source 往往是 EntityID。需校验。
-                # 简单起见，只要有未响应的 Choice，我们就认为是我们的 (通常 Log 只记录可见的 choice)
-                
-                if choices:
-                    print(f"[*] 检测到未处理的 Choices (Turn {choice_turn}): {choices}")
-                    for choice_id in choices:
-                        entity = self._get_entity_by_id(choice_id)
-                        if entity:
-                            card_id = self._get_entity_name(entity)
-                            card_name = "Unknown"
-                            if card_id:
-                                data = self.get_card_data(card_id)
-                                card_name = data.get("name", card_id)
-                            
-                            self.current_choices.append({
-                                "id": choice_id,
-                                "card_id": card_id,
-                                "name": card_name
-                            })
+            # 简单起见，只要有未响应的 Choice，我们就认为是我们的 (通常 Log 只记录可见的 choice)
+            choices = getattr(packet, 'choices', [])
+            if not choices:
+                return
+            if self._announced_choices is not packet:
+                self._announced_choices = packet
+                print(f"[*] 检测到未处理的 Choices (Turn {self._choices_turn}): {choices}")
+            for choice_id in choices:
+                entity = self._get_entity_by_id(choice_id)
+                if entity:
+                    card_id = self._get_entity_name(entity)
+                    card_name = "Unknown"
+                    if card_id:
+                        data = self.get_card_data(card_id)
+                        card_name = data.get("name", card_id)
+
+                    self.current_choices.append({
+                        "id": choice_id,
+                        "card_id": card_id,
+                        "name": card_name
+                    })
         except Exception as e:
             print(f"[!] 提取 Choices 出错: {e}")
 
-    def _update_revealed_cache(self, packet_tree):
-        """解析所有 Packet，记录已知的实体卡片 ID"""
-        def visit_packets(packets, depth=0):
-            if depth > 50: return
-            for packet in packets:
-                # 记录 FullEntity 和 ShowEntity 中的 CardID
-                pkt_type = type(packet).__name__
-                if pkt_type in ['FullEntity', 'ShowEntity']:
-                    if hasattr(packet, 'card_id') and packet.card_id:
-                        self._revealed_cards[packet.entity] = packet.card_id
-                
-                if hasattr(packet, 'packets'):
-                    visit_packets(packet.packets, depth + 1)
-        
-        visit_packets(packet_tree.packets)
-    
     def _get_entity_by_id(self, entity_id):
         """根据 ID 获取实体"""
         if not self.game:
@@ -382,58 +960,93 @@ class GameStateTracker:
             "exhausted": tags.get(GameTag.EXHAUSTED, 0) == 1
         }
     
-    def get_card_data(self, card_id):
-        """获取卡牌详细信息 (中文)"""
+    def get_card_data(self, card_id, spell_damage=0):
+        """获取卡牌详细信息 (中文)
+
+        清理后的名称/描述按 card_id 缓存，只在第一次查询时计算；返回的字典为共享缓存，请勿修改。
+        spell_damage > 0 时，描述中的 $N 按法术伤害加成显示为 *N+spell_damage* (与游戏内一致)。
+        """
         if not card_id:
             return {"name": "Unknown", "text": ""}
-        
+
+        info = self._card_data_cache.get(card_id)
+        if info is None:
+            info = self._build_card_data(card_id)
+            self._card_data_cache[card_id] = info
+
+        if spell_damage and card_id in self._spell_text_cache:
+            return dict(info, text=self._render_placeholders(self._spell_text_cache[card_id], spell_damage))
+        return info
+
+    def _build_card_data(self, card_id):
         card = self.card_db.get(card_id)
-        if card:
-            # 清理描述文本中的 HTML 标签 (如 <b>, <i>)
-            description = card.description or ""
-            description = description.replace("<b>", "").replace("</b>", "")
-            description = description.replace("<i>", "").replace("</i>", "")
-            description = description.replace("$", "") # 移除变量占位符
-            description = description.replace("[x]", "")
-            description = description.replace("\\n", "")
-            return {
-                "name": card.name,
-                "text": description,
-                "cost": card.cost,
-                "type": card.type
-            }
-        return {"name": card_id, "text": ""}
+        if not card:
+            return {"name": card_id, "text": ""}
+        # 清理描述文本中的 HTML 标签 (如 <b>, <i>)
+        raw_text = CARD_MARKUP_RE.sub("", card.description or "")
+        info = {
+            "name": card.name,
+            "text": self._render_placeholders(raw_text, 0),
+            "cost": card.cost,
+            "type": card.type
+        }
+        if "$" in raw_text:
+            self._spell_text_cache[card_id] = raw_text
+        return info
+
+    @staticmethod
+    def _render_placeholders(text, spell_damage):
+        """替换变量占位符：$N 加上法术伤害，#N 保留基础数值"""
+        def render(match):
+            value = int(match.group(2))
+            if match.group(1) == "$" and spell_damage:
+                return f"*{value + spell_damage}*"
+            return str(value)
+        return CARD_PLACEHOLDER_RE.sub(render, text)
+
+    def get_spell_damage(self, player_id=None):
+        """己方当前法术伤害加成 (场上随从的 SPELLPOWER 之和)"""
+        player_id = player_id or self.friendly_player_id
+        if not self.game or not player_id:
+            return 0
+        return sum(e.tags.get(GameTag.SPELLPOWER, 0)
+                   for e in self._exporter.entities_in(player_id, Zone.PLAY, CardType.MINION))
 
     def get_choices(self):
         """获取当前的选择项"""
         return self.current_choices
     
+    def _zone_entities(self, player_id, zone, cardtype=None):
+        """按 ZONE_POSITION 排序返回指定区域的实体 (查询导出器维护的区域索引，不扫描全部实体)"""
+        entities = self._exporter.entities_in(player_id, zone, cardtype)
+        entities.sort(key=lambda x: x.tags.get(GameTag.ZONE_POSITION, 0))
+        return entities
+
     def get_my_hand(self):
         """获取己方手牌 (包含中文描述)"""
         if not self.game or not self.friendly_player_id:
             return []
-            
-        player = self.game.players[self.friendly_player_id - 1]
-        hand_zone = [e for e in player.entities if e.tags.get(GameTag.ZONE) == Zone.HAND]
-        
+
         # 排序：按场上位置 (ZONE_POSITION)
-        hand_zone.sort(key=lambda x: x.tags.get(GameTag.ZONE_POSITION, 0))
+        hand_zone = self._zone_entities(self.friendly_player_id, Zone.HAND)
+        spell_damage = self.get_spell_damage()
         
         cards = []
         for e in hand_zone:
             card_id = e.card_id
-            card_info = self.get_card_data(card_id)
+            card_info = self.get_card_data(card_id, spell_damage)
+            tags = e.tags
             
             cards.append({
                 "id": card_id,
                 "name": card_info["name"], # 中文名
                 "text": card_info["text"], # 描述
-                "atk": e.tags.get(GameTag.ATK, 0),
-                "health": e.tags.get(GameTag.HEALTH, 0) - e.tags.get(GameTag.DAMAGE, 0),
-                "cost": e.tags.get(GameTag.COST, 0),
-                "divine_shield": e.tags.get(GameTag.DIVINE_SHIELD, 0) == 1,
-                "taunt": e.tags.get(GameTag.TAUNT, 0) == 1,
-                "exhausted": e.tags.get(GameTag.EXHAUSTED, 0) == 1
+                "atk": tags.get(GameTag.ATK, 0),
+                "health": tags.get(GameTag.HEALTH, 0) - tags.get(GameTag.DAMAGE, 0),
+                "cost": tags.get(GameTag.COST, 0),
+                "divine_shield": tags.get(GameTag.DIVINE_SHIELD, 0) == 1,
+                "taunt": tags.get(GameTag.TAUNT, 0) == 1,
+                "exhausted": tags.get(GameTag.EXHAUSTED, 0) == 1
             })
         return cards
     
@@ -442,21 +1055,21 @@ class GameStateTracker:
         if not self.game or not self.friendly_player_id:
             return []
             
-        player = self.game.players[self.friendly_player_id - 1]
-        board_zone = [e for e in player.entities if e.tags.get(GameTag.ZONE) == Zone.PLAY and e.tags.get(GameTag.CARDTYPE) == CardType.MINION]
-        board_zone.sort(key=lambda x: x.tags.get(GameTag.ZONE_POSITION, 0))
+        board_zone = self._zone_entities(self.friendly_player_id, Zone.PLAY, CardType.MINION)
         
         minions = []
         for e in board_zone:
             card_info = self.get_card_data(e.card_id)
+            tags = e.tags
             minions.append({
                 "name": card_info["name"],
                 "text": card_info["text"],
-                "atk": e.tags.get(GameTag.ATK, 0),
-                "health": e.tags.get(GameTag.HEALTH, 0) - e.tags.get(GameTag.DAMAGE, 0),
-                "divine_shield": e.tags.get(GameTag.DIVINE_SHIELD, 0) == 1,
-                "taunt": e.tags.get(GameTag.TAUNT, 0) == 1,
-                "can_attack": e.tags.get(GameTag.EXHAUSTED, 0) == 0 and e.tags.get(GameTag.FROZEN, 0) == 0
+                "atk": tags.get(GameTag.ATK, 0),
+                "health": tags.get(GameTag.HEALTH, 0) - tags.get(GameTag.DAMAGE, 0),
+                "divine_shield": tags.get(GameTag.DIVINE_SHIELD, 0) == 1,
+                "taunt": tags.get(GameTag.TAUNT, 0) == 1,
+                "frozen": tags.get(GameTag.FROZEN, 0) == 1,
+                "can_attack": tags.get(GameTag.EXHAUSTED, 0) == 0 and tags.get(GameTag.FROZEN, 0) == 0
             })
         return minions
     
@@ -466,47 +1079,56 @@ class GameStateTracker:
             return []
             
         opp_id = 3 - self.friendly_player_id
-        player = self.game.players[opp_id - 1]
-        board_zone = [e for e in player.entities if e.tags.get(GameTag.ZONE) == Zone.PLAY and e.tags.get(GameTag.CARDTYPE) == CardType.MINION]
-        board_zone.sort(key=lambda x: x.tags.get(GameTag.ZONE_POSITION, 0))
+        board_zone = self._zone_entities(opp_id, Zone.PLAY, CardType.MINION)
         
         minions = []
         for e in board_zone:
             card_info = self.get_card_data(e.card_id)
+            tags = e.tags
             minions.append({
                 "name": card_info["name"],
                 "text": card_info["text"],
-                "atk": e.tags.get(GameTag.ATK, 0),
-                "health": e.tags.get(GameTag.HEALTH, 0) - e.tags.get(GameTag.DAMAGE, 0),
-                "divine_shield": e.tags.get(GameTag.DIVINE_SHIELD, 0) == 1,
-                "taunt": e.tags.get(GameTag.TAUNT, 0) == 1
+                "atk": tags.get(GameTag.ATK, 0),
+                "health": tags.get(GameTag.HEALTH, 0) - tags.get(GameTag.DAMAGE, 0),
+                "divine_shield": tags.get(GameTag.DIVINE_SHIELD, 0) == 1,
+                "taunt": tags.get(GameTag.TAUNT, 0) == 1
             })
         return minions
     
     def get_hero_state(self, player_id):
-        """获取指定玩家的英雄状态 (包含中文描述)"""
+        """获取指定玩家的英雄状态 (包含中文描述和职业)"""
         if not self.game:
-            return {"health": 30, "armor": 0, "atk": 0, "name": "Unknown"}
+            return {"health": 30, "armor": 0, "atk": 0, "name": "Unknown", "class": "UNKNOWN"}
             
-        player = self.game.players[player_id - 1]
-        hero = None
-        for e in player.entities:
-            if e.tags.get(GameTag.ZONE) == Zone.PLAY and e.tags.get(GameTag.CARDTYPE) == CardType.HERO:
-                hero = e
-                break
+        heroes = self._exporter.entities_in(player_id, Zone.PLAY, CardType.HERO)
+        # 与原先按实体创建顺序取第一个保持一致
+        hero = min(heroes, key=lambda e: e.id) if heroes else None
                 
         if not hero:
-            return {"health": 0, "armor": 0, "atk": 0, "name": "Unknown"}
+            return {"health": 0, "armor": 0, "atk": 0, "name": "Unknown", "class": "UNKNOWN"}
             
         tags = hero.tags
         card_info = self.get_card_data(hero.card_id)
         
+        # 获取职业
+        class_enum = tags.get(GameTag.CLASS, 0)
+        try:
+            class_name = CardClass(class_enum).name
+        except:
+            class_name = "UNKNOWN"
+
+        # 英雄技能费用以实体的 COST 标签为准 (会被卡牌效果改变)；没有英雄技能实体时为 None
+        powers = self._exporter.entities_in(player_id, Zone.PLAY, CardType.HERO_POWER)
+        power_cost = powers[0].tags.get(GameTag.COST, 0) if powers else None
+        
         return {
             "name": card_info["name"],
             "text": card_info["text"],
             "health": tags.get(GameTag.HEALTH, 30) - tags.get(GameTag.DAMAGE, 0),
             "armor": tags.get(GameTag.ARMOR, 0),
-            "atk": tags.get(GameTag.ATK, 0)
+            "atk": tags.get(GameTag.ATK, 0),
+            "class": class_name,
+            "power_cost": power_cost
         }
 
     def get_my_deck(self, include_details=False):
@@ -514,48 +1136,44 @@ class GameStateTracker:
         if not self.game or not self.friendly_player_id:
             return []
             
-        player = self.game.players[self.friendly_player_id - 1]
-        
         # 基础逻辑：统计当前 ZONE 为 DECK 的实体
-        deck_entities = [e for e in player.entities if e.tags.get(GameTag.ZONE) == Zone.DECK]
+        deck_entities = self._exporter.entities_in(self.friendly_player_id, Zone.DECK)
         
-        # 如果有套牌代码提供的完整列表，尝试进行“排除法”推理
-        if self.deck_code_list:
-            full_list_names = []
-            for item in self.deck_code_list:
-                name = item.split(":")[0] if ":" in item else item
-                full_list_names.append(name)
-            
-            # 统计所有【已揭示】且【不在牌库】的卡牌名称
-            drawn_cards = []
-            for e in player.entities:
-                if e.tags.get(GameTag.ZONE) != Zone.DECK:
-                    card_id = e.card_id or self._revealed_cards.get(e.id)
-                    if card_id:
-                        card_info = self.get_card_data(card_id)
-                        drawn_cards.append(card_info["name"])
-            
-            # 从完整名单中移除这些已抽到的牌
-            from copy import deepcopy
-            remaining_names = deepcopy(full_list_names)
-            for card in drawn_cards:
-                if card in remaining_names:
-                    remaining_names.remove(card)
-            
+        # 如果有套牌代码提供的完整列表，尝试进行“排除法”推理：
+        # 套牌张数减去已离开牌库的张数，再加上对局中洗入且仍在牌库的张数 (按 card_id 计数，由 _update_deck_tracking 增量维护)
+        if self.deck_code_counts:
+            left = self._left_deck_counts
+            added = self._added_deck_counts
+            extra = sorted((card_id, count) for card_id, count in added.items()
+                           if count > 0 and card_id not in self.deck_code_counts)
             if include_details:
-                # 从 deck_code_list 中捞出匹配项
                 final_deck = []
-                temp_remaining = deepcopy(remaining_names)
-                for item in self.deck_code_list:
-                    name = item.split(":")[0] if ":" in item else item
-                    if name in temp_remaining:
-                        final_deck.append(item)
-                        temp_remaining.remove(name)
+                for card_id, item in self._deck_code_entries:
+                    remaining = self.deck_code_counts[card_id] - left.get(card_id, 0) + added.get(card_id, 0)
+                    if remaining > 0:
+                        final_deck.extend([item] * remaining)
+                for card_id, count in extra:
+                    if card_id:
+                        card_info = self.get_card_data(card_id)
+                        item = f"{card_info['name']}: {card_info['text']}"
+                    else:
+                        item = "未知卡牌"
+                    final_deck.extend([item] * count)
                 return final_deck
             else:
-                from collections import Counter
-                counts = Counter(remaining_names)
-                return [f"{name} x{count}" for name, count in sorted(counts.items())]
+                counts = Counter()
+                for card_id, count in self.deck_code_counts.items():
+                    remaining = count - left.get(card_id, 0) + added.get(card_id, 0)
+                    if remaining > 0:
+                        counts[self.get_card_data(card_id)["name"]] += remaining
+                for card_id, count in extra:
+                    if card_id:
+                        counts[self.get_card_data(card_id)["name"]] += count
+                deck_list = [f"{name} x{count}" for name, count in sorted(counts.items())]
+                unknown_count = added.get("", 0)
+                if unknown_count > 0:
+                    deck_list.append(f"未知卡牌 x{unknown_count}")
+                return deck_list
 
         # --- 原始解析逻辑 (无套牌代码时的保底) ---
         cards = []
@@ -571,7 +1189,6 @@ class GameStateTracker:
             else:
                 unknown_count += 1
                 
-        from collections import Counter
         counts = Counter(cards)
         
         if include_details:
@@ -637,7 +1254,11 @@ class GameStateTracker:
             return game_entity.tags.get(GameTag.TURN, 1)
         return 1
 
-
+    def is_game_over(self):
+        """当前对局是否已结束 (GameEntity STATE=COMPLETE)"""
+        if not self.game:
+            return False
+        return self.game.tags.get(GameTag.STATE) == State.COMPLETE
 
     def is_my_turn(self):
         """判断当前是否为我的回合"""
@@ -659,6 +1280,48 @@ class GameStateTracker:
             print(f"[!] Warning checking turn: {e}")
         return False
 
+    def expect(self, action):
+        """在执行 action 之前调用，返回确认函数：日志中出现该操作的结果后返回 True
+
+        打出卡牌：该手牌离开 HAND；攻击：攻击者的 NUM_ATTACKS_THIS_TURN / EXHAUSTED 变化或离场；
+        英雄技能：技能变为 EXHAUSTED；发现/抉择：出现 SendChoices；结束回合：回合数变化或不再是我的回合；
+        确认调度：离开调度阶段。日志中没有对应事件的操作 (如调度换牌) 或找不到实体时返回 None。
+        """
+        if not self.game or not self.friendly_player_id:
+            return None
+        pid = self.friendly_player_id
+        kind = action.get("type")
+        if kind in ("PLAY_MINION", "PLAY_SPELL_AOE", "PLAY_TARGET"):
+            hand = self._zone_entities(pid, Zone.HAND)
+            idx = action.get("hand_index", 0)
+            if idx < len(hand):
+                card = hand[idx]
+                return lambda: card.tags.get(GameTag.ZONE) != Zone.HAND
+        elif kind == "ATTACK":
+            board = self._zone_entities(pid, Zone.PLAY, CardType.MINION)
+            idx = action.get("attacker_index", 0)
+            if idx < len(board):
+                attacker = board[idx]
+                before = (attacker.tags.get(GameTag.NUM_ATTACKS_THIS_TURN, 0), attacker.tags.get(GameTag.EXHAUSTED, 0))
+                return lambda: (attacker.tags.get(GameTag.ZONE) != Zone.PLAY
+                                or (attacker.tags.get(GameTag.NUM_ATTACKS_THIS_TURN, 0),
+                                    attacker.tags.get(GameTag.EXHAUSTED, 0)) != before)
+        elif kind == "HERO_POWER":
+            powers = self._exporter.entities_in(pid, Zone.PLAY, CardType.HERO_POWER)
+            if powers and not powers[0].tags.get(GameTag.EXHAUSTED, 0):
+                power = powers[0]
+                return lambda: power.tags.get(GameTag.EXHAUSTED, 0) == 1
+        elif kind == "CHOOSE":
+            packet = self._last_choices
+            if packet is not None and not self._choices_answered:
+                return lambda: self._choices_answered or self._last_choices is not packet
+        elif kind == "END_TURN":
+            turn = self.get_turn()  # 一次读到的日志可能已经包含对手的整个回合
+            return lambda: self.get_turn() != turn or not self.is_my_turn()
+        elif kind == "MULLIGAN_CONFIRM":
+            return lambda: self.get_game_phase() != "MULLIGAN"
+        return None
+
 class LogOverlay:
     def __init__(self):
         self.root = tk.Tk()
@@ -721,32 +1384,1690 @@ class LogOverlay:
         # 兼容旧代码，默认更新信息区
         self.update_info(text)
 
+    def post(self, func, *args):
+        """从后台线程安全地调度到 Tk 主线程执行"""
+        self.root.after(0, func, *args)
+
     def mainloop(self):
         self.root.mainloop()
 
 
+class ConsoleOverlay:
+    """headless 模式下代替 LogOverlay：不创建窗口，状态直接输出到控制台"""
+
+    def __init__(self):
+        self._last_status = None
+
+    def update_status(self, text):
+        # 状态会在每次轮询时重复刷新，只输出变化
+        if text != self._last_status:
+            self._last_status = text
+            print(f"[状态] {text}")
+
+    def update_info(self, text):
+        pass  # log() 已经 print 过
+
+    def update_text(self, text):
+        self.update_info(text)
+
+    def post(self, func, *args):
+        func(*args)
+
+    def mainloop(self):
+        pass
+
+
+
+
+MODEL_NAME = "gemini-3-flash-preview"
+
+# 决定 AI 决策的状态字段；message / initial_deck / game_over 等与决策无关，不参与指纹计算
+FINGERPRINT_FIELDS = ("game_phase", "turn", "mana", "max_mana", "hand_cards", "my_deck",
+                      "my_minions", "enemy_minions", "my_hero", "enemy_hero", "choices")
+
+
+def state_fingerprint(state):
+    """游戏状态的规范化指纹：字段相同则指纹相同 (与字典顺序、无关字段无关)"""
+    canonical = json.dumps({key: state.get(key) for key in FINGERPRINT_FIELDS},
+                           sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+    return hashlib.blake2b(canonical.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class DecisionCache:
+    """按状态指纹缓存 AI 计划 (LRU + TTL)
+
+    同一个局面只请求一次模型：表情、计时器等不影响局面的日志行不会触发新的决策。
+    """
+
+    def __init__(self, max_size=64, ttl=30.0, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock             # 回放时为虚拟时钟，过期判断与回放速度无关
+        self._entries = OrderedDict()  # fingerprint -> (plan, 写入时间)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, fingerprint):
+        entry = self._entries.get(fingerprint)
+        if entry is not None and self.clock() - entry[1] <= self.ttl:
+            self._entries.move_to_end(fingerprint)
+            self.hits += 1
+            return entry[0]
+        if entry is not None:
+            del self._entries[fingerprint]  # 已过期：局面可能卡住了 (操作没生效)，允许重新决策
+        self.misses += 1
+        return None
+
+    def put(self, fingerprint, plan):
+        self._entries[fingerprint] = (plan, self.clock())
+        self._entries.move_to_end(fingerprint)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def discard(self, fingerprint):
+        """删除某个局面的计划 (计划执行中途失效时，不能再原样复用)"""
+        self._entries.pop(fingerprint, None)
+
+    def clear(self):
+        self._entries.clear()
+
+
+# 中日韩字符大约 1 个 token，其余字符大约 4 个一个 token
+CJK_CHAR_RE = re.compile(r"[⺀-鿿豈-﫿＀-￯]")
+
+
+def estimate_tokens(text):
+    """粗略估算文本的 token 数 (不依赖分词器，用于提示词预算)"""
+    cjk = len(CJK_CHAR_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+SYSTEM_PROMPT = "You are a JSON-only response bot. Output ONLY valid JSON."
+
+STATE_LEGEND = ("Keys: t=turn, m=mana (current/max), h=hand (list index = hand_index), b=my minions, "
+                "e=enemy minions (list index = target_index), me/op=my/enemy hero, ch=choices (list index = CHOOSE index), "
+                "d=my remaining deck (only sent when it changed), g=card text not in the card glossary. "
+                "Card format: name cCOST ATK/HEALTH flags. 'ready' = the minion can attack this turn.")
+
+
+MULLIGAN_PROMPT = """你是一个炉石传说AI助手。现在是起手调度阶段 (Mulligan)。
+请根据手牌 (h) 和牌库剩余 (d) 决定替换掉哪些牌。通常保留低费随从，替换高费牌。
+请输出 JSON 响应，格式如下：
+{
+    "thought": "简短的一句话思考过程",
+    "actions": [
+        { "type": "MULLIGAN_REPLACE", "hand_index": 0, "desc": "替换第1张" },
+        { "type": "MULLIGAN_CONFIRM", "desc": "确认" }
+    ]
+}
+注意：如果不替换任何牌，直接输出 MULLIGAN_CONFIRM。
+只输出 JSON。"""
+
+TURN_PROMPT = """Role: You are a professional Hearthstone player aiming for the highest win rate.
+
+Your Strategic Priorities (in order):
+0. **DECK AWARENESS**: Check 'd' in the state to know what cards remain in your deck.
+1. **HANDLE CHOICES**: If "ch" is present and not empty, you MUST return a "CHOOSE" action immediately. Do not do anything else.
+2. **CHECK LETHAL**: Calculate if you can kill the enemy hero this turn (Board damage + Hand damage). If yes, IGNORE TRADING and go face.
+3. **SURVIVAL**: If your Health is low, prioritize Taunt, Healing, or Clearing the board.
+4. **VALUE TRADING**: If not lethal, make favorable trades (kill enemy minion while keeping yours alive).
+5. **TEMPO**: Spend as much Mana as possible. Develop the board.
+6. **FACE**: If no good trades, attack Enemy Hero.
+
+Rules:
+- Only minions marked "ready" can attack (Rush/Charge aside, assume mostly no).
+- Minions with 0 attack cannot attack.
+- You cannot target "immune" or "stealth" characters.
+
+Output Format:
+Provide a strictly valid JSON response.
+IMPORTANT: Your 'thought' content MUST be in CHINESE.
+{
+    "thought": "简短的中文战术思考。例如：'斩杀线不够，优先解场。' / '发现法术。'",
+    "actions": [
+        { "type": "CHOOSE", "index": 0, "desc": "Pick option 0" },
+        { "type": "PLAY_MINION", "hand_index": 0, "desc": "Play Card X" },
+        { "type": "PLAY_TARGET", "hand_index": 0, "target_type": "enemy_hero", "desc": "Fireball to Face" },
+        { "type": "PLAY_TARGET", "hand_index": 0, "target_type": "minion", "target_index": 0, "desc": "Buff my minion 0" },
+        { "type": "ATTACK", "attacker_index": 0, "target_type": "minion", "target_index": 0, "desc": "My Minion 0 trades Enemy Minion 0" },
+        { "type": "ATTACK", "attacker_index": 0, "target_type": "enemy_hero", "desc": "Go Face" },
+        { "type": "HERO_POWER", "desc": "Use Hero Power" },
+        { "type": "END_TURN", "desc": "End Turn" }
+    ]
+}
+
+IMPORTANT: Return ONLY the JSON. No markdown formatting."""
+
+
+class PromptEncoder:
+    """把游戏状态编码为紧凑的提示词
+
+    - 短字段名 + 紧凑 JSON，每张卡压缩成一行文本；
+    - 卡牌描述去重：本局套牌的描述放进 system 消息里的卡牌词典 (套牌不变则字节不变，可命中服务端的前缀缓存)，
+      状态里只写卡名；词典里没有的描述 (衍生牌、对手的牌、法术伤害加成后的描述) 每张只在 g 中出现一次；
+    - 牌库列表 (d) 只在与上一次编码时不同 (抽牌、洗入、新对局) 时发送；
+    - 超出 token 预算时按优先级裁剪：先把牌库列表换成张数，再依次省略敌方随从、英雄、己方随从的描述；
+      手牌和选择项始终保留。
+    """
+
+    # g 中描述的优先级：数字越大越先被裁剪
+    HAND, BOARD, HERO, ENEMY = 0, 1, 2, 3
+
+    def __init__(self, token_budget=1200):
+        self.token_budget = token_budget
+        self.system_text = SYSTEM_PROMPT
+        self.trimmed = []         # 最近一次编码中被裁剪的部分
+        self._deck_key = None
+        self._glossary = {}       # 卡名 -> 描述 (本局套牌)
+        self._last_deck = None    # 上一次编码的牌库列表
+
+    def _update_glossary(self, initial_deck):
+        """套牌变化时 (新对局 / 套牌第一次确定) 重建卡牌词典"""
+        key = tuple(initial_deck or ())
+        if key == self._deck_key:
+            return
+        self._deck_key = key
+        glossary = {}
+        for item in key:
+            name, _, text = item.partition(": ")
+            if text:
+                glossary.setdefault(name, text)
+        self._glossary = glossary
+        lines = [f"{name}: {text}" for name, text in sorted(glossary.items())]
+        self.system_text = SYSTEM_PROMPT
+        if lines:
+            self.system_text += "\nCard glossary (my deck this game):\n" + "\n".join(lines)
+
+    @staticmethod
+    def _deck_summary(my_deck):
+        """牌库列表：调度阶段的 "名称: 描述" 条目合并为 "名称 xN"，平时已经是 "名称 xN" 格式"""
+        if not my_deck or ": " not in my_deck[0]:
+            return list(my_deck or [])
+        counts = Counter(item.partition(": ")[0] for item in my_deck)
+        return [f"{name} x{count}" for name, count in sorted(counts.items())]
+
+    def encode(self, state):
+        """返回紧凑的状态文本 (system_text 同时更新为本局的卡牌词典)"""
+        self._update_glossary(state.get("initial_deck"))
+        glossary = self._glossary
+        notes = {}  # 卡名 -> (描述, 优先级)；同一张卡只保留一次，归入优先级最高的出处
+
+        def card(item, priority, flags=(), cost=True):
+            name = item.get("name", "Unknown")
+            text = item.get("text")
+            if text and glossary.get(name) != text and name not in notes:
+                notes[name] = (text, priority)
+            parts = [name]
+            if cost:
+                parts.append(f"c{item.get('cost', 0)}")
+            atk, health = item.get("atk", 0), item.get("health", 0)
+            if health > 0:
+                parts.append(f"{atk}/{health}")
+            elif atk:
+                parts.append(f"atk{atk}")
+            parts.extend(flag for flag, on in flags if on)
+            return " ".join(parts)
+
+        def traits(item):
+            return (("taunt", item.get("taunt")), ("shield", item.get("divine_shield")))
+
+        def hero(item):
+            card(item, self.HERO, cost=False)
+            line = f"{item.get('class', 'UNKNOWN')} hp{item.get('health', 0)}"
+            if item.get("armor"):
+                line += f" armor{item['armor']}"
+            if item.get("atk"):
+                line += f" atk{item['atk']}"
+            return line
+
+        body = {
+            "t": state.get("turn"),
+            "m": f"{state.get('mana', 0)}/{state.get('max_mana', 0)}",
+            "h": [card(c, self.HAND, traits(c)) for c in state.get("hand_cards", [])],
+            "b": [card(c, self.BOARD, traits(c) + (("ready", c.get("can_attack")),), cost=False)
+                  for c in state.get("my_minions", [])],
+            "e": [card(c, self.ENEMY, traits(c), cost=False) for c in state.get("enemy_minions", [])],
+            "me": hero(state.get("my_hero") or {}),
+            "op": hero(state.get("enemy_hero") or {}),
+        }
+        if state.get("choices"):
+            body["ch"] = [c.get("name", "Unknown") for c in state["choices"]]
+        deck = self._deck_summary(state.get("my_deck"))
+        if tuple(deck) != self._last_deck:
+            self._last_deck = tuple(deck)
+            body["d"] = deck
+        else:
+            deck = []  # 牌库没有变化，不重复发送
+
+        # 按预算裁剪：各部分分别估算，裁剪后只序列化一次
+        self.trimmed = []
+        cost_of = estimate_tokens
+        total = cost_of(json.dumps(body, ensure_ascii=False, separators=(",", ":")))
+        total += sum(cost_of(name) + cost_of(text) + 2 for name, (text, _) in notes.items())
+        if total > self.token_budget and deck:
+            total -= sum(cost_of(item) + 1 for item in deck) - 2
+            counts = (item.rpartition(" x")[2] for item in deck)
+            body["d"] = sum(int(count) if count.isdigit() else 1 for count in counts)  # 只保留剩余张数
+            self.trimmed.append("d")
+        for priority in (self.ENEMY, self.HERO, self.BOARD):
+            if total <= self.token_budget:
+                break
+            for name in [n for n, (_, p) in notes.items() if p == priority]:
+                total -= cost_of(name) + cost_of(notes.pop(name)[0]) + 2
+                self.trimmed.append(name)
+        if notes:
+            body["g"] = {name: text for name, (text, _) in notes.items()}
+        return json.dumps(body, ensure_ascii=False, separators=(",", ":"))
+
+
+class LLMClient:
+    """OpenAI 兼容接口 (/chat/completions) 的 HTTP 客户端
+
+    复用同一个 requests.Session：连接池 + keep-alive，只有第一次请求 (或连接被服务端关闭后)
+    才需要 TCP/TLS 握手。每次请求的分阶段耗时 (建立连接 / 首字节 / 总计) 写入调用方传入的 timing 字典；
+    连接耗时按线程累计，竞速时多个线程同时使用同一个客户端也互不干扰。
+    """
+
+    def __init__(self, base_url, api_key, timeout=30, pool_size=4):
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.connections = 0     # 累计新建的连接数
+        self._local = threading.local()  # 当前线程的请求中用于建立连接的时间和次数 (由连接类累加)
+        self._lock = threading.Lock()
+        self._session = None
+
+    def _create_session(self):
+        """创建带计时连接类的 Session (requests / urllib3 在这里才导入)"""
+        from urllib3.connection import HTTPConnection, HTTPSConnection
+        from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+        client = self
+
+        def timed(base):
+            class TimedConnection(base):
+                def connect(self):
+                    start = time.perf_counter()
+                    try:
+                        super().connect()  # HTTPS 包含 TLS 握手
+                    finally:
+                        local = client._local
+                        local.connect_time = getattr(local, "connect_time", 0.0) + time.perf_counter() - start
+                        local.connects = getattr(local, "connects", 0) + 1
+                        with client._lock:
+                            client.connections += 1
+            return TimedConnection
+
+        class TimedHTTPPool(HTTPConnectionPool):
+            ConnectionCls = timed(HTTPConnection)
+
+        class TimedHTTPSPool(HTTPSConnectionPool):
+            ConnectionCls = timed(HTTPSConnection)
+
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        adapter.poolmanager.pool_classes_by_scheme = {"http": TimedHTTPPool, "https": TimedHTTPSPool}
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.headers.update({
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json",
+            "Connection": "keep-alive",
+        })
+        return session
+
+    @property
+    def session(self):
+        if self._session is None:
+            self._session = self._create_session()
+        return self._session
+
+    def _begin(self):
+        """开始一次请求：清零当前线程的连接计时"""
+        local = self._local
+        local.connect_time, local.connects = 0.0, 0
+        return local
+
+    def chat(self, model, messages, cancel=None, timing=None):
+        """发送一次对话请求，成功返回模型输出的文本，失败返回 None
+
+        cancel (threading.Event) 在收到响应头时已被设置，则关闭连接并返回 None (竞速请求中落败的一方)。
+        timing (dict) 不为 None 时写入本次请求的 connect / ttfb / total / new_connection。
+        """
+        session = self.session
+        local = self._begin()
+        start = time.perf_counter()
+        # stream=True: post 在收到响应头后返回，用来区分首字节时间和读取响应体的时间
+        response = session.post(
+            f"{self.base_url}/chat/completions",
+            json={"model": model, "messages": messages},
+            timeout=self.timeout,
+            stream=True,
+        )
+        ttfb = time.perf_counter() - start
+        if cancel is not None and cancel.is_set():
+            response.close()  # 不读取响应体，连接直接丢弃
+            return None
+        body = response.content  # 读完响应体后连接归还连接池
+        total = time.perf_counter() - start
+        stats = {"connect": local.connect_time, "ttfb": ttfb, "total": total, "new_connection": local.connects > 0}
+        if timing is not None:
+            timing.update(stats)
+        print(f"[*] 模型请求耗时: 连接 {stats['connect'] * 1000:.0f} ms"
+              f" ({'新建' if stats['new_connection'] else '复用'})"
+              f" | 首字节 {ttfb * 1000:.0f} ms | 总计 {total * 1000:.0f} ms")
+
+        # 错误处理
+        if response.status_code != 200:
+            print(f"[!] API Error: {response.status_code} - {body.decode('utf-8', 'replace')}")
+            return None
+        result = json.loads(body)
+        return result['choices'][0]['message']['content']
+
+    def chat_stream(self, model, messages, timing=None):
+        """流式请求 (SSE)，逐段产出模型输出的文本；服务端不支持流式时一次性产出完整文本
+
+        timing (dict) 与 chat() 相同，产出过程中额外记录 first_token (第一段文本到达的时间)。
+        """
+        session = self.session
+        local = self._begin()
+        start = time.perf_counter()
+        response = session.post(
+            f"{self.base_url}/chat/completions",
+            json={"model": model, "messages": messages, "stream": True},
+            timeout=self.timeout,
+            stream=True,
+        )
+        ttfb = time.perf_counter() - start
+        timing = {} if timing is None else timing
+        timing.update(connect=local.connect_time, ttfb=ttfb, first_token=None, total=None,
+                      new_connection=local.connects > 0)
+        try:
+            if response.status_code != 200:
+                print(f"[!] API Error: {response.status_code} - {response.text}")
+                return
+            if "text/event-stream" not in response.headers.get("Content-Type", ""):
+                timing["first_token"] = time.perf_counter() - start
+                yield response.json()['choices'][0]['message']['content']
+                return
+            for data in self._iter_sse_data(response.raw):
+                if data == b"[DONE]":
+                    break
+                choices = json.loads(data).get("choices") or []
+                delta = choices[0].get("delta", {}).get("content") if choices else None
+                if delta:
+                    if timing["first_token"] is None:
+                        timing["first_token"] = time.perf_counter() - start
+                    yield delta
+        finally:
+            response.close()
+            timing["total"] = time.perf_counter() - start
+            first_token = timing["first_token"]
+            print(f"[*] 模型流式请求耗时: 连接 {timing['connect'] * 1000:.0f} ms"
+                  f" ({'新建' if timing['new_connection'] else '复用'})"
+                  f" | 首字节 {ttfb * 1000:.0f} ms"
+                  f" | 首段文本 {first_token * 1000 if first_token is not None else float('nan'):.0f} ms"
+                  f" | 总计 {timing['total'] * 1000:.0f} ms")
+
+    @staticmethod
+    def _iter_sse_data(raw):
+        """逐条产出 SSE 事件中 data: 的内容 (read1: 有数据就返回，不等缓冲区填满)"""
+        buffer = b""
+        while True:
+            chunk = raw.read1(65536, decode_content=True)
+            if not chunk:
+                break
+            buffer += chunk
+            *lines, buffer = buffer.split(b"\n")
+            for line in lines:
+                if line.startswith(b"data:"):
+                    yield line[5:].strip()
+        if buffer.startswith(b"data:"):
+            yield buffer[5:].strip()
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+
+class LLMBackend:
+    """一个模型后端 (BASE_URL + 模型名)，记录延迟的 EWMA 和最近的延迟样本"""
+
+    def __init__(self, name, client, model, alpha=0.3, window=20):
+        self.name = name
+        self.client = client
+        self.model = model
+        self.alpha = alpha
+        self.ewma = None           # 延迟 (秒) 的指数加权移动平均；失败按超时时间计入
+        self.samples = []          # 最近 window 次成功请求的延迟，用于估算 p50
+        self.window = window
+        self.failures = 0
+        self.healthy = True        # 最近一次请求是否成功；不健康的后端只用于故障转移，不用于竞速
+
+    def record(self, latency, ok):
+        self.healthy = ok
+        if not ok:
+            self.failures += 1
+            latency = max(latency, self.client.timeout)
+        else:
+            self.samples.append(latency)
+            del self.samples[:-self.window]
+        self.ewma = latency if self.ewma is None else self.alpha * latency + (1 - self.alpha) * self.ewma
+
+    def p50(self):
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[len(ordered) // 2]
+
+
+class LLMRouter:
+    """多个模型后端的竞速 (hedged request) 与故障转移
+
+    按延迟 EWMA 从低到高排序 (还没有数据的后端排在最前，先试一次)。先请求排名第一的后端；
+    它在自己的 p50 延迟内没有返回 (还没有样本时用 hedge_delay)，就同时请求下一个后端；
+    某个后端报错或返回的不是合法计划，立即换下一个。取第一个合法的 JSON 计划，其余请求取消。
+    流式请求 (open_stream) 同样竞速：以输出第一个完整操作的时间代替返回时间。
+    """
+
+    def __init__(self, backends, hedge_delay=2.0):
+        self.backends = backends
+        self.hedge_delay = hedge_delay
+
+    @classmethod
+    def from_config(cls, config):
+        """config.json 中的 BACKENDS 列表 (每项 NAME / BASE_URL / API_KEY / MODEL / TIMEOUT)；
+        没有配置时使用 BASE_URL + API_KEY + MODEL_NAME 这一个后端"""
+        timeout = config.get("API_TIMEOUT", 30)
+        entries = config.get("BACKENDS") or [{"BASE_URL": config.get("BASE_URL", ""), "API_KEY": config.get("API_KEY", "")}]
+        backends = []
+        for i, entry in enumerate(entries):
+            client = LLMClient(entry.get("BASE_URL", ""), entry.get("API_KEY", ""), timeout=entry.get("TIMEOUT", timeout))
+            backends.append(LLMBackend(entry.get("NAME", f"backend{i}"), client, entry.get("MODEL", MODEL_NAME)))
+        return cls(backends, hedge_delay=config.get("HEDGE_DELAY", 2.0))
+
+    def ranked(self):
+        return sorted(self.backends, key=lambda b: -1.0 if b.ewma is None else b.ewma)
+
+    @staticmethod
+    def _attempt(backend, messages, cancel, results):
+        start = time.perf_counter()
+        plan = None
+        try:
+            content = backend.client.chat(backend.model, messages, cancel=cancel)
+            if content is not None:
+                plan = parse_plan(content)
+        except Exception as e:
+            print(f"[!] 模型后端 {backend.name} 请求失败: {e}")
+        ok = isinstance(plan, dict) and isinstance(plan.get("actions"), list)
+        # 竞速落败被取消的请求没有完整的延迟，既不算成功也不算失败，不计入
+        if ok or not cancel.is_set():
+            backend.record(time.perf_counter() - start, ok)
+        results.put((backend, plan if ok else None))
+
+    def request_plan(self, messages):
+        """竞速请求各后端，返回第一个合法的计划 (dict)；全部失败返回 None"""
+        queue_ = self.ranked()
+        results = queue.Queue()
+        cancel = threading.Event()
+        pending = 0
+        deadline = time.perf_counter() + max(b.client.timeout for b in queue_)
+
+        def launch(hedge=False):
+            nonlocal pending
+            # 竞速只请求健康的后端；故障转移时按顺序依次尝试
+            candidates = [b for b in queue_ if b.healthy] if hedge else queue_
+            if not candidates:
+                return None
+            backend = candidates[0]
+            queue_.remove(backend)
+            print(f"[*] 调用模型: {backend.model} @ {backend.name}")
+            threading.Thread(target=self._attempt, args=(backend, messages, cancel, results), daemon=True).start()
+            pending += 1
+            return backend
+
+        primary = launch()
+        hedge_after = primary.p50() or self.hedge_delay
+        while pending:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            wait = min(hedge_after, remaining) if queue_ else remaining
+            try:
+                backend, plan = results.get(timeout=wait)
+            except queue.Empty:
+                hedge = launch(hedge=True)
+                if hedge is None:
+                    hedge_after = remaining  # 没有可用于竞速的后端，等待已发出的请求
+                else:
+                    print(f"[*] {primary.name} 超过 {hedge_after * 1000:.0f} ms 未返回，同时请求 {hedge.name}")
+                    primary, hedge_after = hedge, hedge.p50() or self.hedge_delay
+                continue
+            pending -= 1
+            if plan is not None:
+                cancel.set()
+                return plan
+            if queue_:
+                # 故障转移：报错或返回格式错误，立即换下一个后端
+                launch()
+        cancel.set()
+        print("[!] 所有模型后端均未返回有效计划")
+        return None
+
+    @staticmethod
+    def _stream_attempt(backend, messages, cancel, results):
+        """在线程中读取一个后端的流，逐段放入 results: (后端, 文本段, 是否已输出完整操作)，结束时放入 (后端, None, False)"""
+        start = time.perf_counter()
+        parser = ActionStreamParser()
+        stream = backend.client.chat_stream(backend.model, messages)
+        try:
+            for delta in stream:
+                if cancel.is_set():
+                    break
+                ready = bool(parser.feed(delta)) or parser.done
+                results.put((backend, delta, ready))
+        except Exception as e:
+            print(f"[!] 模型后端 {backend.name} 流式请求失败: {e}")
+        finally:
+            stream.close()
+        # 被取消的流 (竞速落败或本地执行中止) 没有完整的延迟，不计入
+        if parser.done or not cancel.is_set():
+            backend.record(time.perf_counter() - start, parser.done)
+        results.put((backend, None, False))
+
+    @staticmethod
+    def _follow(backend, chunks, results, cancel):
+        """选中的流：先产出竞速期间已收到的文本段，再继续产出后续文本段；关闭时取消该流"""
+        try:
+            yield from chunks
+            while True:
+                owner, delta, _ = results.get()
+                if owner is not backend:
+                    continue  # 落败的流在取消前可能还有输出
+                if delta is None:
+                    return
+                yield delta
+        finally:
+            cancel.set()
+
+    def open_stream(self, messages):
+        """竞速开始流式请求，返回 (后端, 文本段的迭代器)；所有后端都没有输出完整操作时返回 (None, None)
+
+        先开始排名第一的后端的流，它在自己的 p50 延迟内 (还没有样本时用 hedge_delay) 没有输出第一个完整操作，
+        就同时开始下一个健康后端的流；采用先输出完整操作 (或空的操作列表) 的流，其余取消。
+        流在输出完整操作之前报错或结束，立即换下一个后端。迭代器关闭时取消选中的流。
+        """
+        queue_ = self.ranked()
+        results = queue.Queue()
+        cancels, chunks = {}, {}
+        pending = 0
+        deadline = time.perf_counter() + max(b.client.timeout for b in queue_)
+
+        def launch(hedge=False):
+            nonlocal pending
+            candidates = [b for b in queue_ if b.healthy] if hedge else queue_
+            if not candidates:
+                return None
+            backend = candidates[0]
+            queue_.remove(backend)
+            print(f"[*] 调用模型: {backend.model} @ {backend.name} (流式)")
+            cancels[backend], chunks[backend] = threading.Event(), []
+            threading.Thread(target=self._stream_attempt, args=(backend, messages, cancels[backend], results),
+                             name=f"stream-{backend.name}", daemon=True).start()
+            pending += 1
+            return backend
+
+        primary = launch()
+        hedge_after = primary.p50() or self.hedge_delay
+        while pending:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            wait = min(hedge_after, remaining) if queue_ else remaining
+            try:
+                backend, delta, ready = results.get(timeout=wait)
+            except queue.Empty:
+                hedge = launch(hedge=True)
+                if hedge is None:
+                    hedge_after = remaining
+                else:
+                    print(f"[*] {primary.name} 超过 {hedge_after * 1000:.0f} ms 未输出操作，同时请求 {hedge.name}")
+                    primary, hedge_after = hedge, hedge.p50() or self.hedge_delay
+                continue
+            if delta is not None:
+                chunks[backend].append(delta)
+                if ready:
+                    for other, cancel in cancels.items():
+                        if other is not backend:
+                            cancel.set()
+                    return backend, self._follow(backend, chunks[backend], results, cancels[backend])
+                continue
+            pending -= 1
+            if queue_:
+                launch()
+        for cancel in cancels.values():
+            cancel.set()
+        print("[!] 所有模型后端均未输出有效计划")
+        return None, None
+
+    def close(self):
+        for backend in self.backends:
+            backend.client.close()
+
+
+# 流式解析用：定位 actions 数组的起点和 thought 字段 (跳过被转义的引号)
+PLAN_ACTIONS_RE = re.compile(r'(?<!\\)"actions"\s*:\s*\[')
+PLAN_THOUGHT_RE = re.compile(r'(?<!\\)"thought"\s*:\s*"((?:[^"\\]|\\.)*)"')
+
+
+class ActionStreamParser:
+    """增量解析模型输出的 JSON 计划：actions 数组中的对象一旦完整就立即返回
+
+    只做括号/字符串状态扫描，不依赖完整 JSON，因此模型还在输出后面的操作时前面的操作就可以开始执行。
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.thought = None
+        self._pos = None         # 下一个待扫描的位置 (找到 actions 数组之前为 None)
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._object_start = 0
+        self.done = False        # actions 数组已结束
+
+    def feed(self, delta):
+        """追加一段模型输出，返回本段中新完成的操作列表"""
+        self.text += delta
+        if self.thought is None:
+            match = PLAN_THOUGHT_RE.search(self.text)
+            if match:
+                try:
+                    self.thought = json.loads(f'"{match.group(1)}"', strict=False)
+                except ValueError:
+                    self.thought = match.group(1)
+        if self._pos is None:
+            match = PLAN_ACTIONS_RE.search(self.text)
+            if not match:
+                return []
+            self._pos = match.end()
+
+        actions = []
+        text = self.text
+        i = self._pos
+        while i < len(text) and not self.done:
+            ch = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch == "{":
+                if self._depth == 0:
+                    self._object_start = i
+                self._depth += 1
+            elif ch == "}":
+                self._depth -= 1
+                if self._depth == 0:
+                    try:
+                        actions.append(json.loads(text[self._object_start:i + 1]))
+                    except ValueError as e:
+                        print(f"[!] 无法解析流式输出中的操作: {e}")
+            elif ch == "]" and self._depth == 0:
+                self.done = True
+            i += 1
+        self._pos = i
+        return actions
+
+    def result(self):
+        """完整输出对应的计划 (清理 Markdown 后整体解析)；无法解析时返回 None"""
+        content = self.text.replace("```json", "").replace("```", "").strip()
+        try:
+            return json.loads(content)
+        except ValueError:
+            return None
+
+
+def parse_plan(content):
+    """解析模型输出的 JSON 计划 (去掉 Markdown 代码块标记)"""
+    content = content.replace("```json", "").replace("```", "").strip()
+    if content.startswith("```json"):
+        content = content[7:]
+    if content.endswith("```"):
+        content = content[:-3]
+    return json.loads(content)
+
+
+# ---- 战斗模拟 ----
+# 搜索中随从表示为 (攻击力, 生命值, 圣盾, 嘲讽)；英雄只计生命值 + 护甲 (受到攻击时不反击)
+FACE_WEIGHT = 0.5  # 没有斩杀时，每点打脸伤害折算的场面价值
+
+
+def _combat_unit(minion):
+    return (minion.get("atk", 0), minion.get("health", 0), bool(minion.get("divine_shield")), bool(minion.get("taunt")))
+
+
+def _take_damage(unit, damage):
+    """unit 受到 damage 点伤害后的状态 (圣盾抵消一次伤害)，死亡返回 None"""
+    if damage <= 0:
+        return unit
+    if unit[2]:
+        return (unit[0], unit[1], False, unit[3])
+    health = unit[1] - damage
+    return None if health <= 0 else (unit[0], health, unit[2], unit[3])
+
+
+def _unit_value(unit):
+    """场面价值：攻击力 + 生命值，圣盾 +2，嘲讽 +1；死亡为 0"""
+    if unit is None:
+        return 0
+    return unit[0] + unit[1] + (2 if unit[2] else 0) + (1 if unit[3] else 0)
+
+
+class CombatEvaluator:
+    """NumPy 批量评估攻击方案
+
+    把攻击者和目标编码成攻击力 / 生命值 / 圣盾 / 嘲讽数组，一次算出所有 (攻击者, 目标) 配对的结果，
+    以及每个目标被每个攻击者子集 (按攻击者顺序依次攻击) 攻击后的结果，代替逐个子集的 Python 循环。
+    攻击者顺序即攻击顺序；7 个攻击者 x 7 个目标时是一个 7 x 128 的批次。
+    """
+
+    def __init__(self, attackers, defenders):
+        mine = np.array(attackers, dtype=np.int64).reshape(-1, 4)
+        enemy = np.array(defenders, dtype=np.int64).reshape(-1, 4)
+        self.atk, self.health, self.shield = mine[:, 0], mine[:, 1], mine[:, 2].astype(bool)
+        self.value = mine[:, 0] + mine[:, 1] + 2 * mine[:, 2] + mine[:, 3]
+        self.enemy_atk, self.enemy_health = enemy[:, 0], enemy[:, 1]
+        self.enemy_shield, self.enemy_taunt = enemy[:, 2].astype(bool), enemy[:, 3]
+        self.enemy_value = enemy[:, 0] + enemy[:, 1] + 2 * enemy[:, 2] + enemy[:, 3]
+        self.masks = np.arange(1 << len(mine))
+        # bits[m, b]: 子集 m 是否包含第 b 个攻击者
+        self.bits = (self.masks[:, None] >> np.arange(len(mine))) & 1 == 1
+
+    @classmethod
+    def from_boards(cls, my_minions, enemy_minions):
+        return cls([_combat_unit(m) for m in my_minions], [_combat_unit(m) for m in enemy_minions])
+
+    def face_damage(self):
+        """每个子集的攻击力之和 (未使用的攻击者打脸时的伤害)"""
+        return self.bits.astype(np.int64) @ self.atk
+
+    def pairings(self):
+        """所有 (攻击者, 目标) 单次攻击的结果，均为 攻击者数 x 目标数 的数组
+
+        kills: 目标被击杀；survives: 攻击者存活；loss: 攻击者损失的场面价值
+        """
+        hit = self.enemy_atk[None, :] > 0
+        shield = self.shield[:, None]
+        survives = ~hit | shield | (self.health[:, None] > self.enemy_atk[None, :])
+        after = np.where(~hit, self.value[:, None],
+                         np.where(shield, self.value[:, None] - 2,
+                                  np.where(survives, self.value[:, None] - self.enemy_atk[None, :], 0)))
+        kills = (self.atk[:, None] > 0) & ~self.enemy_shield[None, :] & (self.atk[:, None] >= self.enemy_health[None, :])
+        return {"kills": kills, "survives": survives, "loss": self.value[:, None] - after}
+
+    def subsets(self):
+        """每个目标被每个攻击者子集攻击的结果，均为 目标数 x 子集数 的数组
+
+        gain: 敌方价值损失 - 己方价值损失；killed: 目标被击杀；
+        valid: 可用的方案 (目标死后子集中没有多余的攻击者，且击杀目标或只有一个攻击者)
+        """
+        loss = self.pairings()["loss"]
+        shape = (len(self.enemy_atk), len(self.masks))
+        health = np.broadcast_to(self.enemy_health[:, None], shape).copy()
+        shield = np.broadcast_to(self.enemy_shield[:, None], shape).copy()
+        dead = np.zeros(shape, dtype=bool)
+        wasted = np.zeros(shape, dtype=bool)
+        spent = np.zeros(shape, dtype=np.int64)
+        for b, atk in enumerate(self.atk):
+            used = self.bits[None, :, b]
+            wasted |= used & dead
+            active = used & ~dead
+            spent += active * loss[b][:, None]
+            if atk <= 0:
+                continue
+            popped = active & shield
+            damaged = active & ~shield
+            shield &= ~popped
+            health -= damaged * atk
+            dead |= damaged & (health <= 0)
+        remaining = np.where(dead, 0, self.enemy_atk[:, None] + health + 2 * shield + self.enemy_taunt[:, None])
+        single = (self.masks & (self.masks - 1)) == 0
+        valid = ~wasted & (dead | single[None, :]) & (self.masks[None, :] > 0)
+        return {"gain": self.enemy_value[:, None] - remaining - spent, "killed": dead, "valid": valid}
+
+
+class CombatSearch:
+    """随从战斗搜索：斩杀与交换 (启发式)
+
+    输入为 get_my_board() / get_opp_board() / get_hero_state() 的数据，模拟攻击力、生命值、圣盾、嘲讽和护甲
+    (不模拟亡语、风怒、剧毒、奥秘等效果)。
+
+    每个敌方随从由己方可攻击随从的一个子集攻击 (子集内攻击力低的先打，用来破圣盾)，
+    按 "嘲讽在前" 的顺序对敌方随从做子集 DP：状态为 (已使用的攻击者集合, 是否还有嘲讽存活)，
+    剩下的攻击者在没有嘲讽时打脸。7v7 时状态数为 2 x 128，几毫秒内完成。
+    每个目标被各子集攻击的结果由 CombatEvaluator 一次批量算出。
+    为控制分支数，不击杀目标的攻击只考虑单个随从 (破圣盾 / 削血)：多个随从合力削血但不击杀的方案
+    不在搜索范围内，因此 best_trades 不保证最优 (小场面上与穷举对比，约 0.5% 的局面次优)。
+    """
+
+    def __init__(self, my_minions, enemy_minions, enemy_hero):
+        self.my_units = [_combat_unit(m) for m in my_minions]
+        self.enemy_units = [_combat_unit(m) for m in enemy_minions]
+        # 可攻击的随从 (原始下标)，攻击力从低到高 (同一目标的攻击顺序)
+        self.ready = sorted((i for i, m in enumerate(my_minions) if m.get("can_attack") and m.get("atk", 0) > 0),
+                            key=lambda i: self.my_units[i][0])
+        self.enemy_life = enemy_hero.get("health", 0) + enemy_hero.get("armor", 0)
+        # 嘲讽在前
+        self.targets = sorted(range(len(enemy_minions)), key=lambda j: not self.enemy_units[j][3])
+        self.taunts = sum(1 for j in self.targets if self.enemy_units[j][3])
+        self._dp = None
+
+    @classmethod
+    def from_state(cls, state):
+        return cls(state.get("my_minions") or [], state.get("enemy_minions") or [], state.get("enemy_hero") or {})
+
+    def _subset_tables(self):
+        """各目标 (按 self.targets 顺序) 被各攻击者子集攻击的结果：[(子集, 收益, 是否击杀)]
+
+        收益 = 敌方价值损失 - 己方价值损失
+        """
+        evaluator = CombatEvaluator([self.my_units[i] for i in self.ready],
+                                    [self.enemy_units[j] for j in self.targets])
+        self._atk_sum = evaluator.face_damage().tolist()
+        result = evaluator.subsets()
+        tables = []
+        for gain, killed, valid in zip(result["gain"].tolist(), result["killed"].tolist(), result["valid"].tolist()):
+            tables.append([(mask, gain[mask], killed[mask]) for mask in range(len(valid)) if valid[mask]])
+        return tables
+
+    def _solve(self, stages):
+        """子集 DP 推进到处理完前 stages 个目标；记录每一步的来源，用于还原攻击顺序"""
+        n = len(self.ready)
+        size = 1 << n
+        neg = float("-inf")
+        if self._dp is None:
+            self._tables = self._subset_tables()
+            self._dp = [[neg] * size, [neg] * size]  # dp[还有嘲讽存活][已使用的攻击者]
+            self._dp[0][0] = 0.0
+            self._stages = []
+            self._after_taunts = self._dp[0]
+        while len(self._stages) < stages:
+            k = len(self._stages)
+            is_taunt = k < self.taunts
+            table = self._tables[k]
+            nd = [[neg] * size, [neg] * size]
+            parent = {}
+            for blocked in (0, 1):
+                row = self._dp[blocked]
+                for mask in range(size):
+                    value = row[mask]
+                    if value == neg:
+                        continue
+                    # 不攻击该随从
+                    b = 1 if blocked or is_taunt else 0
+                    if nd[b][mask] < value:
+                        nd[b][mask] = value
+                        parent[(b, mask)] = (blocked, mask, 0)
+                    if blocked and not is_taunt:
+                        continue  # 嘲讽还在，不能攻击其他随从
+                    for sub, gain, killed in table:
+                        if sub & mask:
+                            continue
+                        b = 1 if blocked or (is_taunt and not killed) else 0
+                        if nd[b][mask | sub] < value + gain:
+                            nd[b][mask | sub] = value + gain
+                            parent[(b, mask | sub)] = (blocked, mask, sub)
+            self._stages.append(parent)
+            self._dp = nd
+            if k + 1 == self.taunts:
+                self._after_taunts = nd[0]
+
+    def _trace(self, stage_count, blocked, mask):
+        """从第 stage_count 个目标处理完的状态回溯，返回 [(目标, 攻击者原始下标列表)]"""
+        assignment = []
+        for k in range(stage_count - 1, -1, -1):
+            blocked, prev_mask, sub = self._stages[k][(blocked, mask)]
+            if sub:
+                attackers = [self.ready[bit] for bit in range(len(self.ready)) if sub >> bit & 1]
+                assignment.append((self.targets[k], attackers))
+            mask = prev_mask
+        assignment.reverse()
+        return assignment
+
+    def find_lethal(self):
+        """能斩杀时返回 ATTACK 操作列表 (先解嘲讽，再由攻击力高的随从打脸，够斩杀即停)，否则返回 None"""
+        if not self.ready or self.enemy_life <= 0:
+            return None
+        if sum(self.my_units[i][0] for i in self.ready) < self.enemy_life:
+            return None
+        self._solve(self.taunts)  # 斩杀只需要解嘲讽，其余随从不用考虑
+        full = (1 << len(self.ready)) - 1
+        best = None
+        for mask, value in enumerate(self._after_taunts):
+            if value != float("-inf") and self._atk_sum[full ^ mask] >= self.enemy_life:
+                # 解嘲讽用的攻击者越少越好
+                if best is None or bin(mask).count("1") < bin(best).count("1"):
+                    best = mask
+        if best is None:
+            return None
+        assignment = self._trace(self.taunts, 0, best) if self.taunts else []
+        face, damage = [], 0
+        for bit in sorted((b for b in range(len(self.ready)) if not (best >> b & 1)),
+                          key=lambda b: -self.my_units[self.ready[b]][0]):
+            if damage >= self.enemy_life:
+                break
+            face.append(self.ready[bit])
+            damage += self.my_units[self.ready[bit]][0]
+        return self._actions(assignment, face)
+
+    def best_trades(self):
+        """非斩杀时搜索范围内价值最高的攻击方案，返回 (收益, ATTACK 操作列表)"""
+        if not self.ready:
+            return 0.0, []
+        self._solve(len(self.targets))
+        full = (1 << len(self.ready)) - 1
+        best, best_key = float("-inf"), None
+        for blocked in (0, 1):
+            for mask, value in enumerate(self._dp[blocked]):
+                if value == float("-inf"):
+                    continue
+                if not blocked:
+                    value += FACE_WEIGHT * self._atk_sum[full ^ mask]
+                if value > best:
+                    best, best_key = value, (blocked, mask)
+        blocked, mask = best_key
+        assignment = self._trace(len(self.targets), blocked, mask)
+        face = [] if blocked else [self.ready[b] for b in range(len(self.ready)) if not (mask >> b & 1)]
+        return best, self._actions(assignment, face)
+
+    def _actions(self, assignment, face):
+        """把 (目标, 攻击者) 方案转换为 ATTACK 操作
+
+        下标都是规划时 (搜索输入) 的场面位置，与提示词里的下标一致；前面的攻击中有随从死亡时，
+        由 PlanValidator 在执行时按实体 ID 换算成当前下标。这里只模拟伤害，用来写操作说明。
+        """
+        my_units = dict(enumerate(self.my_units))
+        enemy_units = dict(enumerate(self.enemy_units))
+        actions = []
+        for target, attackers in assignment:
+            for i in attackers:
+                attacker, defender = my_units[i], enemy_units[target]
+                actions.append({"type": "ATTACK", "attacker_index": i, "target_type": "minion",
+                                "target_index": target,
+                                "desc": f"随从 {attacker[0]}/{attacker[1]} 攻击 {defender[0]}/{defender[1]}"})
+                my_units[i] = _take_damage(attacker, defender[0])
+                enemy_units[target] = _take_damage(defender, attacker[0])
+        for i in face:
+            attacker = my_units[i]
+            actions.append({"type": "ATTACK", "attacker_index": i, "target_type": "enemy_hero",
+                            "desc": f"随从 {attacker[0]}/{attacker[1]} 攻击敌方英雄"})
+        return actions
+
+
+def combat_hint(state):
+    """给模型的战斗提示 (英文，与常规回合提示词一致)；没有可攻击的随从时返回空字符串"""
+    search = CombatSearch.from_state(state)
+    if not search.ready:
+        return ""
+    lethal = search.find_lethal()
+    if lethal:
+        return f"Combat engine: LETHAL with minion attacks only: {json.dumps(lethal, ensure_ascii=False)}"
+    score, actions = search.best_trades()
+    return (f"Combat engine: no board lethal. Best minion attacks (value {score:+.1f}): "
+            f"{json.dumps(actions, ensure_ascii=False)}")
+
+
+MULLIGAN_KEEP_COST = 3   # 起手全部不高于该费用时直接保留
+
+
+def local_plan(state):
+    """本地规则：不需要模型就能确定的局面直接给出计划，其余返回 None
+
+    - 只有一个选项的发现/抉择；
+    - 调度阶段起手全是低费牌 (全部保留)；
+    - 场攻斩杀：CombatSearch 找到先解嘲讽、再打脸的斩杀线；
+    - 没有可打出的牌、没有可攻击的随从、也不够使用英雄技能：只能结束回合。
+    """
+    hand = state.get("hand_cards") or []
+    if state.get("game_phase") == "MULLIGAN":
+        if hand and all(card.get("cost", 0) <= MULLIGAN_KEEP_COST for card in hand):
+            return {"thought": "起手都是低费牌，全部保留。",
+                    "actions": [{"type": "MULLIGAN_CONFIRM", "desc": "确认"}]}
+        return None
+
+    choices = state.get("choices") or []
+    if choices:
+        if len(choices) == 1:
+            return {"thought": "只有一个选项。",
+                    "actions": [{"type": "CHOOSE", "index": 0, "desc": f"选择 {choices[0].get('name')}"}]}
+        return None
+
+    search = CombatSearch.from_state(state)
+    lethal = search.find_lethal()
+    if lethal:
+        return {"thought": "场攻足够，斩杀。", "actions": lethal}
+
+    mana = state.get("mana", 0)
+    my_hero = state.get("my_hero") or {}
+    power_cost = my_hero.get("power_cost")
+    if (not search.ready and not my_hero.get("atk") and (power_cost is None or mana < power_cost)
+            and not any(card.get("cost", 0) <= mana for card in hand)):
+        return {"thought": "没有可以进行的操作，结束回合。", "actions": [{"type": "END_TURN", "desc": "结束回合"}]}
+    return None
+
+
+def predict_turn_start(state):
+    """由对手回合的状态预测我方回合开始时的局面：回合 +1、法力水晶 +1 并回满、随从可以攻击
+    (对手回合中被冻结的随从在我方回合仍然冻结，不能攻击)。
+
+    抽到的牌无法预知，手牌保持不变 (新牌会加在最右侧，不影响已有手牌的下标)。
+    """
+    max_mana = min(10, (state.get("max_mana") or 0) + 1)
+    predicted = dict(state, turn=(state.get("turn") or 0) + 1, mana=max_mana, max_mana=max_mana, choices=[])
+    predicted["my_minions"] = [dict(minion, can_attack=not minion.get("frozen")) for minion in state.get("my_minions", [])]
+    return predicted
+
+
+class PlanValidator:
+    """执行计划的每一步之前，用追踪器的当前状态校验并重映射下标
+
+    模型给出的 hand_index / attacker_index / target_index 都是相对规划时的局面，
+    打出一张牌、随从死亡之后下标就会偏移。创建时记录各区域的实体 ID，执行时按实体 ID 换算成当前下标
+    (超出规划时数量的下标指规划之后才出现的实体，按它们当前在区域中的位置排列)，再检查法力值、随从能否攻击和嘲讽。
+    失效原因用英文写，会作为提示发给模型。
+    """
+
+    def __init__(self, tracker):
+        self.tracker = tracker
+        self._ids = {zone: [e.id for e in self._entities(zone)] for zone in ("hand", "mine", "enemy")}
+
+    def _entities(self, zone):
+        pid = self.tracker.friendly_player_id
+        if zone == "hand":
+            return self.tracker._zone_entities(pid, Zone.HAND)
+        player = pid if zone == "mine" else 3 - pid
+        return self.tracker._zone_entities(player, Zone.PLAY, CardType.MINION)
+
+    def _resolve(self, zone, index):
+        """规划时的下标 -> (当前实体, 当前下标)；实体已离开该区域时返回 (None, None)
+
+        index 超出规划时的数量时，取规划之后才进入该区域的实体中按当前位置排第 index - 规划时数量 个的
+        (新抽到的牌总在手牌最右侧，此时与模型的预期一致)。
+        """
+        current = self._entities(zone)
+        bound = self._ids[zone]
+        if index < 0:
+            positions = []
+        elif index < len(bound):
+            positions = [i for i, e in enumerate(current) if e.id == bound[index]]
+        else:
+            known = set(bound)
+            positions = [i for i, e in enumerate(current) if e.id not in known][index - len(bound):]
+        if not positions:
+            return None, None
+        return current[positions[0]], positions[0]
+
+    def hand_size(self):
+        return len(self._entities("hand"))
+
+    def check(self, action):
+        """返回 (重映射后的操作, None)；操作在当前局面下已无法执行时返回 (None, 原因)"""
+        kind = action.get("type")
+        mana = self.tracker.get_mana_info()[0]
+        action = dict(action)
+        if kind in ("PLAY_MINION", "PLAY_SPELL_AOE", "PLAY_TARGET"):
+            idx = action.get("hand_index", 0)
+            card, action["hand_index"] = self._resolve("hand", idx)
+            if card is None:
+                return None, f"hand card {idx} is no longer in hand"
+            cost = card.tags.get(GameTag.COST, 0)
+            if cost > mana:
+                return None, f"hand card {idx} costs {cost} but only {mana} mana is left"
+        elif kind == "ATTACK":
+            idx = action.get("attacker_index", 0)
+            attacker, action["attacker_index"] = self._resolve("mine", idx)
+            if attacker is None:
+                return None, f"my minion {idx} is no longer on the board"
+            tags = attacker.tags
+            if tags.get(GameTag.EXHAUSTED, 0) or tags.get(GameTag.FROZEN, 0) or tags.get(GameTag.ATK, 0) <= 0:
+                return None, f"my minion {idx} cannot attack now"
+            taunts = {e.id for e in self._entities("enemy") if e.tags.get(GameTag.TAUNT, 0) == 1}
+            if taunts and action.get("target_type") != "minion":
+                return None, "the enemy has a Taunt minion, attack it first"
+        elif kind == "HERO_POWER":
+            powers = self.tracker._exporter.entities_in(self.tracker.friendly_player_id, Zone.PLAY, CardType.HERO_POWER)
+            if powers:
+                if powers[0].tags.get(GameTag.EXHAUSTED, 0):
+                    return None, "the hero power was already used this turn"
+                cost = powers[0].tags.get(GameTag.COST, 0)
+                if cost > mana:
+                    return None, f"the hero power costs {cost} but only {mana} mana is left"
+        elif kind == "CHOOSE":
+            idx = action.get("index", 0)
+            if not 0 <= idx < len(self.tracker.get_choices()):
+                return None, f"there is no choice option {idx}"
+
+        if kind in ("PLAY_TARGET", "ATTACK") and action.get("target_type") == "minion":
+            idx = action.get("target_index", 0)
+            target, action["target_index"] = self._resolve("enemy", idx)
+            if target is None:
+                return None, f"enemy minion {idx} is no longer on the board"
+            if kind == "ATTACK" and target.tags.get(GameTag.TAUNT, 0) != 1 and taunts:
+                return None, "the enemy has a Taunt minion, attack it first"
+        return action, None
+
+
+class SpeculativePlanner:
+    """对手回合中预先规划下一回合
+
+    对手回合的局面每变化一次，就为预测的回合开始局面排队一次规划 (后台线程串行请求模型，
+    排队中的旧局面直接被新局面替换)。回合开始时 take() 检查实际局面是否与预测一致：
+    一致则直接返回计划，省去一次模型往返；不一致则丢弃 (还没开始的请求不会再发出)。
+    规划还没完成时最多等待 HEDGE_DELAY 秒，仍未完成就交给主循环直接请求模型。
+    使用独立的 LLMRouter / PromptEncoder，不与主循环的请求共享状态。
+    """
+
+    def __init__(self, app):
+        self.app = app
+        config = app.config
+        self.router = LLMRouter.from_config(config)
+        self.encoder = PromptEncoder(config.get("PROMPT_TOKEN_BUDGET", 1200))
+        self.hits = 0
+        self.misses = 0
+        self._cond = threading.Condition()
+        self._job = None      # 最近一次预测 (可能在排队、规划中或已完成)
+        self._queued = None   # 等待后台线程处理的预测
+        self._worker = None
+        self._closed = False
+
+    def observe(self, state):
+        """对手回合的新状态：预测的回合开始局面有变化时重新排队规划"""
+        predicted = predict_turn_start(state)
+        key = state_fingerprint(predicted)
+        with self._cond:
+            if self._closed or (self._job is not None and self._job["key"] == key):
+                return
+            self._job = self._queued = {"key": key, "state": predicted, "plan": None, "done": threading.Event()}
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, daemon=True)
+                self._worker.start()
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._queued is None and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                job, self._queued = self._queued, None
+            try:
+                prompt = self.app.build_prompt(job["state"], self.encoder)
+                job["plan"] = self.router.request_plan(self.app.build_messages(prompt, self.encoder))
+            except Exception as e:
+                print(f"[!] 预先规划失败: {e}")
+            finally:
+                job["done"].set()
+
+    @staticmethod
+    def _matches(predicted, state):
+        """实际局面是否与预测一致 (牌库不比较；实际手牌允许在最右侧多出新抽的牌)"""
+        hand = state.get("hand_cards", [])
+        known = len(predicted.get("hand_cards", []))
+        if len(hand) < known:
+            return False
+        return (state_fingerprint(dict(state, hand_cards=hand[:known], my_deck=None))
+                == state_fingerprint(dict(predicted, my_deck=None)))
+
+    def take(self, state):
+        """回合开始时取出预先规划的计划；局面与预测不符、规划失败时返回 None"""
+        with self._cond:
+            job, self._job = self._job, None
+            if self._queued is job:
+                self._queued = None  # 还没开始，直接取消
+                job = None
+        if job is None:
+            return None
+        if not self._matches(job["state"], state):
+            self.misses += 1
+            print("[*] 回合开始的局面与预测不符，丢弃预先规划的计划")
+            return None
+        # 不等到请求超时：慢的后端会让回合开始时白等，不如直接请求 (主循环的请求会竞速)
+        if not job["done"].wait(self.router.hedge_delay):
+            self.misses += 1
+            print("[*] 预先规划尚未完成，改为直接请求模型")
+            return None
+        plan = job["plan"]
+        if not plan or not plan.get("actions"):
+            self.misses += 1
+            return None
+        actions = plan["actions"]
+        if len(state.get("hand_cards", [])) > len(job["state"].get("hand_cards", [])):
+            # 预测时不知道新抽的牌：先不结束回合，执行完后按实际局面 (包含新牌) 再决策一次
+            actions = [action for action in actions if action.get("type") != "END_TURN"]
+            if not actions:
+                self.misses += 1
+                return None
+        self.hits += 1
+        return dict(plan, actions=actions)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._job = self._queued = None
+            self._cond.notify()
+        self.router.close()
+
+
+# ---- 输入后端 ----
+# 接口：size() / screenshot() / move_to(x, y, duration) / drag_to(x, y, duration) / click(x=None, y=None)
+# screenshot() 返回 (整屏图像, 转换到 BGR 的 cv2 颜色代码，None 表示已是 BGR)
+
+
+class PyAutoGUIInput:
+    """通过 pyautogui 操作鼠标 (跨平台)；每次调用后停顿 pause 秒，鼠标移到屏幕左上角可强制终止程序"""
+
+    name = "pyautogui"
+
+    def __init__(self, pause=0.1):
+        pyautogui.FAILSAFE = True
+        pyautogui.PAUSE = pause
+
+    def size(self):
+        return tuple(pyautogui.size())
+
+    def screenshot(self):
+        return np.asarray(pyautogui.screenshot()), cv2.COLOR_RGB2BGR
+
+    def move_to(self, x, y, duration=0.0):
+        pyautogui.moveTo(x, y, duration=duration)
+
+    def drag_to(self, x, y, duration=0.0):
+        pyautogui.dragTo(x, y, duration=duration, button="left")
+
+    def click(self, x=None, y=None):
+        pyautogui.click(x, y)
+
+
+class FailSafeError(Exception):
+    """鼠标位于屏幕左上角：用户要求强制停止 (XTestInput 的 failsafe，对应 pyautogui.FailSafeException)"""
+
+
+class XTestInput:
+    """通过 X11 XTest 扩展直接注入鼠标事件 (需要 python-xlib，仅 Linux/X11)
+
+    没有 pyautogui 的逐点 tween 计算和平台层封装；带 duration 的移动按 STEP 秒一步线性插值，
+    duration 为 0 时直接跳到目标点。与 pyautogui 一样，每次调用前检查鼠标是否在屏幕左上角，是则抛出 FailSafeError。
+    """
+
+    name = "xtest"
+    STEP = 1 / 120
+
+    def __init__(self, pause=0.0):
+        self._X = importlib.import_module("Xlib.X")
+        self._xtest = importlib.import_module("Xlib.ext.xtest")
+        self.display = importlib.import_module("Xlib.display").Display()
+        if not self.display.has_extension("XTEST"):
+            raise RuntimeError("X 服务器不支持 XTEST 扩展")
+        self.root = self.display.screen().root
+        self.pause = pause
+
+    def size(self):
+        screen = self.display.screen()
+        return screen.width_in_pixels, screen.height_in_pixels
+
+    def screenshot(self):
+        width, height = self.size()
+        raw = self.root.get_image(0, 0, width, height, self._X.ZPixmap, 0xFFFFFFFF).data
+        return np.frombuffer(raw, dtype=np.uint8).reshape(height, width, 4), cv2.COLOR_BGRA2BGR
+
+    def _fake(self, event, **kwargs):
+        self._xtest.fake_input(self.display, event, **kwargs)
+        self.display.sync()
+
+    def _check_failsafe(self):
+        """查询鼠标位置 (后续插值的起点)；位于屏幕左上角时强制停止"""
+        pointer = self.root.query_pointer()
+        if pointer.root_x == 0 and pointer.root_y == 0:
+            raise FailSafeError("鼠标位于屏幕左上角，强制停止")
+        return pointer
+
+    def _glide(self, pointer, x, y, duration):
+        if duration > 0:
+            steps = int(duration / self.STEP)
+            for i in range(1, steps):
+                t = i / steps
+                self._fake(self._X.MotionNotify, x=int(pointer.root_x + (x - pointer.root_x) * t),
+                           y=int(pointer.root_y + (y - pointer.root_y) * t))
+                time.sleep(self.STEP)
+        self._fake(self._X.MotionNotify, x=int(x), y=int(y))
+
+    def move_to(self, x, y, duration=0.0):
+        self._glide(self._check_failsafe(), x, y, duration)
+        time.sleep(self.pause)
+
+    def drag_to(self, x, y, duration=0.0):
+        pointer = self._check_failsafe()
+        self._fake(self._X.ButtonPress, detail=1)
+        self._glide(pointer, x, y, duration)
+        self._fake(self._X.ButtonRelease, detail=1)
+        time.sleep(self.pause)
+
+    def click(self, x=None, y=None):
+        pointer = self._check_failsafe()
+        if x is not None:
+            self._glide(pointer, x, y, 0)
+        self._fake(self._X.ButtonPress, detail=1)
+        self._fake(self._X.ButtonRelease, detail=1)
+        time.sleep(self.pause)
+
+
+class MockInput:
+    """不操作真实鼠标，只记录带时间戳的事件 events = [(时间, 类型, x, y)]，用于无显示器的测试与日志回放
+
+    realtime=False 时不等待 duration / pause，整个流程全速运行；
+    on_input(事件) 在每次拖拽和点击后调用 (例如回放下一段录制的日志)。screenshot() 返回 frame (BGR，默认全黑)。
+    """
+
+    name = "mock"
+
+    def __init__(self, size=(1920, 1080), realtime=False, pause=0.0, on_input=None, clock=time.perf_counter):
+        self._size = tuple(size)
+        self.realtime = realtime
+        self.pause = pause
+        self.on_input = on_input
+        self.clock = clock             # 事件时间戳的来源 (回放时为虚拟时钟)
+        self.events = []
+        self.position = (0, 0)
+        self.frame = None
+        self.screenshots = 0
+        self._start = clock()
+
+    def size(self):
+        return self._size
+
+    def screenshot(self):
+        self.screenshots += 1
+        if self.frame is None:
+            self.frame = np.zeros((self._size[1], self._size[0], 3), dtype=np.uint8)
+        return self.frame, None
+
+    def _record(self, kind, x, y, duration=0.0):
+        if self.realtime:
+            time.sleep(duration)
+        self.position = (x, y)
+        event = (self.clock() - self._start, kind, x, y)
+        self.events.append(event)
+        if kind != "move" and self.on_input:
+            self.on_input(event)
+        if self.realtime:
+            time.sleep(self.pause)  # 与 pyautogui.PAUSE 一致：每次调用之后停顿
+
+    def move_to(self, x, y, duration=0.0):
+        self._record("move", x, y, duration)
+
+    def drag_to(self, x, y, duration=0.0):
+        self._record("drag", x, y, duration)
+
+    def click(self, x=None, y=None):
+        if x is None:
+            x, y = self.position
+        self._record("click", x, y)
+
+
+INPUT_BACKENDS = {"pyautogui": PyAutoGUIInput, "xtest": XTestInput, "mock": MockInput}
+
+
+def create_input(config):
+    """按 INPUT_BACKEND 创建输入后端；XTest 不可用 (没有 python-xlib / 不是 X11) 时退回 pyautogui"""
+    name = config.get("INPUT_BACKEND", "pyautogui")
+    pause = config.get("INPUT_PAUSE", 0.1)
+    if name == "mock":
+        return MockInput(config.get("SCREEN_SIZE", (1920, 1080)))
+    if name == "xtest":
+        try:
+            return XTestInput(pause)
+        except Exception as e:
+            print(f"[!] 无法使用 XTest 输入 ({e})，改用 pyautogui")
+    elif name not in INPUT_BACKENDS:
+        print(f"[!] 未知的 INPUT_BACKEND: {name}，使用 pyautogui")
+    return PyAutoGUIInput(pause)
+
+
+# ---- 截图 ----
+# HSV 颜色范围 (OpenCV 的 H 为 0-180)
+GREEN_HIGHLIGHT = ((35, 100, 100), (85, 255, 255))    # 可操作卡的绿光
+YELLOW_HIGHLIGHT = ((20, 100, 100), (35, 255, 255))   # 金色传说 / 部分抉择卡的黄光
+CHOICE_BANNER = ((100, 50, 50), (130, 255, 255))      # 发现/抉择横幅的深蓝色/紫色背景
+HAND_PROBE_OFFSETS = (0, -20, 20, -40, 40, -60, 60)   # 手牌中心的左右修正 (像素)
+
+
+class ScreenCapture:
+    """整屏单帧截图
+
+    grab() 截取一整帧到复用的 NumPy 缓冲区：装了 mss 时用 mss (Linux 下走 X11 共享内存)，
+    否则由输入后端截图 (source，如 pyautogui.screenshot())。HSV 图每帧转换一次，各颜色的 inRange 掩码在第一次使用时计算并转成积分图，
+    之后同一帧上任意矩形内的像素计数都是 O(1)，所有手牌位置的探测共用这一帧。
+    """
+
+    def __init__(self, screen_size, backend="auto", source=None):
+        self.screen_size = screen_size  # 返回鼠标坐标系下屏幕大小的函数 (与截图分辨率不同时按比例换算)
+        self.backend = backend
+        self.source = source            # 输入后端的截图函数，返回 (图像, 颜色代码)
+        self.frame = None
+        self._hsv = None
+        self._mss = None
+        self._integrals = {}
+        self._scale = (1.0, 1.0)
+        self.cache = {}  # 基于当前帧的计算结果 (如随从位置)，换帧时清空
+
+    def _grab_raw(self):
+        """截取整屏，返回 (图像, 转换到 BGR 的 cv2 颜色代码)"""
+        if self.backend in ("auto", "mss") and self._mss is None:
+            try:
+                self._mss = importlib.import_module("mss").mss()
+                self.backend = "mss"
+            except ImportError:
+                if self.backend == "mss":
+                    print("[!] 未安装 mss (pip install mss)，改由输入后端截图")
+                self.backend = "input"
+        if self.backend == "mss":
+            shot = self._mss.grab(self._mss.monitors[1])
+            return np.frombuffer(shot.raw, dtype=np.uint8).reshape(shot.height, shot.width, 4), cv2.COLOR_BGRA2BGR
+        return self.source()
+
+    def grab(self):
+        image, code = self._grab_raw()
+        self.load(image, code)
+        return self.frame
+
+    def load(self, image, code=None):
+        """放入一帧 (code 为转换到 BGR 的颜色代码，None 表示已是 BGR)；分辨率不变时复用缓冲区"""
+        height, width = image.shape[:2]
+        if self.frame is None or self.frame.shape[:2] != (height, width):
+            self.frame = np.empty((height, width, 3), dtype=np.uint8)
+            self._hsv = np.empty_like(self.frame)
+        if code is None:
+            np.copyto(self.frame, image)
+        else:
+            cv2.cvtColor(image, code, dst=self.frame)
+        cv2.cvtColor(self.frame, cv2.COLOR_BGR2HSV, dst=self._hsv)
+        self._integrals = {}
+        self.cache = {}
+        screen_w, screen_h = self.screen_size()
+        self._scale = (width / screen_w, height / screen_h)
+
+    def _integral(self, color_range):
+        table = self._integrals.get(color_range)
+        if table is None:
+            mask = cv2.inRange(self._hsv, np.array(color_range[0]), np.array(color_range[1]))
+            table = cv2.integral(mask)  # 掩码像素为 0/255，计数时再除以 255
+            self._integrals[color_range] = table
+        return table
+
+    def count(self, color_range, left, top, width, height):
+        """当前帧中矩形区域 (鼠标坐标系) 内颜色落在 color_range 的像素数"""
+        table = self._integral(color_range)
+        frame_h, frame_w = self.frame.shape[:2]
+        sx, sy = self._scale
+        x0, x1 = (min(max(int(v * sx), 0), frame_w) for v in (left, left + width))
+        y0, y1 = (min(max(int(v * sy), 0), frame_h) for v in (top, top + height))
+        return int(table[y1, x1] - table[y0, x1] - table[y1, x0] + table[y0, x0]) // 255
+
+
+# ---- 场面定位 ----
+# 随从总是在各自一行中居中排列，相对坐标 (宽度、高度的比例) 按 1920x1080 校准
+BOARD_ROWS = {"enemy": 0.37, "mine": 0.56}  # 随从中心的 y
+MINION_SPACING = 0.0667                     # 相邻随从中心的 x 间距
+MINION_SIZE = (0.052, 0.13)                 # 随从肖像 (椭圆) 的宽高
+LOCATOR_SCALE = 0.25                        # 模板匹配前的缩放比例
+LOCATOR_MIN_SCORE = 0.2                     # 峰值下限取得较低，误检由布局校验排除
+LOCATOR_CONFIDENT_SCORE = 0.3               # locate() 只采用不低于该得分的峰值
+
+
+def minion_layout(count, row_y, spacing=MINION_SPACING):
+    """一行 count 个随从的相对中心坐标"""
+    return [(0.5 + (i - (count - 1) / 2) * spacing, row_y) for i in range(count)]
+
+
+class BoardLocator:
+    """在一帧截图上定位随从
+
+    把随从所在的一行缩小到 LOCATOR_SCALE 后做边缘检测，用椭圆轮廓模板 (按尺寸缓存) 做模板匹配，
+    按得分从高到低取出相距接近一个随从间距的峰值，结果按帧缓存在 capture.cache 中。
+    locate() 以日志中的随从数量为准：可信的峰值恰好有这么多个、且能构成一行随从 (间距一致、居中，允许一处空位)
+    时使用识别结果，否则按配置的行高和间距计算布局坐标 (不再依赖固定的 7 个槽位，奇数/偶数个随从都能对准)。
+    """
+
+    def __init__(self, capture, rows=None, spacing=MINION_SPACING, size=MINION_SIZE):
+        self.capture = capture
+        self.rows = dict(BOARD_ROWS, **(rows or {}))
+        self.spacing = spacing
+        self.size = size
+        self._templates = {}
+
+    def _template(self, width, height):
+        template = self._templates.get((width, height))
+        if template is None:
+            template = np.zeros((height + 4, width + 4), dtype=np.uint8)
+            cv2.ellipse(template, ((width + 4) // 2, (height + 4) // 2), (width // 2, height // 2), 0, 0, 360, 255, 2)
+            template = cv2.GaussianBlur(template, (5, 5), 0)
+            self._templates[(width, height)] = template
+        return template
+
+    def detect(self, side):
+        """当前帧中一行随从的相对中心坐标 (按 x 排序)，附带匹配得分：[(x, y, 得分)]"""
+        key = ("minions", side)
+        if key in self.capture.cache:
+            return self.capture.cache[key]
+        frame = self.capture.frame
+        frame_h, frame_w = frame.shape[:2]
+        row_y = self.rows[side]
+        top = max(int((row_y - self.size[1]) * frame_h), 0)
+        bottom = min(int((row_y + self.size[1]) * frame_h), frame_h)
+        band = cv2.resize(frame[top:bottom], None, fx=LOCATOR_SCALE, fy=LOCATOR_SCALE, interpolation=cv2.INTER_AREA)
+        edges = cv2.GaussianBlur(cv2.Canny(cv2.cvtColor(band, cv2.COLOR_BGR2GRAY), 50, 150), (5, 5), 0)
+        template = self._template(max(int(self.size[0] * frame_w * LOCATOR_SCALE), 4),
+                                  max(int(self.size[1] * frame_h * LOCATOR_SCALE), 4))
+        found = []
+        if edges.shape[0] >= template.shape[0] and edges.shape[1] >= template.shape[1]:
+            scores = cv2.matchTemplate(edges, template, cv2.TM_CCOEFF_NORMED)
+            columns = scores.max(axis=0)
+            # 抑制半径接近一个间距：模板在肖像两侧 "相切" 的位置也有较弱的峰值
+            gap = max(int(self.spacing * frame_w * LOCATOR_SCALE * 0.9), 1)
+            while len(found) < 7:
+                x = int(columns.argmax())
+                score = float(columns[x])
+                if score < LOCATOR_MIN_SCORE:
+                    break
+                y = int(scores[:, x].argmax())
+                found.append(((x + template.shape[1] / 2) / LOCATOR_SCALE / frame_w,
+                              (top + (y + template.shape[0] / 2) / LOCATOR_SCALE) / frame_h, score))
+                columns[max(x - gap, 0):x + gap + 1] = -1
+        found.sort()
+        self.capture.cache[key] = found
+        return found
+
+    def _fits_layout(self, centers, row_y):
+        """识别出的中心能否构成一行随从：在行高附近、相邻间距约为一个 spacing，
+        最多有一处约两个 spacing 的空位 (拖入随从时整行会让出位置，此时各随从不在居中布局上)"""
+        if any(abs(y - row_y) > self.size[1] / 2 for _, y, _ in centers):
+            return False
+        steps = [(b - a) / self.spacing for (a, _, _), (b, _, _) in zip(centers, centers[1:])]
+        if not all(0.8 < step < 1.3 or 1.6 < step < 2.4 for step in steps) or sum(step > 1.6 for step in steps) > 1:
+            return False
+        # 两端随从的中点仍在屏幕中央 (空位两侧各让出半个间距)
+        return abs((centers[0][0] + centers[-1][0]) / 2 - 0.5) < self.spacing * 0.3
+
+    def locate(self, side, index, count):
+        """第 index 个随从的相对中心坐标；count 为已知的随从数量 (get_my_board / get_opp_board)
 
+        识别结果不可信 (得分低于 LOCATOR_CONFIDENT_SCORE 的峰值不计) 或数量与 count 不一致时，
+        使用配置的布局：识别出错时的偏差可能超过一个随从，布局坐标最多偏离半个间距。
+        """
+        row_y = self.rows[side]
+        found = self.detect(side) if self.capture.frame is not None else []
+        centers = [c for c in found if c[2] >= LOCATOR_CONFIDENT_SCORE]
+        if index < len(centers) == count and self._fits_layout(centers, row_y):
+            return centers[index][:2]
+        return minion_layout(max(count, index + 1), row_y, self.spacing)[index]
 
 
 class HearthstoneAutoPilot:
-    def __init__(self, overlay=None, config_path="config.json"):
-        self.overlay = overlay
-        self.log_overlay = overlay # Alias for consistency
+    def __init__(self, overlay=None, config_path="config.json", headless=None, clock=None, overrides=None):
         self.tracker = GameStateTracker()
         self.load_config(config_path)
+        self.config.update(overrides or {})
+        # 等待与超时都经过 clock：实时运行为 SystemClock，回放时为按录制日志推进的 ReplayClock
+        self.clock = clock or SystemClock()
+        self.stages = StageTimer()
+        # headless: 不创建悬浮窗、不操作鼠标、不截图，只解析日志并输出 AI 决策 (可在无显示器的机器上运行)
+        self.headless = self.config.get("HEADLESS", False) if headless is None else headless
+        if overlay is None and self.headless:
+            overlay = ConsoleOverlay()
+        self.overlay = overlay
+        self.log_overlay = overlay # Alias for consistency
 
-        self.last_tell = 0
-        self.client = OpenAI(
-            api_key=self.config["API_KEY"], base_url=self.config["BASE_URL"])
+        self.log_start = 0  # 首次读取日志的起始位置 (run() 中设置)；之后的读取位置由 LogTailer 维护
+        self.tailer = None  # LogTailer，在首次读取日志时创建
+        # 模型后端池 (每个后端复用连接，首次请求时才建立连接)，按延迟竞速 / 故障转移
+        self.router = LLMRouter.from_config(self.config)
+        self.decision_cache = DecisionCache(self.config.get("DECISION_CACHE_SIZE", 64),
+                                            self.config.get("DECISION_CACHE_TTL", 30), self.clock.monotonic)
+        # 输入后端 (鼠标)：headless 模式不操作鼠标；mock 后端不需要显示器，headless 下也可使用
+        self.input = None
+        if not self.headless or self.config.get("INPUT_BACKEND") == "mock":
+            self.input = create_input(self.config)
+        # mock 后端没有真实屏幕，截图也由它提供
+        capture_backend = "input" if isinstance(self.input, MockInput) else self.config.get("CAPTURE_BACKEND", "auto")
+        self.capture = ScreenCapture(self.get_screen_size, capture_backend, lambda: self.input.screenshot())
+        coordinates = self.config.get("COORDINATES", {})
+        self.locator = BoardLocator(self.capture,
+                                    {side: coordinates[key] for side, key in (("enemy", "ENEMY_BOARD_Y"), ("mine", "MY_BOARD_Y"))
+                                     if key in coordinates},
+                                    coordinates.get("MINION_SPACING", MINION_SPACING))
+        self.prompt_encoder = PromptEncoder(self.config.get("PROMPT_TOKEN_BUDGET", 1200))
+        self._last_fingerprint = None  # 最近一次执行过的局面
+        self._unreported = False       # execute_action 等待确认时读到的日志还没有生成过状态
+        self.plan_confirmed = False    # 最近一次执行的计划是否每一步都在日志中得到确认
+        self.validator = None          # 正在执行的计划的 PlanValidator
+        self.plan_rejected = None      # 计划中途失效的原因 (下一次决策时提示模型)
+        self.plan_aborted = False      # 最近一次的计划没有完整执行 (不写入决策缓存，重新决策)
+        self._replans = 0              # 同一局面上连续因计划失效而重新决策的次数
+        self._replan_fingerprint = None  # 最近一次计划失效时的局面
+        # 对手回合中预先规划下一回合 (会额外消耗模型调用)
+        self.planner = SpeculativePlanner(self) if self.config.get("SPECULATIVE_PLANNING", True) else None
         
         # 应用套牌代码
         if "DECK_CODE" in self.config:
             self.tracker.apply_deck_code(self.config["DECK_CODE"])
 
-        # 安全设置：鼠标移动到屏幕左上角(0,0)可强制终止程序
-        pyautogui.FAILSAFE = True
-        pyautogui.PAUSE = 1.0  # 每次点击后暂停1秒，模拟人类迟钝
-
         self.log(f"[*] ai-hearthstone 已启动。移至屏幕左上角可强制停止。")
         self.last_is_my_turn = False
 
@@ -755,7 +3076,7 @@ class HearthstoneAutoPilot:
         if self.overlay:
             # 这是一个简单的线程安全调用方式 (Tkinter 不是完全线程安全的，但 text update 通常 ok，或者用 after)
             # 为了更稳健，我们使用 root.after
-            self.overlay.root.after(0, self.overlay.update_text, text)
+            self.overlay.post(self.overlay.update_text, text)
 
     def load_config(self, config_path):
         """加载配置文件"""
@@ -770,27 +3091,18 @@ class HearthstoneAutoPilot:
     def get_game_state(self):
         """读取日志获取真实状态（使用 hslog 库）"""
         log_path = self.config.get("LOG_PATH", "Power.log")
-        if not os.path.exists(log_path):
-            return None
-
-        content = ""
-        try:
-            with open(log_path, 'r', encoding='utf-8', errors='ignore') as f:
-                f.seek(self.last_tell)
-                new_lines = f.readlines()
-                if new_lines:
-                    self.last_tell = f.tell()
-                    content = "".join(new_lines)
-        except Exception as e:
-            print(f"[!] 读取日志出错: {e}")
-            return None
+        if self.tailer is None:
+            self.tailer = LogTailer(log_path, self.log_start, on_reset=self.tracker.on_log_rotated)
 
-        if not content:
+        # 执行操作时已经读过的日志 (poll_log) 也要生成一次状态
+        if not self.poll_log() and not self._unreported:
             return None
+        self._unreported = False
+        with self.stages("生成状态"):
+            return self._build_state()
 
-        # 使用 hslog 解析器更新游戏状态
-        self.tracker.process_log_chunk(content)
-        
+    def _build_state(self):
+        """由 GameStateTracker 的当前状态生成决策用的状态字典；没有可决策的内容时返回 None"""
         # 如果没有游戏数据，返回 None
         if not self.tracker.game:
             return None
@@ -826,8 +3138,7 @@ class HearthstoneAutoPilot:
                 display_msg += f"\n[!] 发现/抉择: {len(choices)}"
 
             if self.overlay:
-                self.overlay.root.after(
-                    0, self.overlay.update_status, display_msg)
+                self.overlay.post(self.overlay.update_status, display_msg)
             else:
                 self.log(display_msg)
 
@@ -849,6 +3160,7 @@ class HearthstoneAutoPilot:
                 "my_hero": my_hero,
                 "enemy_hero": enemy_hero,
                 "choices": choices,
+                "game_over": self.tracker.is_game_over(),
                 "message": "Log update detected (via hslog)"
             }
 
@@ -858,6 +3170,43 @@ class HearthstoneAutoPilot:
 
 
 
+    def poll_log(self):
+        """读取新增日志并更新 GameStateTracker，返回是否读到了新内容"""
+        try:
+            content = self.tailer.read()
+        except Exception as e:
+            print(f"[!] 读取日志出错: {e}")
+            return False
+
+        if not content:
+            return False
+
+        # 使用 hslog 解析器更新游戏状态
+        with self.stages("解析日志"):
+            self.tracker.process_log_chunk(content)
+        return True
+
+    def build_prompt(self, state, encoder=None):
+        """根据游戏状态生成提示词 (固定的规则说明在前，紧凑编码的状态在后)"""
+        encoder = encoder or self.prompt_encoder
+        with self.stages("提示词"):
+            state_text = encoder.encode(state)
+        if encoder.trimmed:
+            print(f"[*] 提示词超出预算，已省略: {', '.join(encoder.trimmed)}")
+        # 针对 Mulligan 阶段的特殊 Prompt
+        if state.get("game_phase") == "MULLIGAN":
+            prompt = f"{MULLIGAN_PROMPT}\n{STATE_LEGEND}\n{state_text}"
+        else:
+            # 常规回合 Prompt - 职业选手版 (Professional Player)
+            prompt = f"{TURN_PROMPT}\n{STATE_LEGEND}\nCurrent Game State:\n{state_text}"
+            hint = combat_hint(state)
+            if hint:
+                prompt += f"\n{hint}"
+            if state.get("rejected"):
+                prompt += (f"\nNote: your previous plan was stopped because an action was no longer valid "
+                           f"({state['rejected']}). Plan again from the state above.")
+        return prompt
+
     def decide_action(self, state):
         """请求 OpenAI 返回 JSON 格式的操作指令"""
         if not state:
@@ -868,127 +3217,143 @@ class HearthstoneAutoPilot:
 
         self.log("[*] AI 正在思考中...")
 
-        # 针对 Mulligan 阶段的特殊 Prompt
-        if state.get("game_phase") == "MULLIGAN":
-            prompt = f"""
-            你是一个炉石传说AI助手。现在是起手调度阶段 (Mulligan)。
-            
-            你的手牌: {state.get("hand_cards", [])}
-            你的牌库剩余: {state.get("my_deck", [])}
-            
-            请决定替换掉哪些牌。通常保留低费随从，替换高费牌。
-            请输出 JSON 响应，格式如下：
-            {{
-                "thought": "简短的一句话思考过程",
-                "actions": [
-                    {{ "type": "MULLIGAN_REPLACE", "hand_index": 0, "desc": "替换第1张" }},
-                    {{ "type": "MULLIGAN_CONFIRM", "desc": "确认" }}
-                ]
-            }}
-            注意：如果不替换任何牌，直接输出 MULLIGAN_CONFIRM。
-            只输出 JSON。
-            """
-        else:
-            # 常规回合 Prompt - 职业选手版 (Professional Player)
-            prompt = f"""
-            Role: You are a professional Hearthstone player aiming for the highest win rate.
-            
-            Current Game State (JSON):
-            {json.dumps(state, ensure_ascii=False)}
-            
-            Your Strategic Priorities (in order):
-            0. **DECK AWARENESS**: Check your 'my_deck' in the state JSON to know what cards are remaining.
-            1. **HANDLE CHOICES**: If "choices" list is present and not empty, you MUST return a "CHOOSE" action immediately. Do not do anything else.
-            2. **CHECK LETHAL**: Calculate if you can kill the enemy hero this turn (Board damage + Hand damage). If yes, IGNORE TRADING and go face.
-            3. **SURVIVAL**: If your Health is low, prioritize Taunt, Healing, or Clearing the board.
-            4. **VALUE TRADING**: If not lethal, make favorable trades (kill enemy minion while keeping yours alive).
-            5. **TEMPO**: Spend as much Mana as possible. Develop the board.
-            6. **FACE**: If no good trades, attack Enemy Hero.
-            
-            Rules:
-            - Minions with "exhausted": true cannot attack (unless they have Rush/Charge, but assume mostly no).
-            - Minions with "attack": 0 cannot attack.
-            - You cannot target "immune" or "stealth" characters.
-            
-            Output Format:
-            Provide a strictly valid JSON response.
-            IMPORTANT: Your 'thought' content MUST be in CHINESE.
-            {{
-                "thought": "简短的中文战术思考。例如：'斩杀线不够，优先解场。' / '发现法术。'",
-                "actions": [
-                    {{ "type": "CHOOSE", "index": 0, "desc": "Pick option 0" }},
-                    {{ "type": "PLAY_MINION", "hand_index": 0, "desc": "Play Card X" }},
-                    {{ "type": "PLAY_TARGET", "hand_index": 0, "target_type": "enemy_hero", "desc": "Fireball to Face" }},
-                    {{ "type": "PLAY_TARGET", "hand_index": 0, "target_type": "minion", "target_index": 0, "desc": "Buff my minion 0" }},
-                    {{ "type": "ATTACK", "attacker_index": 0, "target_type": "minion", "target_index": 0, "desc": "My Minion 0 trades Enemy Minion 0" }},
-                    {{ "type": "ATTACK", "attacker_index": 0, "target_type": "enemy_hero", "desc": "Go Face" }},
-                    {{ "type": "HERO_POWER", "desc": "Use Hero Power" }},
-                    {{ "type": "END_TURN", "desc": "End Turn" }}
-                ]
-            }}
-            
-            IMPORTANT: Return ONLY the JSON. No markdown formatting.
-            """
+        prompt = self.build_prompt(state)
 
         try:
-            # 使用 requests 调用，保持与原版一致的兼容性 (用户指定)
-            headers = {
-                "Authorization": f"Bearer {self.config['API_KEY']}",
-                "Content-Type": "application/json"
-            }
-
-            # 优先尝试 gemini-3-flash-preview (用户保留)
-            model_name = "gemini-3-flash-preview"
-            data = {
-                "model": model_name,
-                "messages": [
-                    {"role": "system", "content": "You are a JSON-only response bot. Output ONLY valid JSON."},
-                    {"role": "user", "content": prompt}
-                ]
-            }
-
-            print(f"[*] 调用模型: {model_name} (via requests)")
+            # 使用 requests 调用，保持与原版一致的兼容性 (用户指定)；Session 复用连接
+            # 默认模型 gemini-3-flash-preview (用户保留)，可在 BACKENDS 中为每个后端指定
+            with self.stages("模型"):
+                return self.router.request_plan(self.build_messages(prompt))
 
-            response = requests.post(
-                f"{self.config['BASE_URL']}/chat/completions",
-                headers=headers,
-                json=data,
-                timeout=30
-            )
-
-            # 错误处理
-            if response.status_code != 200:
-                print(
-                    f"[!] API Error: {response.status_code} - {response.text}")
-                return None
+        except Exception as e:
+            print(f"[!] AI 决策失败: {e}")
+            return None
 
-            result = response.json()
-            content = result['choices'][0]['message']['content']
+    def build_messages(self, prompt, encoder=None):
+        # system 消息 = 固定说明 + 本局卡牌词典 (由 build_prompt 更新)
+        return [
+            {"role": "system", "content": (encoder or self.prompt_encoder).system_text},
+            {"role": "user", "content": prompt}
+        ]
 
-            # 清理 Markdown
-            content = content.replace("```json", "").replace("```", "").strip()
-            if content.startswith("```json"):
-                content = content[7:]
-            if content.endswith("```"):
-                content = content[:-3]
+    def decide_and_execute(self, state, hand_size=0):
+        """流式决策：模型每输出一个完整操作就立即执行，不等待整个 JSON 生成完毕
 
-            plan = json.loads(content)
-            return plan
+        流式请求由 LLMRouter.open_stream 竞速：延迟最低的后端在 p50 内没有输出第一个完整操作时同时请求下一个后端，
+        报错或输出不了完整操作时换下一个。返回完整计划 (thought + 已执行的 actions)，没有执行任何操作时返回 None。
+        请求和读取流的错误在读取线程中处理；执行操作抛出的异常 (如 pyautogui 的 FailSafeException) 直接向上传递。
+        流中途失败或输出不完整时计划只执行了一部分，设置 plan_aborted，不写入决策缓存。
+        """
+        if not state or state.get("game_over"):
+            return None
 
-        except Exception as e:
-            print(f"[!] AI 决策失败: {e}")
+        self.log("[*] AI 正在思考中 (流式)...")
+        prompt = self.build_prompt(state)
+        messages = self.build_messages(prompt)
+        parser = ActionStreamParser()
+        executed = []
+        aborted = False
+        _, stream = self.router.open_stream(messages)
+        if stream is None:
             return None
+        try:
+            for delta in stream:
+                for action in parser.feed(delta):
+                    if not executed:
+                        self.log(f"AI 思考:\n{parser.thought or 'No thought provided.'}")
+                    print(f"   [流式] 执行操作: {action.get('desc', action.get('type'))}")
+                    executed.append(action)
+                    if not self.execute_action(action, hand_size):
+                        aborted = True  # 操作没有生效：剩余操作基于过期状态，不再执行
+                        break
+                if aborted:
+                    break
+        finally:
+            stream.close()  # 取消读取线程；本地执行失败截断的流既不算成功也不算失败，不计入延迟样本
+        if aborted:
+            return {"thought": parser.thought, "actions": executed}
+
+        if not executed:
+            return None  # 模型给出了空的操作列表
+        plan = parser.result()
+        if plan is None or len(plan.get("actions", [])) != len(executed):
+            print(f"[!] 流式输出不完整或格式有误，已执行 {len(executed)} 个操作")
+            self.plan_aborted = True
+        return {"thought": parser.thought, "actions": executed}
+
+    def act_on_state(self, state, hand_size=0):
+        """决策并执行，返回执行的计划
+
+        局面与刚执行过的相同 (只有无关日志) 时直接跳过；之前见过的局面复用缓存的计划，不再请求模型。
+        缓存未命中时依次尝试：本地规则 (local_plan)、对手回合中预先规划的计划、请求模型。
+        每一步执行前都由 PlanValidator 校验；计划中途失效 (校验不通过、操作确认超时、流式输出中断) 时不缓存，
+        立即基于最新状态重新决策 (同样先尝试本地规则，校验不通过时请求模型会在提示词中附上失效原因)，
+        同一局面上连续失效超过 MAX_REPLANS 次后等待新的日志。
+        """
+        fingerprint = state_fingerprint(state)
+        if fingerprint != self._replan_fingerprint:
+            self._replans = 0  # 局面变了 (之前的操作生效了)：重新计数
+        if self.plan_rejected:
+            state = dict(state, rejected=self.plan_rejected)
+            self.plan_rejected = None
+        self.plan_confirmed = True
+        self.plan_aborted = False
+        # 没有输入后端时操作不会改变局面，不需要校验
+        if self.input is not None and self.tracker.game and self.tracker.friendly_player_id:
+            self.validator = PlanValidator(self.tracker)
+        try:
+            plan = self._decide_and_run(state, fingerprint, hand_size)
+        finally:
+            self.validator = None
+
+        if self.plan_rejected or self.plan_aborted:
+            # 点歪的操作不改变局面：缓存这个计划会让下一次轮询命中 "局面未变化" 而卡住
+            self.decision_cache.discard(fingerprint)
+            self._replan_fingerprint = fingerprint
+            self._replans += 1
+            if self._replans <= self.config.get("MAX_REPLANS", 2):
+                print("[*] 计划已失效，基于最新状态重新决策")
+                self._unreported = True
+            return plan
+        self._replans = 0
+        if plan:
+            self.decision_cache.put(fingerprint, plan)
+            self._last_fingerprint = fingerprint
+        return plan
+
+    def _decide_and_run(self, state, fingerprint, hand_size):
+        plan = self.decision_cache.get(fingerprint)
+        if plan is not None:
+            if fingerprint == self._last_fingerprint:
+                print("[*] 局面未变化，跳过本次决策")
+                return None
+            print("[*] 命中决策缓存，复用之前的计划")
+            self.perform_mouse_actions(plan, hand_size=hand_size)
+        elif self.config.get("LOCAL_FAST_PATH", True) and (plan := self.stages.timed("本地规则", local_plan, state)):
+            print("[*] 本地规则直接决策，不请求模型")
+            self.perform_mouse_actions(plan, hand_size=hand_size)
+        elif self.planner and (plan := self.planner.take(state)):
+            print("[*] 使用对手回合中预先规划的计划")
+            self.perform_mouse_actions(plan, hand_size=hand_size)
+        elif self.config.get("STREAMING", True):
+            # 流式决策：模型每输出一个完整操作就立即执行
+            plan = self.stages.timed("流式模型 (含执行)", self.decide_and_execute, state, hand_size=hand_size)
+        else:
+            # 获取决策 JSON 后执行
+            plan = self.decide_action(state)
+            self.perform_mouse_actions(plan, hand_size=hand_size)
+        return plan
 
     def get_scaled_coord(self, pos):
         """
         将相对坐标 (0.0-1.0) 转换为当前屏幕的绝对坐标。
-        完全基于 pyautogui.size() 获取的实时分辨率，不依赖任何预设值。
+        完全基于输入后端获取的实时分辨率，不依赖任何预设值。
         """
         if not pos:
             return (0, 0)
 
         x, y = pos
-        screen_w, screen_h = pyautogui.size()
+        screen_w, screen_h = self.get_screen_size()
 
         # 确保输入是相对坐标
         if isinstance(x, float) and x <= 1.0 and isinstance(y, float) and y <= 1.0:
@@ -1000,6 +3365,12 @@ class HearthstoneAutoPilot:
         return (int(x), int(y))
 
 
+    def get_screen_size(self):
+        """屏幕分辨率 (由输入后端提供)；headless 模式没有显示器，使用 config 中的 SCREEN_SIZE (默认 1920x1080)"""
+        if self.input is None:
+            return tuple(self.config.get("SCREEN_SIZE", (1920, 1080)))
+        return self.input.size()
+
     def get_hand_card_pos(self, index, total_cards):
         """动态计算手牌坐标 (Relative)"""
         # 基础参数 (校准后)
@@ -1027,35 +3398,17 @@ class HearthstoneAutoPilot:
         x = start_x + index * spacing
         return (x, y_pos)
 
-    def vision_verify_highlight(self, x, y, radius=30):
+    def vision_verify_highlight(self, x, y, radius=30, grab=True):
         """
         验证屏幕指定坐标周围是否有绿色/黄色高亮 (使用 OpenCV)
+        grab=False 时复用 self.capture 中的当前帧，不重新截图
         """
         try:
-            # 1. 截取小区域 (减少计算开销)
-            left, top = int(x - radius), int(y - radius)
-            width, height = radius * 2, radius * 2
-            
-            # 使用 PIL 或 PyAutoGUI 截图并转换为 OpenCV 格式
-            screenshot = pyautogui.screenshot(region=(left, top, width, height))
-            img = cv2.cvtColor(np.array(screenshot), cv2.COLOR_RGB2BGR)
-            
-            # 2. 转换到 HSV 空间检测颜色
-            # 炉石可操作卡的绿光高亮 (大致范围)
-            hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
-            
-            # 绿色高亮范围 (Hue: 40-90, Sat: 50-255, Val: 50-255)
-            lower_green = np.array([35, 100, 100])
-            upper_green = np.array([85, 255, 255])
-            mask_green = cv2.inRange(hsv, lower_green, upper_green)
-            
-            # 黄色高亮范围 (金色传说/部分抉择卡)
-            lower_yellow = np.array([20, 100, 100])
-            upper_yellow = np.array([35, 255, 255])
-            mask_yellow = cv2.inRange(hsv, lower_yellow, upper_yellow)
-            
-            green_pixels = cv2.countNonZero(mask_green)
-            yellow_pixels = cv2.countNonZero(mask_yellow)
+            if grab or self.capture.frame is None:
+                self.capture.grab()
+            region = (int(x - radius), int(y - radius), radius * 2, radius * 2)
+            green_pixels = self.capture.count(GREEN_HIGHLIGHT, *region)
+            yellow_pixels = self.capture.count(YELLOW_HIGHLIGHT, *region)
             
             total_active = green_pixels + yellow_pixels
             print(f"   [Vision] 坐标({x},{y}) 检测到高亮像素: 绿={green_pixels}, 黄={yellow_pixels}")
@@ -1070,21 +3423,13 @@ class HearthstoneAutoPilot:
         验证屏幕中央是否出现了“发现/抉择”的蓝色横幅
         """
         try:
-            screen_w, screen_h = pyautogui.size()
-            # 截取屏幕中央一条带 (横跨大部分宽度，高度在 0.1-0.2 左右)
+            screen_w, screen_h = self.get_screen_size()
+            # 屏幕中央一条带 (横跨大部分宽度，高度在 0.1-0.2 左右)
             left, top = int(screen_w * 0.2), int(screen_h * 0.1)
             width, height = int(screen_w * 0.6), int(screen_h * 0.15)
             
-            screenshot = pyautogui.screenshot(region=(left, top, width, height))
-            img = cv2.cvtColor(np.array(screenshot), cv2.COLOR_RGB2BGR)
-            hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
-            
-            # 炉石抉择横幅的深蓝色/紫色背景
-            lower_blue = np.array([100, 50, 50])
-            upper_blue = np.array([130, 255, 255])
-            mask_blue = cv2.inRange(hsv, lower_blue, upper_blue)
-            
-            blue_pixels = cv2.countNonZero(mask_blue)
+            self.capture.grab()
+            blue_pixels = self.capture.count(CHOICE_BANNER, left, top, width, height)
             print(f"   [Vision] 抉择检测: 蓝色像素={blue_pixels}")
             return blue_pixels > 2000 # 经验值：大横幅会有很多蓝色像素
         except Exception as e:
@@ -1108,27 +3453,43 @@ class HearthstoneAutoPilot:
         if debug_mode:
             return start_pos
 
-        # [VISION] 校验并寻找由于间距偏差导致的“点歪”
+        # [VISION] 校验并寻找由于间距偏差导致的“点歪”：悬停一次让卡牌抬起并显示高亮，
+        # 之后只截一帧，中心和左右微调位置都在这一帧上检测
         print(f"   [Vision] 正在尝试悬停第 {idx+1} 张手牌...")
-        pyautogui.moveTo(start_pos[0], start_pos[1], duration=0.2)
-        time.sleep(0.3)
-        
-        if self.vision_verify_highlight(start_pos[0], start_pos[1]):
-            return start_pos
-        
-        # 左右微调扫描
-        for offset in [-20, 20, -40, 40, -60, 60]:
-            test_x = start_pos[0] + offset
-            pyautogui.moveTo(test_x, start_pos[1], duration=0.1)
-            time.sleep(0.1)
-            if self.vision_verify_highlight(test_x, start_pos[1]):
-                print(f"   [Vision] 在偏移量 {offset} 处修正了卡牌中心")
-                return (test_x, start_pos[1])
-        
-        print(f"   [Warning] 无法确认卡牌高亮，将使用原计算坐标: {start_pos}")
-        return start_pos
+        self.input.move_to(start_pos[0], start_pos[1], duration=0.2)
+        self.clock.sleep(0.3)
+        pos = start_pos
+        try:
+            self.capture.grab()
+        except Exception as e:
+            print(f"   [Vision] 截图出错: {e}")
+        else:
+            for offset in HAND_PROBE_OFFSETS:
+                test_x = start_pos[0] + offset
+                if self.vision_verify_highlight(test_x, start_pos[1], grab=False):
+                    if offset:
+                        print(f"   [Vision] 在偏移量 {offset} 处修正了卡牌中心")
+                    pos = (test_x, start_pos[1])
+                    break
+            else:
+                print(f"   [Warning] 无法确认卡牌高亮，将使用原计算坐标: {start_pos}")
+
+        # 拖拽从当前鼠标位置开始：修正过的位置需要再移动一次
+        if pos != start_pos:
+            self.input.move_to(pos[0], pos[1], duration=0.1)
+        return pos
 
 
+    def locate_minion(self, side, index, debug_mode=False, grab=True):
+        """随从中心的屏幕坐标 (side 为 "mine" / "enemy")：在一帧截图上识别，随从数量取自日志中的场面"""
+        board = self.tracker.get_my_board() if side == "mine" else self.tracker.get_opp_board()
+        if not debug_mode and (grab or self.capture.frame is None):
+            try:
+                self.capture.grab()
+            except Exception as e:
+                print(f"   [Vision] 截图出错: {e}")
+        return self.get_scaled_coord(self.locator.locate(side, index, len(board)))
+
     def perform_mouse_actions(self, plan, hand_size=0):
         """
         将 JSON 指令转换为 PyAutoGUI 动作
@@ -1147,8 +3508,54 @@ class HearthstoneAutoPilot:
 
         print(f"DEBUG: {plan}")
 
+        for action in plan["actions"]:
+            if not self.execute_action(action, hand_size):
+                break
+
+    def execute_action(self, action, hand_size=0):
+        """执行单个操作，并等待日志中出现对应的结果 (闭环执行，代替固定的等待时间)
+
+        确认后才执行下一步；超时 (ACTION_CONFIRM_TIMEOUT) 说明操作没有生效或状态已变化，
+        设置 plan_aborted 并返回 False，调用方应停止执行剩余操作、基于最新状态重新决策。
+        没有输入后端 (headless) 或日志中没有对应事件的操作不等待，直接返回 True，但计划不算已确认。
+        有 PlanValidator 时先按当前局面重映射下标 (手牌数量也取当前值)；操作已无法执行时不操作鼠标，
+        记下原因 (plan_rejected) 并返回 False。
+        """
+        if self.validator is not None:
+            checked, reason = self.validator.check(action)
+            if checked is None:
+                print(f"[!] 操作已失效，停止执行剩余操作: {action.get('desc', action.get('type'))} ({reason})")
+                self.plan_rejected = f"{action.get('type')} {reason}"
+                return False
+            action, hand_size = checked, self.validator.hand_size()
+        expect = self.tracker.expect(action) if self.input is not None and self.tailer else None
+        with self.stages("执行"):
+            self.perform_action(action, hand_size)
+        if expect is None:
+            self.plan_confirmed = False
+            return True
+
+        timeout = self.config.get("ACTION_CONFIRM_TIMEOUT", 5.0)
+        deadline = self.clock.monotonic() + timeout
+        while not expect():
+            remaining = deadline - self.clock.monotonic()
+            if remaining <= 0:
+                print(f"[!] {timeout}s 内日志中未出现操作结果: {action.get('desc', action.get('type'))}，停止执行剩余操作")
+                self.plan_confirmed = False
+                self.plan_aborted = True
+                return False
+            self.clock.wait(self.tailer, min(remaining, 0.5))
+            if self.poll_log():
+                self._unreported = True
+        print(f"   [确认] {action.get('desc', action.get('type'))}")
+        self.clock.sleep(self.config.get("POST_CONFIRM_DELAY", 0.3))
+        return True
+
+    def perform_action(self, action, hand_size=0):
+        """执行单个操作 (流式模式下模型每输出一个完整操作就会调用一次)"""
         coordinates = self.config.get("COORDINATES", {})
-        debug_mode = self.config.get("DEBUG_MODE", False)
+        # headless 模式下只打印操作，不移动鼠标
+        debug_mode = self.config.get("DEBUG_MODE", False) or self.input is None
         
         # 获取基准坐标配置
         board_center = coordinates.get("BOARD_CENTER", [0.5, 0.5])
@@ -1158,118 +3565,113 @@ class HearthstoneAutoPilot:
         mulligan_cards = coordinates.get("MULLIGAN_CARDS", [])
         mulligan_confirm = coordinates.get("MULLIGAN_CONFIRM", [0.5, 0.75])
 
-        for action in plan["actions"]:
-            action_type = action.get("type")
-
-            if action_type == "CHOOSE":
-                # [VISION] 校验抉择界面是否准备好
-                if not debug_mode:
-                    if not self.vision_verify_choice_ui():
-                        print("   [Vision] 未检测到抉择横幅，等待 0.5s...")
-                        time.sleep(0.5)
-                
-                # 发现/选择：点击
-                idx = action.get("index", 0)
-                if not choice_cards:
-                    choice_cards = [[0.25, 0.5], [0.50, 0.5], [0.75, 0.5]]
-
-                if idx < len(choice_cards):
-                    pos = self.get_scaled_coord(choice_cards[idx])
-                    print(f"   -> 选择选项 {idx} | 坐标 {pos}")
-                    if not debug_mode:
-                        # 悬停一下确认高亮（可选，但通常抉择按钮也有高亮）
-                        pyautogui.moveTo(pos[0], pos[1], duration=0.2)
-                        pyautogui.click()
-
-            elif action_type == "PLAY_MINION" or action_type == "PLAY_SPELL_AOE":
-                idx = action.get("hand_index", 0)
-                # [VISION] 视觉寻找卡牌 (包含计算和扫描)
-                start_pos = self._find_hand_card(idx, hand_size, coordinates, debug_mode)
-                end_pos = self.get_scaled_coord(board_center)
-                
-                print(f"   -> 正在操作: {action.get('desc')} | 坐标 {start_pos} -> {end_pos}")
-                if not debug_mode:
-                    # 已经在 start_pos 了，直接拖拽
-                    pyautogui.dragTo(end_pos[0], end_pos[1], duration=0.8, button='left')
-
-            elif action_type == "PLAY_TARGET":
-                # 指向性法术/战吼
-                idx = action.get("hand_index", 0)
-                start_pos = self._find_hand_card(idx, hand_size, coordinates, debug_mode)
-                
-                # ... (目标识别逻辑同前，略命调整为相对坐标)
-                target_type = action.get("target_type", "enemy_hero")
-                target_idx = action.get("target_index", 0)
-                
-                end_pos = (0, 0)
-                if target_type == "minion":
-                    enemy_minion_pos_list = coordinates.get("ENEMY_MINIONS", [])
-                    if target_idx < len(enemy_minion_pos_list):
-                        end_pos = self.get_scaled_coord(enemy_minion_pos_list[target_idx])
-                    else:
-                        end_pos = self.get_scaled_coord(board_center) # Fallback
-                else:
-                    end_pos = self.get_scaled_coord(enemy_hero)
+        action_type = action.get("type")
 
-                print(f"   -> 指向性打出: {start_pos} -> {end_pos}")
-                if not debug_mode:
-                    # 已经在 start_pos 了，直接拖拽
-                    pyautogui.dragTo(end_pos[0], end_pos[1], duration=0.5, button='left')
+        if action_type == "CHOOSE":
+            # [VISION] 校验抉择界面是否准备好
+            if not debug_mode:
+                if not self.vision_verify_choice_ui():
+                    print("   [Vision] 未检测到抉择横幅，等待 0.5s...")
+                    self.clock.sleep(0.5)
             
-            elif action_type == "END_TURN":
-                pos = self.get_scaled_coord(end_turn)
-                print(f"   -> 结束回合 | 坐标 {pos}")
+            # 发现/选择：点击
+            idx = action.get("index", 0)
+            if not choice_cards:
+                choice_cards = [[0.25, 0.5], [0.50, 0.5], [0.75, 0.5]]
+
+            if idx < len(choice_cards):
+                pos = self.get_scaled_coord(choice_cards[idx])
+                print(f"   -> 选择选项 {idx} | 坐标 {pos}")
                 if not debug_mode:
-                    pyautogui.moveTo(pos[0], pos[1], duration=0.2)
-                    pyautogui.click()
+                    # 悬停一下确认高亮（可选，但通常抉择按钮也有高亮）
+                    self.input.move_to(pos[0], pos[1], duration=0.2)
+                    self.input.click()
+
+        elif action_type == "PLAY_MINION" or action_type == "PLAY_SPELL_AOE":
+            idx = action.get("hand_index", 0)
+            # [VISION] 视觉寻找卡牌 (包含计算和扫描)
+            start_pos = self._find_hand_card(idx, hand_size, coordinates, debug_mode)
+            end_pos = self.get_scaled_coord(board_center)
             
-            elif action_type == "MULLIGAN_REPLACE":
-                idx = action.get("hand_index", 0)
-                if idx < len(mulligan_cards):
-                    pos = self.get_scaled_coord(mulligan_cards[idx])
-                    print(f"   -> 替换手牌 {idx} | 坐标 {pos}")
-                    if not debug_mode:
-                        pyautogui.click(pos[0], pos[1])
-
-            elif action_type == "MULLIGAN_CONFIRM":
-                pos = self.get_scaled_coord(mulligan_confirm)
-                print(f"   -> 确认调度")
-                if not debug_mode:
-                    pyautogui.click(pos[0], pos[1])
-
-            elif action_type == "HERO_POWER":
-                hero_power_pos = coordinates.get("HERO_POWER", [0.6, 0.75]) # 默认值
-                pos = self.get_scaled_coord(hero_power_pos)
-                print(f"   -> 使用英雄技能")
-                if not debug_mode:
-                    pyautogui.click(pos[0], pos[1])
-
-            elif action_type == "ATTACK":
-                 # 简化版: 默认第一个随从打脸
-                 # 实际需要完善 My Minions 相对坐标
-                atk_idx = action.get("attacker_index", 0)
-                my_minion_pos = coordinates.get("MY_MINIONS", [])
-                
-                start_pos = (0,0)
-                if atk_idx < len(my_minion_pos):
-                     start_pos = self.get_scaled_coord(my_minion_pos[atk_idx])
-                
+            print(f"   -> 正在操作: {action.get('desc')} | 坐标 {start_pos} -> {end_pos}")
+            if not debug_mode:
+                # 已经在 start_pos 了，直接拖拽
+                self.input.drag_to(end_pos[0], end_pos[1], duration=0.8)
+
+        elif action_type == "PLAY_TARGET":
+            # 指向性法术/战吼
+            idx = action.get("hand_index", 0)
+            start_pos = self._find_hand_card(idx, hand_size, coordinates, debug_mode)
+            
+            # ... (目标识别逻辑同前，略命调整为相对坐标)
+            target_type = action.get("target_type", "enemy_hero")
+            target_idx = action.get("target_index", 0)
+            
+            end_pos = (0, 0)
+            if target_type == "minion":
+                end_pos = self.locate_minion("enemy", target_idx, debug_mode)
+            else:
                 end_pos = self.get_scaled_coord(enemy_hero)
-                print(f"   -> 随从攻击: {start_pos} -> {end_pos}")
+
+            print(f"   -> 指向性打出: {start_pos} -> {end_pos}")
+            if not debug_mode:
+                # 已经在 start_pos 了，直接拖拽
+                self.input.drag_to(end_pos[0], end_pos[1], duration=0.5)
+        
+        elif action_type == "END_TURN":
+            pos = self.get_scaled_coord(end_turn)
+            print(f"   -> 结束回合 | 坐标 {pos}")
+            if not debug_mode:
+                self.input.move_to(pos[0], pos[1], duration=0.2)
+                self.input.click()
+        
+        elif action_type == "MULLIGAN_REPLACE":
+            idx = action.get("hand_index", 0)
+            if idx < len(mulligan_cards):
+                pos = self.get_scaled_coord(mulligan_cards[idx])
+                print(f"   -> 替换手牌 {idx} | 坐标 {pos}")
                 if not debug_mode:
-                    pyautogui.moveTo(start_pos[0], start_pos[1], duration=0.2)
-                    pyautogui.dragTo(end_pos[0], end_pos[1], duration=0.5, button='left')
+                    self.input.click(pos[0], pos[1])
+
+        elif action_type == "MULLIGAN_CONFIRM":
+            pos = self.get_scaled_coord(mulligan_confirm)
+            print(f"   -> 确认调度")
+            if not debug_mode:
+                self.input.click(pos[0], pos[1])
+
+        elif action_type == "HERO_POWER":
+            hero_power_pos = coordinates.get("HERO_POWER", [0.6, 0.75]) # 默认值
+            pos = self.get_scaled_coord(hero_power_pos)
+            print(f"   -> 使用英雄技能")
+            if not debug_mode:
+                self.input.click(pos[0], pos[1])
+
+        elif action_type == "ATTACK":
+            # 攻击者和目标在同一帧截图上定位
+            atk_idx = action.get("attacker_index", 0)
+            start_pos = self.locate_minion("mine", atk_idx, debug_mode)
+            
+            end_pos = self.get_scaled_coord(enemy_hero)
+            if action.get("target_type") == "minion":
+                end_pos = self.locate_minion("enemy", action.get("target_index", 0), debug_mode, grab=False)
+            print(f"   -> 随从攻击: {start_pos} -> {end_pos}")
+            if not debug_mode:
+                self.input.move_to(start_pos[0], start_pos[1], duration=0.2)
+                self.input.drag_to(end_pos[0], end_pos[1], duration=0.5)
 
 
     def run(self):
         # 初始化文件指针
         log_path = self.config.get("LOG_PATH", "Power.log")
         if os.path.exists(log_path):
-            # 从头读取日志以重建完整状态 (支持中途启动)
-            self.last_tell = 0
+            if self.config.get("FAST_START", True):
+                # 快速启动：直接跳到最后一个 CREATE_GAME，只重建当前对局 (支持中途启动)
+                self.log_start = find_last_game_offset(log_path)
+            else:
+                # 从头读取日志以重建完整状态
+                self.log_start = 0
 
-        print(f"[*] 已重置日志指针 (Start: 0)，正在重建游戏状态...")
-        print("[*] (如果是中途启动，请等待几秒钟让脚本跑完历史记录)")
+        print(f"[*] 已设置日志指针 (Start: {self.log_start})，正在重建游戏状态...")
         print("[*] (请在游戏中进行任意操作，例如查看手牌/表情，以触发日志更新)")
         
         self.log_overlay.update_status("等待游戏开始...")
@@ -1281,55 +3683,277 @@ class HearthstoneAutoPilot:
 
                 # 2. 如果有新状态，且需要操作
                 if state:
-                    if state.get("game_over"):
-                        print("[*] 游戏结束，等待下一局...")
-                        self.log_overlay.update_status("游戏结束")
-                        time.sleep(5)
-                        continue
+                    self.handle_state(state)
+                elif self.clock.done:
+                    break  # 回放结束
+                else:
+                    # 没有新日志：阻塞等待文件写入事件 (毫秒级唤醒)，最多 1 秒
+                    self.clock.wait(self.tailer, 1.0)
+        except KeyboardInterrupt:
+            print("\n[*] 用户停止程序。")
+        finally:
+            if self.planner:
+                self.planner.close()
 
-                    # 检查是否为我的回合
-                    is_my_turn = self.tracker.is_my_turn()
-
-                    # 检测回合开始 (从 False 变为 True)
-                    if is_my_turn and not self.last_is_my_turn:
-                         print("[*] 回合开始！等待抽牌动画(3.5s)...")
-                         self.log_overlay.update_status("回合开始 | 等待抽牌...")
-                         time.sleep(3.5)
-                         # 重新获取状态以确保手牌更新
-                         state = self.get_game_state()
-                         if not state: continue
-                    
-                    self.last_is_my_turn = is_my_turn
-                    phase = state.get("game_phase")
-                    
-                    # 只有在我的回合，或者是起手调度阶段，才进行 AI 思考
-                    if is_my_turn or phase == "MULLIGAN":
-                        self.log_overlay.update_status(f"我的回合 | {phase}")
-                        
-                        # 3. 获取决策 JSON
-                        plan = self.decide_action(state)
-
-                        # 4. 执行鼠标操作 (传递手牌数量以计算动态坐标)
-                        hand_size = len(state.get("hand_cards", []))
-                        self.perform_mouse_actions(plan, hand_size=hand_size)
-                    else:
-                        self.log_overlay.update_status(f"对手回合 | {phase}")
-                        # print("[*] 等待对手行动...") 
+    def handle_state(self, state):
+        """处理一次新状态：我的回合 (或调度阶段) 决策并执行，对手回合预先规划下一回合"""
+        if state.get("game_over"):
+            print("[*] 游戏结束，等待下一局...")
+            self.log_overlay.update_status("游戏结束")
+            return
 
-                    # 防止由于模拟数据的频繁触发导致疯狂操作，实际中Log读取不会这样
-                    time.sleep(5)
+        # 检查是否为我的回合
+        is_my_turn = self.tracker.is_my_turn()
+
+        # 检测回合开始 (从 False 变为 True)
+        if is_my_turn and not self.last_is_my_turn:
+            delay = self.config.get("TURN_START_DELAY", 3.5)
+            print(f"[*] 回合开始！等待抽牌动画({delay}s)...")
+            self.log_overlay.update_status("回合开始 | 等待抽牌...")
+            self.clock.sleep(delay)
+            # 重新获取状态以确保手牌更新
+            state = self.get_game_state()
+            if not state:
+                return
+
+        self.last_is_my_turn = is_my_turn
+        phase = state.get("game_phase")
+
+        # 只有在我的回合，或者是起手调度阶段，才进行 AI 思考
+        if is_my_turn or phase == "MULLIGAN":
+            self.log_overlay.update_status(f"我的回合 | {phase}")
+
+            # 3+4. 决策并执行鼠标操作 (传递手牌数量以计算动态坐标)
+            hand_size = len(state.get("hand_cards", []))
+            plan = self.act_on_state(state, hand_size=hand_size)
+
+            # 每一步都在日志中确认过时，追踪器已是最新状态，可以直接进入下一次决策；
+            # 否则等待动画结算，避免基于过期状态再次决策
+            if plan and not self.plan_confirmed:
+                self.clock.sleep(self.config.get("ACTION_SETTLE_DELAY", 5))
+        else:
+            self.log_overlay.update_status(f"对手回合 | {phase}")
+            if self.planner and phase == "PLAYING":
+                self.planner.observe(state)
+
+# ---- 回放 ----
+LOG_TIME_RE = re.compile(r"^D (\d+):(\d+):(\d+(?:\.\d+)?) ")
+REPLAY_CHUNK_WINDOW = 0.05   # 录制时间相差不超过该秒数的连续日志行作为一次写入
+
+
+class SystemClock:
+    """实时时钟 (默认)：等待新日志由 LogTailer 的文件事件唤醒"""
+
+    done = False  # 实时运行没有结束的时候
+
+    @staticmethod
+    def monotonic():
+        return time.monotonic()
+
+    @staticmethod
+    def sleep(seconds):
+        time.sleep(seconds)
+
+    @staticmethod
+    def wait(tailer, timeout):
+        return tailer.wait(timeout)
+
+
+def load_replay_chunks(path, window=REPLAY_CHUNK_WINDOW):
+    """读取录制的 Power.log，按行首时间戳分段 -> [(距第一行的秒数, 文本)]
+
+    没有时间戳的行并入上一段；时间戳跨过午夜时加 24 小时。
+    """
+    chunks = []
+    first = previous = None
+    day = 0.0
+    with open(path, encoding="utf-8", errors="ignore") as f:
+        for line in f:
+            m = LOG_TIME_RE.match(line)
+            if m:
+                t = int(m.group(1)) * 3600 + int(m.group(2)) * 60 + float(m.group(3)) + day
+                if previous is not None and t < previous - 43200:
+                    day += 86400
+                    t += 86400
+                previous = t
+                if first is None:
+                    first = t
+                if not chunks or t - first - chunks[-1][0] > window:
+                    chunks.append([t - first, []])
+            elif not chunks:
+                chunks.append([0.0, []])
+            chunks[-1][1].append(line)
+    return [(at, "".join(lines)) for at, lines in chunks]
+
+
+class ReplayClock:
+    """回放用的虚拟时钟：按录制时间把日志分段追加到 LOG_PATH
+
+    monotonic() 返回虚拟时间 (秒，从第一行日志开始)；sleep() 和等待日志 (wait) 推进虚拟时间，
+    途经的日志段按录制时的顺序写入文件。speed 为相对录制时的倍速，0 表示不等待。
+    程序里的等待、超时和决策缓存的过期都按虚拟时间计算，同一份日志在任意倍速下的回放结果相同。
+    """
+
+    def __init__(self, chunks, log_path, speed=0.0):
+        self.chunks = chunks
+        self.log_path = log_path
+        self.speed = speed
+        self.now = 0.0
+        self._next = 0
+        self._lock = threading.Lock()  # 模型桩在请求线程中也会推进时钟
+
+    @property
+    def done(self):
+        return self._next >= len(self.chunks)
+
+    def monotonic(self):
+        return self.now
+
+    def _advance(self, target):
+        with self._lock:
+            with open(self.log_path, "a", encoding="utf-8") as f:
+                while self._next < len(self.chunks) and self.chunks[self._next][0] <= target:
+                    at, text = self.chunks[self._next]
+                    self._pass(at)
+                    f.write(text)
+                    f.flush()
+                    self._next += 1
+            self._pass(target)
+
+    def _pass(self, target):
+        if target > self.now:
+            if self.speed > 0:
+                time.sleep((target - self.now) / self.speed)
+            self.now = target
+
+    def sleep(self, seconds):
+        self._advance(self.now + seconds)
+
+    def wait(self, tailer, timeout):
+        """推进到下一段日志的录制时间 (最多 timeout 秒)，返回是否写入了新日志"""
+        written = self._next
+        target = self.now + timeout
+        if not self.done:
+            target = min(target, self.chunks[self._next][0])
+        self._advance(target)
+        return self._next > written
+
+
+class StubLLMClient:
+    """回放用的模型桩：不联网，经过 latency 秒 (虚拟时间) 后返回固定的计划
+
+    调度阶段确认起手，有发现/抉择时选第一个，其余情况直接结束回合。
+    """
+
+    def __init__(self, clock, latency=0.0):
+        self.clock = clock
+        self.latency = latency
+        self.timeout = 30
+        self.requests = 0
+
+    def _reply(self, messages):
+        self.requests += 1
+        self.clock.sleep(self.latency)
+        prompt = messages[-1]["content"]
+        if prompt.startswith(MULLIGAN_PROMPT):
+            action = {"type": "MULLIGAN_CONFIRM", "desc": "确认"}
+        elif '"ch":' in prompt:
+            action = {"type": "CHOOSE", "index": 0, "desc": "选择第一个"}
+        else:
+            action = {"type": "END_TURN", "desc": "结束回合"}
+        return json.dumps({"thought": "回放模型桩", "actions": [action]}, ensure_ascii=False)
 
-                time.sleep(1)
-        except KeyboardInterrupt:
-            print("\n[*] 用户停止程序。")
+    def chat(self, model, messages, cancel=None, timing=None):
+        return self._reply(messages)
 
-if __name__ == "__main__":
-    overlay = LogOverlay()
-    app = HearthstoneAutoPilot(overlay=overlay)
+    def chat_stream(self, model, messages, timing=None):
+        content = self._reply(messages)
+        for i in range(0, len(content), 16):
+            yield content[i:i + 16]
 
-    # 逻辑循环必须在后台线程运行，否则会阻塞 GUI
-    t = threading.Thread(target=app.run, daemon=True)
-    t.start()
+    def close(self):
+        pass
 
-    # GUI 必须在主线程运行
-    overlay.mainloop()
+
+class StageTimer:
+    """按阶段记录耗时 (秒)：with stages("解析日志"): ...；回放结束时 report() 输出汇总"""
+
+    def __init__(self):
+        self.samples = {}
+
+    @contextlib.contextmanager
+    def __call__(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.samples.setdefault(name, []).append(time.perf_counter() - start)
+
+    def timed(self, name, func, *args, **kwargs):
+        with self(name):
+            return func(*args, **kwargs)
+
+    def report(self):
+        for name, samples in self.samples.items():
+            ordered = sorted(samples)
+            p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+            print(f"    {name:<12} {len(ordered):6d} 次 | 总计 {sum(ordered) * 1000:9.1f} ms | 平均 {sum(ordered) / len(ordered) * 1000:7.3f} ms"
+                  f" | p95 {p95 * 1000:7.3f} ms | 最大 {ordered[-1] * 1000:7.3f} ms")
+
+
+def run_replay(recorded_path, speed=0.0, config_path="config.json", llm_latency=0.0, **overrides):
+    """回放模式：把录制的 Power.log 按录制时间分段写入临时日志，驱动完整的决策循环
+
+    模型换成 StubLLMClient，鼠标换成 MockInput (只记录事件)，不需要游戏、显示器和网络；
+    预先规划在后台线程里请求模型，会让结果依赖线程调度，回放时默认关闭。结束后输出各阶段耗时，返回 app。
+    """
+    chunks = load_replay_chunks(recorded_path)
+    with tempfile.TemporaryDirectory() as tmp:
+        log_path = os.path.join(tmp, "Power.log")
+        open(log_path, "w").close()
+        clock = ReplayClock(chunks, log_path, speed)
+        settings = {"LOG_PATH": log_path, "HEADLESS": True, "INPUT_BACKEND": "mock", "SPECULATIVE_PLANNING": False}
+        app = HearthstoneAutoPilot(config_path=config_path, clock=clock, overrides=dict(settings, **overrides))
+        app.router.close()
+        app.router = LLMRouter([LLMBackend("stub", StubLLMClient(clock, llm_latency), "stub")])
+        app.input = MockInput(app.input.size(), clock=clock.monotonic)
+        print(f"[*] 回放 {recorded_path}: {len(chunks)} 段日志，录制时长 {chunks[-1][0] if chunks else 0:.1f}s，"
+              f"倍速 {speed or '不等待'}")
+        start = time.perf_counter()
+        try:
+            app.run()
+        finally:
+            if app.tailer:
+                app.tailer.close()
+        elapsed = time.perf_counter() - start
+    print(f"[*] 回放结束: 虚拟时间 {clock.now:.1f}s，实际用时 {elapsed:.2f}s，"
+          f"模型请求 {app.router.backends[0].client.requests} 次，鼠标事件 {len(app.input.events)} 个")
+    app.stages.report()
+    return app
+
+
+if __name__ == "__main__":
+    # python hearthstone_copilot.py --replay <Power.log> [--speed 倍速] : 回放录制的日志 (模型桩 + mock 鼠标)
+    if "--replay" in sys.argv:
+        speed = float(sys.argv[sys.argv.index("--speed") + 1]) if "--speed" in sys.argv else 0.0
+        run_replay(sys.argv[sys.argv.index("--replay") + 1], speed)
+        sys.exit(0)
+
+    # python hearthstone_copilot.py --headless : 无窗口、无鼠标操作 (也可在 config.json 中设置 "HEADLESS": true)
+    if "--headless" in sys.argv:
+        app = HearthstoneAutoPilot(headless=True)
+    else:
+        app = HearthstoneAutoPilot()
+
+    if app.headless:
+        app.run()
+    else:
+        overlay = LogOverlay()
+        app.overlay = app.log_overlay = overlay
+
+        # 逻辑循环必须在后台线程运行，否则会阻塞 GUI
+        t = threading.Thread(target=app.run, daemon=True)
+        t.start()
+
+        # GUI 必须在主线程运行
+        overlay.mainloop()